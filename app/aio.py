@@ -0,0 +1,260 @@
+"""asyncio engine for the fan-out stages of pause: cordon, toleration patching and node deletion.
+
+Functions here have the same signatures and return values as their sync counterparts in cast_utils and
+k8s_utils, so handle_suspend can pick an engine with ENGINE=async. Every request is a coroutine on one event
+loop instead of a thread per request. Requires the optional aiohttp dependency (poetry install -E async).
+"""
+import asyncio
+import json
+import logging
+import random
+import ssl
+from urllib.parse import quote, urlsplit
+
+import metrics
+
+from cast_utils import (NetworkError, castai_endpoint_class, finish_deletion_summary, get_node_inventory,
+                        invalidate_node_inventory, select_pausable_nodes)
+from k8s_utils import (deployment_record, deployment_tolerates, finish_cordon_summary, finish_toleration_summary,
+                       select_nodes_to_cordon, toleration_patch)
+from utils import get_rate_limiter, retry_delay, sort_outcomes
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover - optional dependency
+    aiohttp = None
+
+
+def available() -> bool:
+    return aiohttp is not None
+
+
+class AsyncHTTPError(Exception):
+    def __init__(self, method: str, url: str, status: int, body: str, headers=None):
+        super().__init__(f"{method} {url} failed with {status}: {body[:200]}")
+        self.status = status
+        self.headers = headers
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, AsyncHTTPError):
+        return exc.status == 429 or 500 <= exc.status < 600
+    return isinstance(exc, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+
+async def _with_retry(f, attempts: int, pause: float):
+    """ async counterpart of utils.basic_retry"""
+    for attempt in range(1, attempts + 1):
+        try:
+            return await f()
+        except Exception as err:
+            if attempt == attempts or not _is_retryable(err):
+                logging.error(f"Call failed: {err}")
+                raise
+            logging.info(f"Retrying after {err}, attempt {attempt}/{attempts}")
+            metrics.RETRIES.inc(function="aio")
+            await asyncio.sleep(retry_delay(err, attempt, pause))
+
+
+async def _request(session, api: str, method: str, url: str, endpoint: str = None, **kwargs):
+    """ endpoint is the path template for the metrics label, derived from url when not given"""
+    code, received = "error", 0
+    sent = len(json.dumps(kwargs["json"])) if "json" in kwargs else 0
+    loop_time = asyncio.get_running_loop().time
+    started = loop_time()
+    try:
+        async with session.request(method, url, **kwargs) as resp:
+            code = resp.status
+            body = await resp.text()
+            received = len(body)
+            if resp.status >= 400:
+                raise AsyncHTTPError(method, url, resp.status, body, resp.headers)
+            return body
+    finally:
+        metrics.count_request(api, method, endpoint or metrics.endpoint_template(urlsplit(url).path), code,
+                              loop_time() - started, sent, received)
+
+
+async def _limited_request(session, endpoint_class: str, method: str, url: str, **kwargs):
+    """ _request counted against the process wide rate limit of the endpoint class"""
+    await asyncio.sleep(get_rate_limiter(endpoint_class).reserve())
+    return await _request(session, "castai" if endpoint_class.startswith("castai") else "kubernetes", method, url,
+                          **kwargs)
+
+
+async def _castai_request(session, method: str, url: str, **kwargs):
+    return await _limited_request(session, castai_endpoint_class(method, url), method, url, **kwargs)
+
+
+async def _gather_bounded(f, items, max_workers: int):
+    """ asyncio counterpart of utils.run_concurrently"""
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def bounded(item):
+        async with semaphore:
+            try:
+                return item, (await f(item), None)
+            except Exception as err:
+                return item, (None, err)
+
+    return dict(await asyncio.gather(*(bounded(item) for item in items)))
+
+
+def _k8s_session(client):
+    """ aiohttp session authenticated like the kubernetes client configuration of client"""
+    configuration = client.api_client.configuration
+    if configuration.refresh_api_key_hook is not None:
+        configuration.refresh_api_key_hook(configuration)
+    headers = {"Accept": "application/json"}
+    authorization = configuration.get_api_key_with_prefix("authorization")
+    if authorization:
+        headers["Authorization"] = authorization
+    ssl_context = ssl.create_default_context(cafile=configuration.ssl_ca_cert)
+    if configuration.cert_file:
+        ssl_context.load_cert_chain(configuration.cert_file, configuration.key_file)
+    if not configuration.verify_ssl:
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    connector = aiohttp.TCPConnector(ssl=ssl_context if configuration.host.startswith("https") else False)
+    return aiohttp.ClientSession(headers=headers, connector=connector, timeout=aiohttp.ClientTimeout(total=120))
+
+
+async def _cordon_all_nodes(client, protect_removal_disabled: str, exclude_node_id: str, max_workers: int):
+    summary = {"cordoned": [], "skipped": [], "failed": {}}
+    to_cordon = select_nodes_to_cordon(client, protect_removal_disabled, exclude_node_id, summary)
+
+    host = client.api_client.configuration.host
+    async with _k8s_session(client) as session:
+        async def cordon(node_name):
+            logging.info("Cordoning: %s" % node_name)
+            return await _with_retry(lambda: _limited_request(
+                session, "k8s-write", "PATCH", f"{host}/api/v1/nodes/{quote(node_name)}",
+                endpoint="/api/v1/nodes/{name}", json={"spec": {"unschedulable": True}},
+                headers={"Content-Type": "application/strategic-merge-patch+json"}), attempts=3, pause=10)
+
+        outcomes = await _gather_bounded(cordon, to_cordon, max_workers)
+    return finish_cordon_summary(summary, sort_outcomes(outcomes, summary, "cordoned"))
+
+
+def cordon_all_nodes(client, protect_removal_disabled: str, exclude_node_id: str, max_workers: int = 10):
+    """ async engine variant of k8s_utils.cordon_all_nodes"""
+    return asyncio.run(_cordon_all_nodes(client, protect_removal_disabled, exclude_node_id, max_workers))
+
+
+async def _add_special_tolerations(client, deployments: list, toleration: str, max_workers: int):
+    summary = {"patched": [], "skipped": [], "failed": {}}
+    by_key = {deployment.key: deployment for deployment in deployments}
+
+    host = client.api_client.configuration.host
+    async with _k8s_session(client) as session:
+        async def patch(key):
+            deployment = by_key[key]
+            if deployment_tolerates(deployment, toleration):
+                logging.info(f'SKIP Deployment {deployment.name} already has toleration')
+                return False
+            logging.info("Patching and restarting: %s" % deployment.name)
+            url = f"{host}/apis/apps/v1/namespaces/{quote(deployment.namespace)}/deployments/{quote(deployment.name)}"
+            endpoint = "/apis/apps/v1/namespaces/{namespace}/deployments/{name}"
+            try:
+                await _with_retry(lambda: _limited_request(
+                    session, "k8s-write", "PATCH", url, endpoint=endpoint,
+                    json=toleration_patch(deployment, toleration),
+                    headers={"Content-Type": "application/json-patch+json"}), attempts=3, pause=5)
+            except AsyncHTTPError as e:
+                # the guarded patch fails with 422 once the list changed, an earlier attempt may have applied it
+                if e.status != 422:
+                    raise
+                body = await _with_retry(lambda: _limited_request(session, "k8s-read", "GET", url, endpoint=endpoint),
+                                         attempts=3, pause=5)
+                if not deployment_tolerates(deployment_record(json.loads(body)), toleration):
+                    raise
+                logging.info(f'Deployment {deployment.name} already has toleration, applied by an earlier attempt')
+            return True
+
+        outcomes = await _gather_bounded(patch, list(by_key), max_workers)
+    return finish_toleration_summary(summary, sort_outcomes(outcomes, summary, "patched", "skipped"))
+
+
+def add_special_tolerations(client, deployments: list, toleration: str, max_workers: int = 10):
+    """ async engine variant of k8s_utils.add_special_tolerations"""
+    return asyncio.run(_add_special_tolerations(client, deployments, toleration, max_workers))
+
+
+async def _wait_operation(session, castai_api_url: str, operation_id: str, initial_delay: float = 2,
+                          max_delay: float = 30, factor: float = 1.6):
+    """ poll one CAST AI operation with jittered exponential backoff until it is done"""
+    delay = initial_delay
+    while True:
+        await asyncio.sleep(random.uniform(delay / 2, delay))
+        logging.info("checking operation ID: %s", operation_id)
+        ops_response = await _with_retry(lambda: _castai_request(
+            session, "GET", f"{castai_api_url}/v1/kubernetes/external-clusters/operations/{operation_id}"),
+            attempts=5, pause=delay)
+        ops_response = _json(ops_response)
+        if ops_response.get("done"):
+            logging.info(f"ops_response: {ops_response}")
+            if ops_response.get("error"):
+                raise NetworkError(f'Operation {operation_id} failed: {ops_response["error"]}')
+            return ops_response
+        delay = min(max_delay, delay * factor)
+
+
+def _json(body: str):
+    return json.loads(body) if body else {}
+
+
+async def _delete_all_pausable_nodes(cluster_id: str, castai_api_url: str, castai_api_token: str,
+                                     hibernation_node_id: str, protect_removal_disabled: str, job_node_id,
+                                     max_workers: int, operation_timeout: float, wait_operations: bool):
+    inventory = get_node_inventory(cluster_id, castai_api_url, castai_api_token)
+    summary = {"deleted": [], "in_progress": [], "skipped": [], "failed": {}}
+    to_delete = select_pausable_nodes(inventory, hibernation_node_id, protect_removal_disabled, job_node_id, summary)
+
+    headers = {"accept": "application/json", "X-API-Key": castai_api_token}
+    async with aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=120)) as session:
+        async def delete(node_id):
+            url = f"{castai_api_url}/v1/kubernetes/external-clusters/{cluster_id}/nodes/{node_id}"
+            body = await _with_retry(lambda: _castai_request(session, "DELETE", url,
+                                                             params={"forceDelete": "true", "drainTimeout": "60"}),
+                                     attempts=3, pause=30)
+            invalidate_node_inventory(cluster_id, castai_api_url)
+            return _json(body).get("operationId")
+
+        # deletes are bounded by max_workers, waiting for the drain operations is not
+        outcomes = await _gather_bounded(delete, to_delete, max_workers)
+        operations = {}
+        errors = {}
+        for node_id, (operation_id, err) in outcomes.items():
+            if err is not None:
+                summary["failed"][node_id] = str(err)
+                errors[node_id] = err
+            elif operation_id and not wait_operations:
+                summary["in_progress"].append(node_id)
+            elif operation_id:
+                operations[node_id] = asyncio.ensure_future(_wait_operation(session, castai_api_url, operation_id))
+            else:
+                logging.info(f"Node {node_id} deleted successfully (204 No Content)")
+                summary["deleted"].append(node_id)
+
+        if operations:
+            await asyncio.wait(operations.values(), timeout=operation_timeout)
+        for node_id, task in operations.items():
+            if not task.done():
+                task.cancel()
+                logging.warning("Node %s deletion still in progress after %ss", node_id, operation_timeout)
+                summary["in_progress"].append(node_id)
+            elif task.exception() is not None:
+                summary["failed"][node_id] = str(task.exception())
+                errors[node_id] = task.exception()
+            else:
+                summary["deleted"].append(node_id)
+    return finish_deletion_summary(summary, errors)
+
+
+def delete_all_pausable_nodes(cluster_id: str, castai_api_url: str, castai_api_token: str, hibernation_node_id: str,
+                              protect_removal_disabled: str, job_node_id=None, max_workers: int = 10,
+                              operation_timeout: float = 600, wait_operations: bool = True):
+    """ async engine variant of cast_utils.delete_all_pausable_nodes"""
+    return asyncio.run(_delete_all_pausable_nodes(cluster_id, castai_api_url, castai_api_token, hibernation_node_id,
+                                                  protect_removal_disabled, job_node_id, max_workers,
+                                                  operation_timeout, wait_operations))
@@ -0,0 +1,269 @@
+"""Local benchmarks for hibernate, no cloud cluster or API key needed.
+
+    python bench.py reuse --requests 500
+    python bench.py startup --runs 10
+    python bench.py snapshot --deployments 5000
+    python bench.py scale --nodes 10 100 1000 5000
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from cast_utils import CastAIClient
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """ Answers every GET with a small CAST AI-like JSON body, keeps connections alive"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = json.dumps({"items": [], "enabled": True}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.accepted = 0
+
+    def get_request(self):
+        conn = super().get_request()
+        self.accepted += 1
+        return conn
+
+
+def start_stand_in_server(handler=_StandInHandler, server_class=_CountingServer):
+    """ Start HTTP server on a free local port in a daemon thread, returns (server, base url)"""
+    server = server_class(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def bench_connection_reuse(count: int):
+    """ Compare per-call requests.get against the pooled CastAIClient"""
+    server, url = start_stand_in_server()
+    try:
+        started = time.perf_counter()
+        for _ in range(count):
+            requests.get(url + "/v1/kubernetes/clusters/bench/policies",
+                         headers={"accept": "application/json", "X-API-Key": "bench"}).raise_for_status()
+        per_call = {"seconds": time.perf_counter() - started, "connections": server.accepted}
+
+        server.accepted = 0
+        client = CastAIClient(url, "bench")
+        responses = []
+        client.add_response_hook(responses.append)
+        started = time.perf_counter()
+        for _ in range(count):
+            client.get("/v1/kubernetes/clusters/bench/policies").raise_for_status()
+        pooled = {"seconds": time.perf_counter() - started, "connections": server.accepted,
+                  "client_connections": client.connections_opened(), "responses": len(responses)}
+        client.close()
+    finally:
+        server.shutdown()
+
+    return {"requests": count, "per_call": per_call, "pooled": pooled}
+
+
+STARTUP_SCENARIOS = {
+    "interpreter": "pass",
+    "import main": "import main",
+    "resume job": "import main, context; context.AppContext(cluster_id='bench', castai_api_token='bench')",
+    "pause job": "import main, k8s_utils",
+}
+
+
+def bench_startup(runs: int):
+    """ Cold start latency of a fresh interpreter per scenario, plus slowest imports of the pause job"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = {}
+    for name, code in STARTUP_SCENARIOS.items():
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=here, check=True)
+            timings.append(time.perf_counter() - started)
+        result[name] = {"median": statistics.median(timings), "max": max(timings)}
+
+    importtime = subprocess.run([sys.executable, "-X", "importtime", "-c", STARTUP_SCENARIOS["pause job"]],
+                                cwd=here, check=True, capture_output=True, text=True).stderr
+    # lines look like "import time:   self [us] | cumulative | imported package"
+    cumulative = []
+    for line in importtime.splitlines()[1:]:
+        _, total, module = line.split(":", 1)[1].split("|")
+        cumulative.append((int(total), module.strip()))
+    result["slowest imports us"] = dict((module, total) for total, module in sorted(cumulative, reverse=True)[:10])
+    return result
+
+
+class _MemoryConfigMaps:
+    """ ConfigMap calls of CoreV1Api kept in memory, objects are stored as the JSON the API server would get"""
+
+    def __init__(self):
+        from kubernetes.client import ApiClient
+        self.serialize = ApiClient().sanitize_for_serialization
+        self.objects = {}
+
+    def _missing(self):
+        from kubernetes.client.rest import ApiException
+        return ApiException(status=404, reason="Not Found")
+
+    def read_namespaced_config_map(self, name, namespace):
+        from kubernetes.client import V1ConfigMap
+        if (namespace, name) not in self.objects:
+            raise self._missing()
+        stored = json.loads(self.objects[(namespace, name)])
+        return V1ConfigMap(data=stored.get("data"), binary_data=stored.get("binaryData"))
+
+    def create_namespaced_config_map(self, namespace, body):
+        self.objects[(namespace, body.metadata.name)] = json.dumps(self.serialize(body))
+
+    def replace_namespaced_config_map(self, name, namespace, body):
+        if (namespace, name) not in self.objects:
+            raise self._missing()
+        self.objects[(namespace, name)] = json.dumps(self.serialize(body))
+
+    def patch_namespaced_config_map(self, name, namespace, body):
+        stored = json.loads(self.objects[(namespace, name)])
+        stored.setdefault("data", {}).update(body["data"])
+        self.objects[(namespace, name)] = json.dumps(stored)
+
+    def delete_namespaced_config_map(self, name, namespace):
+        if self.objects.pop((namespace, name), None) is None:
+            raise self._missing()
+
+
+def bench_snapshot(deployments: int, nodes: int, runs: int):
+    """ Build, write and read the pre-pause snapshot of a synthetic cluster against in-memory ConfigMaps"""
+    from cast_utils import node_footprint
+    from k8s_utils import DeploymentRecord, NodeRecord
+    from snapshot import build_snapshot, read_snapshot, save_snapshot
+
+    toleration = "scheduling.cast.ai/paused-cluster"
+    node_records = [NodeRecord(f"node-{i:05d}", {"provisioner.cast.ai/node-id": f"{i:08x}-0000-4000-8000-{i:012x}",
+                                                 "topology.kubernetes.io/zone": f"zone-{i % 3}"}, i % 50 == 0)
+                    for i in range(nodes)]
+    deployment_records = [DeploymentRecord(f"namespace-{i % 200}", f"deployment-{i:05d}", None,
+                                           [{"key": toleration}] if i % 10 == 0 else [], 1 + i % 4, {})
+                          for i in range(deployments)]
+    footprint = node_footprint([{"instanceType": f"type-{i % 7}", "labels": node.labels}
+                                for i, node in enumerate(node_records)])
+
+    client = _MemoryConfigMaps()
+    client.create_namespaced_config_map("castai-agent", _config_map("castai-hibernate-state"))
+    timings = {"build": [], "save": [], "read": []}
+    for _ in range(runs):
+        started = time.perf_counter()
+        snapshot = build_snapshot("cluster", "hibernation", node_records, deployment_records, toleration, footprint)
+        timings["build"].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        meta = save_snapshot(client, "castai-hibernate-state", "castai-agent", snapshot)
+        timings["save"].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        assert read_snapshot(client, "castai-hibernate-state", "castai-agent") == snapshot
+        timings["read"].append(time.perf_counter() - started)
+
+    result = {name: {"median ms": statistics.median(values) * 1000} for name, values in timings.items()}
+    result["json bytes"] = len(json.dumps(snapshot, separators=(",", ":")))
+    result["compressed bytes"] = meta["size"]
+    result["chunks"] = meta["chunks"]
+    result["largest object bytes"] = max(len(stored) for stored in client.objects.values())
+    return result
+
+
+def _config_map(name: str):
+    from kubernetes.client import V1ConfigMap, V1ObjectMeta
+    return V1ConfigMap(metadata=V1ObjectMeta(name=name), data={"last_run_status": "success"})
+
+
+def bench_scale(sizes: list, latency: float, operation_latency: float, rate_limits: str = None):
+    """ Pause and resume end to end against the fake CAST AI and Kubernetes APIs, one fresh cluster per size"""
+    import main as hibernate
+    from fakes import FakeCluster
+    from utils import RATE_LIMITS, parse_rate_limits, set_rate_limit
+
+    # the production limits protect shared APIs, here they would only measure the limiter
+    limits = {endpoint_class: (10000, 10000) for endpoint_class in RATE_LIMITS}
+    limits.update(parse_rate_limits(rate_limits or ""))
+    for endpoint_class, (rate, burst) in limits.items():
+        set_rate_limit(endpoint_class, rate, burst)
+
+    result = {}
+    for size in sizes:
+        cluster = FakeCluster(nodes=size, latency=latency, operation_latency=operation_latency).start()
+        ctx = cluster.context(delete_concurrency=50, cordon_concurrency=50, patch_concurrency=50,
+                              provision_concurrency=50)
+        try:
+            runs = {}
+            for action, run in (("pause", lambda: hibernate.handle_suspend(ctx, "EKS")),
+                                ("resume", lambda: hibernate.handle_resume(ctx))):
+                cluster.calls.clear()
+                tracemalloc.start()
+                started = time.perf_counter()
+                run()
+                seconds = time.perf_counter() - started
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                runs[action] = {"seconds": round(seconds, 2), "peak memory MiB": round(peak / 2 ** 20, 1),
+                                "nodes after": len(cluster.nodes), "calls": sum(cluster.calls.values()),
+                                "calls by endpoint": dict(cluster.calls)}
+            result[f"{size} nodes"] = runs
+        finally:
+            ctx.node_informer.stop()
+            cluster.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="hibernate local benchmarks")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+    reuse = subparsers.add_parser("reuse", help="CAST AI client connection reuse")
+    reuse.add_argument("--requests", type=int, default=200)
+    startup = subparsers.add_parser("startup", help="import and cold start latency of the pause/resume job")
+    startup.add_argument("--runs", type=int, default=5)
+    snapshot = subparsers.add_parser("snapshot", help="pre-pause snapshot size and read/write cost")
+    snapshot.add_argument("--deployments", type=int, default=5000)
+    snapshot.add_argument("--nodes", type=int, default=500)
+    snapshot.add_argument("--runs", type=int, default=5)
+    scale = subparsers.add_parser("scale", help="pause and resume end to end against fake CAST AI and Kubernetes APIs")
+    scale.add_argument("--nodes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    scale.add_argument("--latency", type=float, default=0.005, help="seconds added to every fake API response")
+    scale.add_argument("--operation-latency", type=float, default=0.5,
+                       help="seconds a fake node create or delete operation takes")
+    scale.add_argument("--rate-limits", help="API rate limits like RATE_LIMITS, unlimited by default")
+    args = parser.parse_args()
+
+    if args.bench == "reuse":
+        result = bench_connection_reuse(args.requests)
+    elif args.bench == "startup":
+        result = bench_startup(args.runs)
+    elif args.bench == "snapshot":
+        result = bench_snapshot(args.deployments, args.nodes, args.runs)
+    elif args.bench == "scale":
+        result = bench_scale(args.nodes, args.latency, args.operation_latency, args.rate_limits)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.WARNING)
+    main()
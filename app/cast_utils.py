@@ -1,21 +1,233 @@
+import contextvars
 import logging
+import random
+import threading
 import time
-from utils import basic_retry, parse_labels
-import requests
-from requests import Session
+from concurrent.futures import Future, TimeoutError, wait
+import metrics
+from utils import (FanOutError, basic_retry, finish_summary, get_rate_limiter, parse_labels, run_concurrently,
+                   _is_retryable_error)
+from requests import HTTPError, Session
+from requests.adapters import HTTPAdapter
 
 
 class NetworkError(Exception):
     pass
 
 
+class OperationFailed(NetworkError):
+    pass
+
+
+class OperationTimeout(NetworkError):
+    pass
+
+
+# wording of CAST AI rejections of the instance type itself, a bad request or credentials fail for every type
+INSTANCE_TYPE_REJECTIONS = ("instance type", "capacity", "not available", "unavailable", "not supported",
+                            "unsupported", "quota", "insufficient")
+
+
+def is_instance_type_rejection(err) -> bool:
+    """ CAST AI refused to provision this instance type (not offered in the region, no capacity)"""
+    if not isinstance(err, HTTPError) or err.response is None:
+        return False
+    if err.response.status_code not in (400, 404, 422):
+        return False
+    body = (err.response.text or "").lower()
+    return any(marker in body for marker in INSTANCE_TYPE_REJECTIONS)
+
+
+class CastAIClient:
+    """ Keep-alive HTTP client for CAST AI API, one pooled session shared by all helpers"""
+
+    def __init__(self, castai_api_url: str, castai_api_token: str, pool_maxsize: int = 32,
+                 timeout=(10, 120), session: Session = None):
+        self.castai_api_url = castai_api_url.rstrip("/")
+        self.timeout = timeout
+        self.session = session or Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"accept": "application/json",
+                                     "Accept-Encoding": "gzip, deflate",
+                                     "Connection": "keep-alive",
+                                     "X-API-Key": castai_api_token})
+
+    def add_response_hook(self, hook):
+        """ hook(response) is called for every response, used by benchmarks and instrumentation"""
+        self.session.hooks["response"].append(lambda resp, *args, **kwargs: hook(resp))
+
+    def connections_opened(self) -> int:
+        """ number of TCP connections opened by the pool so far"""
+        opened = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                opened += pools[key].num_connections
+        return opened
+
+    def request(self, method: str, path: str, **kwargs):
+        get_rate_limiter(castai_endpoint_class(method, path)).acquire()
+        kwargs.setdefault("timeout", self.timeout)
+        code, sent, received = "error", 0, 0
+        started = time.monotonic()
+        try:
+            resp = self.session.request(method, self.castai_api_url + path, **kwargs)
+            code = resp.status_code
+            sent = len(resp.request.body or b"")
+            received = len(resp.content)
+            return resp
+        finally:
+            metrics.count_request("castai", method, metrics.endpoint_template(path), code,
+                                  time.monotonic() - started, sent, received)
+
+    def get(self, path: str, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path: str, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path: str, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def castai_endpoint_class(method: str, path: str) -> str:
+    """ rate limit bucket of a CAST AI request, operation polling does not eat into reads"""
+    if "/operations/" in path:
+        return "castai-operations"
+    return "castai-read" if method == "GET" else "castai-write"
+
+
+def get_castai_client(castai_api_url: str, castai_api_token: str) -> CastAIClient:
+    """ Return the shared client for API url and token, created on first use"""
+    key = (castai_api_url, castai_api_token)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = CastAIClient(castai_api_url, castai_api_token)
+        return _clients[key]
+
+
+class OperationTracker:
+    """ Polls many CAST AI operations from one background thread with jittered exponential backoff.
+
+    track() returns a Future resolved with the finished operation, or failed with NetworkError.
+    """
+
+    def __init__(self, client: CastAIClient, initial_delay: float = 2, max_delay: float = 30, factor: float = 1.6,
+                 max_poll_errors: int = 5):
+        self.client = client
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.max_poll_errors = max_poll_errors
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def track(self, operation_id: str) -> Future:
+        with self._condition:
+            if operation_id in self._pending:
+                return self._pending[operation_id]["future"]
+            future = Future()
+            # polls are counted in the API calls of the run that started the operation
+            self._pending[operation_id] = {"future": future, "delay": self.initial_delay,
+                                           "context": contextvars.copy_context(),
+                                           "next_poll": time.monotonic() + self._jitter(self.initial_delay),
+                                           "errors": 0}
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="castai-operations", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+            return future
+
+    def untrack(self, operation_id: str):
+        with self._condition:
+            self._pending.pop(operation_id, None)
+
+    @staticmethod
+    def _jitter(delay: float) -> float:
+        return random.uniform(delay / 2, delay)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._pending:
+                    self._thread = None
+                    return
+                now = time.monotonic()
+                next_poll = min(op["next_poll"] for op in self._pending.values())
+                if next_poll > now:
+                    self._condition.wait(next_poll - now)
+                    continue
+                due = [(op_id, op["context"]) for op_id, op in self._pending.items() if op["next_poll"] <= now]
+            for op_id, context in due:
+                context.run(self._poll, op_id)
+
+    def _poll(self, operation_id: str):
+        logging.info("checking operation ID: %s", operation_id)
+        try:
+            with self.client.get(f"/v1/kubernetes/external-clusters/operations/{operation_id}") as operation:
+                operation.raise_for_status()
+                ops_response = operation.json()
+            error = None
+        except Exception as e:
+            ops_response, error = None, e
+
+        with self._condition:
+            op = self._pending.get(operation_id)
+            if op is None:
+                return
+            if error is not None:
+                op["errors"] += 1
+                if not _is_retryable_error(error) or op["errors"] >= self.max_poll_errors:
+                    del self._pending[operation_id]
+                    failure = NetworkError('Failed to get Operation status')
+                    failure.__cause__ = error
+                    op["future"].set_exception(failure)
+                    return
+            elif ops_response.get("done"):
+                del self._pending[operation_id]
+                logging.info(f"ops_response: {ops_response}")
+                if ops_response.get('error'):
+                    op["future"].set_exception(OperationFailed(f'Operation {operation_id} failed: {ops_response["error"]}'))
+                else:
+                    op["future"].set_result(ops_response)
+                return
+            else:
+                op["errors"] = 0
+            op["delay"] = min(self.max_delay, op["delay"] * self.factor)
+            op["next_poll"] = time.monotonic() + self._jitter(op["delay"])
+
+
+_trackers = {}
+
+
+def get_operation_tracker(castai_api_url: str, castai_api_token: str) -> OperationTracker:
+    """ Return the shared operation tracker for API url and token"""
+    key = (castai_api_url, castai_api_token)
+    client = get_castai_client(castai_api_url, castai_api_token)
+    with _clients_lock:
+        if key not in _trackers:
+            _trackers[key] = OperationTracker(client)
+        return _trackers[key]
+
+
 @basic_retry(attempts=3, pause=5)
 def get_cluster_status(cluster_id, castai_api_url, castai_api_token):
-    url = f"{castai_api_url}/v1/kubernetes/external-clusters/{cluster_id}"
-    header_dict = {"accept": "application/json",
-                   "X-API-Key": castai_api_token}
+    path = f"/v1/kubernetes/external-clusters/{cluster_id}"
 
-    resp = requests.get(url, headers=header_dict)
+    resp = get_castai_client(castai_api_url, castai_api_token).get(path)
     resp.raise_for_status()
     if not resp.content:
         return {}
@@ -32,11 +244,9 @@ def cluster_ready(cluster_id, castai_api_url, castai_api_token):
 
 
 def get_castai_policy(cluster_id, castai_api_url, castai_api_token):
-    url = f"{castai_api_url}/v1/kubernetes/clusters/{cluster_id}/policies"
-    header_dict = {"accept": "application/json",
-                   "X-API-Key": castai_api_token}
+    path = f"/v1/kubernetes/clusters/{cluster_id}/policies"
 
-    resp = requests.get(url, headers=header_dict)
+    resp = get_castai_client(castai_api_url, castai_api_token).get(path)
     resp.raise_for_status()
     if not resp.content:
         return {}
@@ -44,11 +254,9 @@ def get_castai_policy(cluster_id, castai_api_url, castai_api_token):
 
 
 def set_castai_policy(cluster_id, castai_api_url, castai_api_token, updated_policies):
-    url = f"{castai_api_url}/v1/kubernetes/clusters/{cluster_id}/policies"
-    header_dict = {"accept": "application/json",
-                   "X-API-Key": castai_api_token}
+    path = f"/v1/kubernetes/clusters/{cluster_id}/policies"
 
-    resp = requests.put(url, json=updated_policies, headers=header_dict)
+    resp = get_castai_client(castai_api_url, castai_api_token).put(path, json=updated_policies)
     resp.raise_for_status()
     if not resp.content:
         return {}
@@ -79,15 +287,8 @@ def toggle_autoscaler_top_flag(cluster_id: str, castai_api_url: str, castai_api_
         return True
 
 
-@basic_retry(attempts=3, pause=5)
-def create_hibernation_node(cluster_id: str, castai_api_url: str, castai_api_token: str, instance_type: str,
-                            k8s_taint: str, labels: str, cloud: str):
-    """ Create Node with Taint that will stay running during hibernation"""
-    url = f"{castai_api_url}/v1/kubernetes/external-clusters/{cluster_id}/nodes"
-    header_dict = {"accept": "application/json",
-                   "X-API-Key": castai_api_token}
-
-    add_node_result = ""
+def hibernation_node_body(instance_type: str, k8s_taint: str, labels: str, cloud: str) -> dict:
+    """ CAST AI add node request for a hibernation node of instance_type"""
     new_node_body = {}
     new_node_body["instanceType"] = instance_type
 
@@ -117,65 +318,276 @@ def create_hibernation_node(cluster_id: str, castai_api_url: str, castai_api_tok
         if isinstance(parsed_labels, dict):
             new_node_body["kubernetesLabels"].update(parsed_labels)
         else:
-            logging.warning("create_hibernation_node: Parsed labels is not a valid dictionary")
+            logging.warning("hibernation_node_body: Parsed labels is not a valid dictionary")
 
     logging.debug(f'add node body for CAST AI api: {new_node_body}')
+    return new_node_body
 
-    with Session() as session:
-        try:
-            with session.post(url, json=new_node_body, headers=header_dict) as postresp:
-                postresp.raise_for_status()
-                add_node_result = postresp.json()
-        except Exception as e:
-            raise NetworkError(f'Failed to add node {add_node_result}') from e
 
-        # wait for new node to be created, listen to operation
-        ops_id = add_node_result["operationId"]
-        nodeId = add_node_result["nodeId"]
-        urlOperations = f"{castai_api_url}/v1/kubernetes/external-clusters/operations/{ops_id}"
-        done_node_creation = False
+def create_hibernation_node_with_fallback(cluster_id: str, castai_api_url: str, castai_api_token: str,
+                                          instance_types: list, k8s_taint: str, labels: str, cloud: str,
+                                          on_failure=None, operation_timeout: float = 600):
+    """ Create the hibernation node with the first of instance_types CAST AI provisions, returns (node id, type).
 
-        while not done_node_creation:
-            logging.info("checking node creation operation ID: %s", ops_id)
+    A rejected instance type, failed or timed out operation moves on to the next type at once and calls
+    on_failure(instance_type, error). Transient API errors and other rejected requests (credentials, labels) are
+    raised, the next type would fail the same way.
+    """
+    error = None
+    for instance_type in instance_types:
+        new_node_body = hibernation_node_body(instance_type, k8s_taint, labels, cloud)
+        try:
+            add_node_result = add_castai_node(cluster_id, castai_api_url, castai_api_token, new_node_body)
+        except NetworkError as e:
+            if not is_instance_type_rejection(e.__cause__):
+                raise
+            error = e.__cause__
+        else:
+            logging.info("waiting for node creation operation ID: %s", add_node_result["operationId"])
             try:
-                with session.get(urlOperations, headers=header_dict) as operation:
-                    operation.raise_for_status()
-                    ops_response = operation.json()
-            except Exception as e:
-                raise NetworkError('Failed to get Operation status') from e
+                wait_for_node_operation(cluster_id, castai_api_url, castai_api_token,
+                                        add_node_result["operationId"], operation_timeout)
+                return add_node_result["nodeId"], instance_type
+            except (OperationFailed, OperationTimeout) as e:
+                error = e
+                # a failed or still pending node must not come up later as a second hibernation node
+                try:
+                    delete_castai_node(cluster_id, castai_api_url, castai_api_token, add_node_result["nodeId"])
+                except Exception as cleanup_error:
+                    logging.warning("could not delete node %s: %s", add_node_result["nodeId"], cleanup_error)
+        logging.warning("Could not create hibernation node of type %s, trying the next type: %s", instance_type,
+                        error)
+        if on_failure:
+            on_failure(instance_type, error)
+    raise NetworkError(f"could not create hibernation node with any of {', '.join(instance_types)}") from error
+
+
+def add_castai_node(cluster_id: str, castai_api_url: str, castai_api_token: str, new_node_body: dict) -> dict:
+    """ Request a new node, returns the nodeId and operationId without waiting for the node"""
+    path = f"/v1/kubernetes/external-clusters/{cluster_id}/nodes"
+    add_node_result = ""
+    client = get_castai_client(castai_api_url, castai_api_token)
+    try:
+        with client.post(path, json=new_node_body) as postresp:
+            postresp.raise_for_status()
+            add_node_result = postresp.json()
+    except Exception as e:
+        raise NetworkError(f'Failed to add node {add_node_result}') from e
+    finally:
+        invalidate_node_inventory(cluster_id, castai_api_url)
+    return add_node_result
 
-            if ops_response["done"]:
-                logging.info(f"ops_response: {ops_response}")
-                if ops_response.get('error'):
-                    raise NetworkError('Failed to get Operation status')
-                break
-            time.sleep(60)
-        return nodeId
+
+def wait_for_node_operation(cluster_id: str, castai_api_url: str, castai_api_token: str, ops_id: str,
+                            operation_timeout: float):
+    tracker = get_operation_tracker(castai_api_url, castai_api_token)
+    try:
+        tracker.track(ops_id).result(timeout=operation_timeout)
+    except TimeoutError as e:
+        tracker.untrack(ops_id)
+        raise OperationTimeout(f'Node creation operation {ops_id} did not finish in {operation_timeout}s') from e
+    finally:
+        invalidate_node_inventory(cluster_id, castai_api_url)
+
+
+DELETING_PHASES = ("draining", "deleting")
+
+
+class NodeDeletionError(FanOutError):
+    """ nodes failed to delete, errors by CAST AI node id"""
 
 
 @basic_retry(attempts=4, pause=15)
 def delete_all_pausable_nodes(cluster_id: str, castai_api_url: str, castai_api_token: str, hibernation_node_id: str,
-                              protect_removal_disabled: str, job_node_id=None):
-    """" Delete all nodes through CAST AI mothership excluding hibernation node"""
-    node_list_result = get_castai_nodes(cluster_id, castai_api_url, castai_api_token)
-    for node in node_list_result["items"]:
-        # drain/delete each node
+                              protect_removal_disabled: str, job_node_id=None, max_workers: int = 10,
+                              operation_timeout: float = 600, wait_operations: bool = True):
+    """" Delete all nodes through CAST AI mothership excluding hibernation node, max_workers nodes at a time.
+
+    Without wait_operations the deletions are only started and reported in progress, for the node running this pod.
+    """
+    inventory = get_node_inventory(cluster_id, castai_api_url, castai_api_token)
+    summary = {"deleted": [], "in_progress": [], "skipped": [], "failed": {}}
+    to_delete = select_pausable_nodes(inventory, hibernation_node_id, protect_removal_disabled, job_node_id, summary)
+
+    # each node is drained and retried on its own, one failing node does not stop the others
+    outcomes = run_concurrently(lambda node_id: delete_castai_node(cluster_id, castai_api_url, castai_api_token, node_id),
+                                to_delete, max_workers)
+    tracker = get_operation_tracker(castai_api_url, castai_api_token)
+    operations = {}
+    errors = {}
+    for node_id, (ops_id, err) in outcomes.items():
+        if err is not None:
+            summary["failed"][node_id] = str(err)
+            errors[node_id] = err
+        elif ops_id and not wait_operations:
+            summary["in_progress"].append(node_id)
+        elif ops_id:
+            operations[tracker.track(ops_id)] = node_id
+        else:
+            summary["deleted"].append(node_id)
+
+    # deletion operations finish once the node is drained, wait for all of them at once
+    done, not_done = wait(operations, timeout=operation_timeout)
+    for future in done:
+        if future.exception() is None:
+            summary["deleted"].append(operations[future])
+        else:
+            summary["failed"][operations[future]] = str(future.exception())
+            errors[operations[future]] = future.exception()
+    for future in not_done:
+        logging.warning("Node %s deletion still in progress after %ss", operations[future], operation_timeout)
+        summary["in_progress"].append(operations[future])
+
+    return finish_deletion_summary(summary, errors)
+
+
+def select_pausable_nodes(inventory, hibernation_node_id: str, protect_removal_disabled: str, job_node_id, summary: dict):
+    """ ids of nodes to delete, excluded nodes are recorded in summary as skipped"""
+    to_delete = []
+    for node in inventory.items:
         if node["id"] == hibernation_node_id or node["id"] == job_node_id:
             logging.info("Skipping temp node: %s " % node["id"])
+            summary["skipped"].append(node["id"])
             continue
         if node["labels"].get("autoscaling.cast.ai/removal-disabled") == "true" and protect_removal_disabled == "true":
             logging.info("Skipping node protected by removal-disabled ID: %s " % node["id"])
+            summary["skipped"].append(node["id"])
+            continue
+        # a retried run must not delete a draining node again, CAST AI may reject it
+        if node.get("state", {}).get("phase") in DELETING_PHASES:
+            logging.info("Node %s is already being deleted" % node["id"])
+            summary["in_progress"].append(node["id"])
             continue
         logging.info("Deleting: %s with id: %s" % (node["name"], node["id"]))
-        delete_castai_node(cluster_id, castai_api_url, castai_api_token, node["id"])
+        to_delete.append(node["id"])
+    return to_delete
+
+
+def finish_deletion_summary(summary: dict, errors: dict = None):
+    return finish_summary("Node deletion", summary, errors, NodeDeletionError, "delete", "node")
+
+
+# labels set by the cloud, kubelet or CAST AI itself, a new node gets them without asking
+SYSTEM_LABEL_PREFIXES = (
+    "kubernetes.io/", "k8s.io/", "beta.kubernetes.io/", "node.kubernetes.io/", "topology.kubernetes.io/",
+    "failure-domain.beta.kubernetes.io/", "node-role.kubernetes.io/", "provisioner.cast.ai/", "node.cast.ai/",
+    "topology.gke.io/", "cloud.google.com/", "eks.amazonaws.com/", "kubernetes.azure.com/",
+    "node.kubernetes.azure.com/", "autoscaling.cast.ai/",
+    # CAST AI lifecycle and template labels (spot, on-demand, node-template, paused-cluster) describe how the old
+    # node was provisioned, pre-provisioned nodes are on-demand and owned by no template
+    "scheduling.cast.ai/",
+)
+# taints kept up by Kubernetes, cloud controllers and autoscalers, a new node gets its own
+SYSTEM_TAINT_PREFIXES = (
+    "node.kubernetes.io/", "node.cloudprovider.kubernetes.io/", "node-role.kubernetes.io/", "scheduling.cast.ai/",
+    "autoscaling.cast.ai/", "ToBeDeletedByClusterAutoscaler", "DeletionCandidateOfClusterAutoscaler",
+)
+ZONE_LABEL = "topology.kubernetes.io/zone"
+
+
+def node_footprint(nodes: list) -> list:
+    """ nodes grouped by instance type, zone, custom labels and custom taints, each group with a node count"""
+    groups = {}
+    for node in nodes:
+        labels = {key: value for key, value in (node.get("labels") or {}).items()
+                  if not key.startswith(SYSTEM_LABEL_PREFIXES)}
+        taints = sorted(({"key": taint["key"], "value": taint.get("value") or "", "effect": taint["effect"]}
+                         for taint in node.get("taints") or [] if not taint["key"].startswith(SYSTEM_TAINT_PREFIXES)),
+                        key=lambda taint: (taint["key"], taint["value"], taint["effect"]))
+        zone = (node.get("labels") or {}).get(ZONE_LABEL)
+        key = (node.get("instanceType"), zone, tuple(sorted(labels.items())),
+               tuple((taint["key"], taint["value"], taint["effect"]) for taint in taints))
+        if key not in groups:
+            groups[key] = {"instanceType": node.get("instanceType"), "zone": zone, "labels": labels,
+                           "taints": taints, "count": 0}
+        groups[key]["count"] += 1
+    return sorted(groups.values(), key=lambda group: (group["instanceType"] or "", group["zone"] or ""))
+
+
+def pausable_node_footprint(inventory, hibernation_node_id: str, protect_removal_disabled: str) -> list:
+    """ footprint of the ready nodes pause is about to delete, the job node included"""
+    nodes = []
+    for node in inventory.items:
+        if node["id"] == hibernation_node_id or node["state"]["phase"] != "ready":
+            continue
+        if node["labels"].get("autoscaling.cast.ai/removal-disabled") == "true" and protect_removal_disabled == "true":
+            continue
+        nodes.append(node)
+    return node_footprint(nodes)
+
+
+def missing_footprint(footprint: list, inventory) -> list:
+    """ groups of footprint reduced by nodes of the same instance type and zone that already exist"""
+    existing = {}
+    for node in inventory.items:
+        if node["state"]["phase"] in ("ready", "pending", "creating"):
+            key = (node.get("instanceType"), (node.get("labels") or {}).get(ZONE_LABEL))
+            existing[key] = existing.get(key, 0) + 1
+    missing = []
+    for group in footprint:
+        key = (group["instanceType"], group["zone"])
+        covered = min(existing.get(key, 0), group["count"])
+        existing[key] = existing.get(key, 0) - covered
+        if group["count"] > covered:
+            missing.append(dict(group, count=group["count"] - covered))
+    return missing
+
+
+def provision_footprint(cluster_id: str, castai_api_url: str, castai_api_token: str, footprint: list,
+                        max_workers: int = 10, operation_timeout: float = 1800):
+    """ Add every node of the footprint at once, then wait for all creation operations together.
+
+    Best effort, failures are logged and counted, the autoscaler adds whatever is still missing.
+    """
+    bodies = []
+    for group in footprint:
+        body = {"instanceType": group["instanceType"], "kubernetesLabels": dict(group["labels"])}
+        if group.get("zone"):
+            body["zone"] = group["zone"]
+        # snapshots taken before taints were recorded have none
+        if group.get("taints"):
+            body["kubernetesTaints"] = [dict(taint) for taint in group["taints"]]
+        bodies.extend([body] * group["count"])
+    summary = {"created": [], "in_progress": [], "failed": {}}
+    if not bodies:
+        return summary
+    logging.info("Provisioning %s nodes from the pre-pause footprint", len(bodies))
+
+    outcomes = run_concurrently(lambda index: add_castai_node(cluster_id, castai_api_url, castai_api_token,
+                                                              bodies[index]),
+                                range(len(bodies)), max_workers=max_workers)
+    tracker = get_operation_tracker(castai_api_url, castai_api_token)
+    operations = {}
+    for index, (add_node_result, err) in outcomes.items():
+        name = f'{bodies[index]["instanceType"]}#{index}'
+        if err is not None:
+            summary["failed"][name] = str(err)
+        else:
+            operations[tracker.track(add_node_result["operationId"])] = add_node_result["nodeId"]
+
+    done, not_done = wait(operations, timeout=operation_timeout)
+    for future in done:
+        if future.exception() is None:
+            summary["created"].append(operations[future])
+        else:
+            summary["failed"][operations[future]] = str(future.exception())
+    for future in not_done:
+        summary["in_progress"].append(operations[future])
+    invalidate_node_inventory(cluster_id, castai_api_url)
+
+    logging.info("Node provisioning summary: created %s, in progress %s, failed %s",
+                 len(summary["created"]), len(summary["in_progress"]), len(summary["failed"]))
+    for name, err in summary["failed"].items():
+        logging.warning("Failed to provision node %s: %s", name, err)
+    return summary
 
 
 def get_castai_nodes_by_instance_type(cluster_id: str, castai_api_url: str, castai_api_token: str, instance_type: str):
     """" Get all nodes by instance type"""
-    node_list_result = get_castai_nodes(cluster_id, castai_api_url, castai_api_token)
+    inventory = get_node_inventory(cluster_id, castai_api_url, castai_api_token)
     nodes = []
-    for node in node_list_result["items"]:
-        if node["instanceType"] == instance_type and node["state"]["phase"] == "ready":
+    for node in inventory.by_instance_type.get(instance_type, []):
+        if node["state"]["phase"] == "ready":
             nodes.append(node)
     logging.info("Found %s nodes with instance type: %s" % (len(nodes), instance_type))
     return nodes
@@ -200,24 +612,91 @@ def get_suitable_hibernation_node(cluster_id: str, castai_api_url: str, castai_a
 
 def get_castai_nodes(cluster_id, castai_api_url, castai_api_token):
     """ Get all nodes from CAST AI API inside the cluster"""
-    url = f"{castai_api_url}/v1/kubernetes/external-clusters/{cluster_id}/nodes"
-    header_dict = {"accept": "application/json",
-                   "X-API-Key": castai_api_token}
+    path = f"/v1/kubernetes/external-clusters/{cluster_id}/nodes"
 
-    resp = requests.get(url, headers=header_dict)
+    resp = get_castai_client(castai_api_url, castai_api_token).get(path)
     resp.raise_for_status()
     if not resp.content:
         return {"items": []}
     return resp.json()
 
 
+class NodeInventory:
+    """ Point in time snapshot of CAST AI cluster nodes, indexed by id, name, instance type and label"""
+
+    def __init__(self, items: list):
+        self.items = items
+        self.fetched_at = time.monotonic()
+        self.by_id = {}
+        self.by_name = {}
+        self.by_instance_type = {}
+        self.by_label = {}
+        for node in items:
+            self.by_id[node["id"]] = node
+            if node.get("name"):
+                self.by_name[node["name"]] = node
+            self.by_instance_type.setdefault(node.get("instanceType"), []).append(node)
+            for key, value in (node.get("labels") or {}).items():
+                self.by_label.setdefault((key, value), []).append(node)
+
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    def with_label(self, key: str, value: str) -> list:
+        return self.by_label.get((key, value), [])
+
+
+INVENTORY_TTL = 60
+
+_inventories = {}
+# bumped by every invalidation, a listing fetched across one is not cached
+_inventory_generations = {}
+_inventory_locks = {}
+# guards the dicts above only, never held during a fetch
+_inventories_lock = threading.Lock()
+
+
+def _inventory_lock(key) -> threading.Lock:
+    with _inventories_lock:
+        return _inventory_locks.setdefault(key, threading.Lock())
+
+
+def get_node_inventory(cluster_id, castai_api_url, castai_api_token, max_age: float = INVENTORY_TTL) -> NodeInventory:
+    """ Cached CAST AI node listing, fetched again when older than max_age seconds or invalidated"""
+    key = (castai_api_url, cluster_id)
+    # concurrent callers for one cluster share a fetch, other clusters are not held up by it
+    with _inventory_lock(key):
+        with _inventories_lock:
+            inventory = _inventories.get(key)
+            generation = _inventory_generations.get(key, 0)
+        if inventory is not None and inventory.age() <= max_age:
+            return inventory
+        node_list_result = get_castai_nodes(cluster_id, castai_api_url, castai_api_token)
+        inventory = NodeInventory(node_list_result.get("items", []))
+        with _inventories_lock:
+            if _inventory_generations.get(key, 0) == generation:
+                _inventories[key] = inventory
+        logging.debug("Node inventory refreshed, %s nodes", len(inventory.items))
+        return inventory
+
+
+def invalidate_node_inventory(cluster_id, castai_api_url):
+    """ Drop cached node listing, must be called after node create/delete"""
+    key = (castai_api_url, cluster_id)
+    with _inventories_lock:
+        _inventories.pop(key, None)
+        _inventory_generations[key] = _inventory_generations.get(key, 0) + 1
+
+
 def get_castai_node_name_by_id(cluster_id, castai_api_url, castai_api_token, node_id):
-    """ Get node by CAST AI id from CAST AI API"""
-    url = f"{castai_api_url}/v1/kubernetes/external-clusters/{cluster_id}/nodes/{node_id}"
-    header_dict = {"accept": "application/json",
-                   "X-API-Key": castai_api_token}
+    """ Get node by CAST AI id from node inventory or CAST AI API"""
+    node = get_node_inventory(cluster_id, castai_api_url, castai_api_token).by_id.get(node_id)
+    if node and node.get("name"):
+        return node["name"]
+
+    path = f"/v1/kubernetes/external-clusters/{cluster_id}/nodes/{node_id}"
 
-    resp = requests.get(url, headers=header_dict)
+    resp = get_castai_client(castai_api_url, castai_api_token).get(path)
     resp.raise_for_status()
     # Handle 204 No Content or empty responses
     if not resp.content:
@@ -231,32 +710,29 @@ def get_castai_node_name_by_id(cluster_id, castai_api_url, castai_api_token, nod
 
 @basic_retry(attempts=3, pause=30)
 def delete_castai_node(cluster_id, castai_api_url, castai_api_token, node_id):
-    """ Delete single node"""
-    url = f"{castai_api_url}/v1/kubernetes/external-clusters/{cluster_id}/nodes/{node_id}"
-    header_dict = {"accept": "application/json",
-                   "X-API-Key": castai_api_token}
+    """ Delete single node, returns deletion operation id when CAST AI provides one"""
+    path = f"/v1/kubernetes/external-clusters/{cluster_id}/nodes/{node_id}"
     paramsDelete = {
         "forceDelete": True,
         "drainTimeout": 60
     }
 
-    resp = requests.delete(url, headers=header_dict, params=paramsDelete)
+    resp = get_castai_client(castai_api_url, castai_api_token).delete(path, params=paramsDelete)
     resp.raise_for_status()
+    invalidate_node_inventory(cluster_id, castai_api_url)
     # DELETE may return 204 No Content with empty body
     if resp.content:
         delete_node_result = resp.json()
         logging.info(delete_node_result)
-    else:
-        logging.info(f"Node {node_id} deleted successfully (204 No Content)")
-    return True
+        return delete_node_result.get("operationId")
+    logging.info(f"Node {node_id} deleted successfully (204 No Content)")
+    return None
 
 
 def get_cluster_details(cluster_id, castai_api_url, castai_api_token):
-    url = f"{castai_api_url}/v1/kubernetes/external-clusters/{cluster_id}"
-    header_dict = {"accept": "application/json",
-                   "X-API-Key": castai_api_token}
+    path = f"/v1/kubernetes/external-clusters/{cluster_id}"
 
-    resp = requests.get(url, headers=header_dict)
+    resp = get_castai_client(castai_api_url, castai_api_token).get(path)
     resp.raise_for_status()
     if not resp.content:
         return {}
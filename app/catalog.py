@@ -0,0 +1,82 @@
+import json
+import logging
+import time
+
+from kubernetes.client.rest import ApiException
+
+CATALOG_KEY = "instance_catalog"
+# a type running in the cluster is offered in its region, a failed one is skipped until the failure expires
+OBSERVED_TTL = 7 * 24 * 3600
+FAILED_TTL = 6 * 3600
+
+# hibernation node candidates per cloud, cheapest general purpose first
+HIBERNATION_INSTANCE_TYPES = {
+    "GKE": ["e2-standard-2", "n2-standard-2", "n2d-standard-2", "n1-standard-2", "e2-standard-4"],
+    "EKS": ["m5a.large", "m5.large", "m6a.large", "m6i.large", "t3.large"],
+    "AKS": ["Standard_D2as_v5", "Standard_D2s_v5", "Standard_D2as_v4", "Standard_D2s_v3", "Standard_D4as_v5"],
+}
+
+
+class InstanceCatalog:
+    """ Instance types seen running in the cluster and types that recently failed to provision, unix times"""
+
+    def __init__(self, observed: dict = None, failed: dict = None):
+        self.observed = observed or {}
+        self.failed = failed or {}
+
+    @classmethod
+    def from_json(cls, value: str) -> "InstanceCatalog":
+        data = json.loads(value or "{}")
+        return cls(data.get("observed"), data.get("failed"))
+
+    def to_json(self) -> str:
+        return json.dumps({"observed": self.observed, "failed": self.failed}, separators=(",", ":"), sort_keys=True)
+
+    def expire(self, now: float = None):
+        now = time.time() if now is None else now
+        self.observed = {name: seen for name, seen in self.observed.items() if now - seen < OBSERVED_TTL}
+        self.failed = {name: failure for name, failure in self.failed.items() if now - failure["at"] < FAILED_TTL}
+
+    def observe(self, nodes: list, now: float = None):
+        """ record instance types of ready CAST AI nodes, a successful creation clears an earlier failure"""
+        now = time.time() if now is None else now
+        for node in nodes:
+            if node.get("instanceType") and node.get("state", {}).get("phase") == "ready":
+                self.observed[node["instanceType"]] = now
+                self.failed.pop(node["instanceType"], None)
+
+    def mark_failed(self, instance_type: str, error, now: float = None):
+        self.failed[instance_type] = {"at": time.time() if now is None else now, "error": str(error)[:200]}
+
+    def ranked(self, cloud: str, override: str = None, now: float = None) -> list:
+        """ hibernation node types to try in order: the override, then types known to run in this cluster,
+        then the remaining defaults, recently failed types left out unless nothing else is left"""
+        self.expire(now)
+        defaults = [name for name in HIBERNATION_INSTANCE_TYPES.get(cloud, []) if name != override]
+        candidates = sorted(defaults, key=lambda name: name not in self.observed)
+        if override:
+            candidates.insert(0, override)
+        usable = [name for name in candidates if name not in self.failed]
+        if len(usable) < len(candidates):
+            logging.info("Skipping recently failed instance types: %s",
+                         ", ".join(f"{name} ({self.failed[name]['error']})" for name in candidates
+                                   if name in self.failed))
+        return usable or candidates
+
+
+def read_catalog(client, cm: str, ns: str) -> InstanceCatalog:
+    """ catalog stored in the state ConfigMap, empty when missing or unreadable"""
+    try:
+        config_map = client.read_namespaced_config_map(name=cm, namespace=ns)
+        return InstanceCatalog.from_json((config_map.data or {}).get(CATALOG_KEY))
+    except (ApiException, ValueError) as e:
+        logging.warning(f"could not read instance catalog, starting empty: {e}")
+        return InstanceCatalog()
+
+
+def save_catalog(client, cm: str, ns: str, catalog: InstanceCatalog):
+    """ best effort, a lost update only costs one doomed creation attempt on the next pause"""
+    try:
+        client.patch_namespaced_config_map(name=cm, namespace=ns, body={"data": {CATALOG_KEY: catalog.to_json()}})
+    except ApiException as e:
+        logging.warning(f"could not save instance catalog: {e}")
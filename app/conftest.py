@@ -0,0 +1,13 @@
+import pytest
+
+from utils import RATE_LIMITS, set_rate_limit
+
+
+@pytest.fixture(scope="session", autouse=True)
+def unlimited_rate():
+    """ the fake APIs answer at once, the production rate limits would only slow the tests down"""
+    for endpoint_class in RATE_LIMITS:
+        set_rate_limit(endpoint_class, 10000, 10000)
+    yield
+    for endpoint_class, (rate, burst) in RATE_LIMITS.items():
+        set_rate_limit(endpoint_class, rate, burst)
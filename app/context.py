@@ -0,0 +1,108 @@
+import logging
+import os
+from dataclasses import dataclass
+from functools import cached_property
+
+
+@dataclass
+class AppContext:
+    """ Settings and API clients for one hibernate run, Kubernetes clients are built on first use"""
+    cluster_id: str
+    castai_api_token: str
+    castai_api_url: str = "https://api.cast.ai"
+    action: str = None
+    hibernate_node_type_override: str = None
+    hibernate_node_labels: str = None
+    user_namespaces_to_keep: str = None
+    protect_removal_disabled: str = None
+    my_node_name: str = None
+    delete_concurrency: int = 10
+    cordon_concurrency: int = 10
+    patch_concurrency: int = 10
+    workload_ready_timeout: int = 300
+    run_lock_wait: int = 1800
+    run_lock_identity: str = None
+    engine: str = "sync"
+    resume_preprovision: bool = True
+    provision_concurrency: int = 10
+    schedule_timezone: str = "Etc/UTC"
+    kube_context: str = None
+    cloud: str = None
+    local_development: bool = False
+
+    @classmethod
+    def from_env(cls, environ=os.environ) -> "AppContext":
+        local_development = bool(environ.get("LOCAL_DEVELOPMENT"))
+        if local_development:
+            # Run hibernate from local IDE
+            from dotenv import load_dotenv
+            from pathlib import Path
+            logging.info(f"local dev: {local_development}")
+            load_dotenv(dotenv_path=Path('../.env'))
+
+        return cls(
+            cluster_id=environ["CLUSTER_ID"],
+            castai_api_token=environ["API_KEY"],
+            castai_api_url=environ.get("API_URL", "https://api.cast.ai"),
+            action=environ["ACTION"],
+            hibernate_node_type_override=environ.get("HIBERNATE_NODE"),
+            hibernate_node_labels=environ.get("HIBERNATE_NODE_LABELS"),
+            user_namespaces_to_keep=environ.get("NAMESPACES_TO_KEEP"),
+            protect_removal_disabled=environ.get("PROTECT_REMOVAL_DISABLED"),
+            my_node_name=environ.get("MY_NODE_NAME"),
+            delete_concurrency=int(environ.get("DELETE_CONCURRENCY", "10")),
+            cordon_concurrency=int(environ.get("CORDON_CONCURRENCY", "10")),
+            patch_concurrency=int(environ.get("PATCH_CONCURRENCY", "10")),
+            workload_ready_timeout=int(environ.get("WORKLOAD_READY_TIMEOUT", "300")),
+            run_lock_wait=int(environ.get("RUN_LOCK_WAIT", "1800")),
+            run_lock_identity=environ.get("RUN_LOCK_IDENTITY"),
+            engine=environ.get("ENGINE", "sync"),
+            resume_preprovision=environ.get("RESUME_PREPROVISION", "true").lower() != "false",
+            provision_concurrency=int(environ.get("PROVISION_CONCURRENCY", "10")),
+            schedule_timezone=environ.get("SCHEDULE_TIMEZONE", "Etc/UTC"),
+            kube_context=environ.get("KUBE_CONTEXT"),
+            local_development=local_development,
+        )
+
+    @cached_property
+    def k8s_api_client(self):
+        from kubernetes import client, config
+        from k8s_utils import RateLimitedApiClient
+        configuration = client.Configuration()
+        if self.local_development or self.kube_context:
+            config.load_kube_config(context=self.kube_context, client_configuration=configuration)
+        else:
+            # Run hibernate from container inside k8s
+            config.load_incluster_config(client_configuration=configuration)
+        return RateLimitedApiClient(configuration)
+
+    @cached_property
+    def k8s_v1(self):
+        from kubernetes import client
+        return client.CoreV1Api(self.k8s_api_client)
+
+    @cached_property
+    def k8s_v1_apps(self):
+        from kubernetes import client
+        return client.AppsV1Api(self.k8s_api_client)
+
+    @cached_property
+    def k8s_coordination(self):
+        from kubernetes import client
+        return client.CoordinationV1Api(self.k8s_api_client)
+
+    @cached_property
+    def node_informer(self):
+        from k8s_utils import NodeInformer
+        return NodeInformer(self.k8s_v1)
+
+
+_context = None
+
+
+def get_context() -> AppContext:
+    """ Process wide context, read from environment on first call"""
+    global _context
+    if _context is None:
+        _context = AppContext.from_env()
+    return _context
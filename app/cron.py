@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+MONTH_NAMES = {name: number for number, name in
+               enumerate(["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], 1)}
+DAY_NAMES = {name: number for number, name in enumerate(["sun", "mon", "tue", "wed", "thu", "fri", "sat"])}
+
+MACROS = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+
+
+class CronError(ValueError):
+    pass
+
+
+def _parse_value(value: str, names: dict) -> int:
+    value = value.lower()
+    if value in names:
+        return names[value]
+    if not value.isdigit():
+        raise CronError(f"invalid cron value: {value}")
+    return int(value)
+
+
+def _parse_field(field: str, low: int, high: int, names: dict = None) -> set:
+    """ expand one cron field (*, 1-5, */15, mon-fri, 1,2,3) into the set of allowed values"""
+    names = names or {}
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_value = part.split("/", 1)
+            if not step_value.isdigit() or int(step_value) == 0:
+                raise CronError(f"invalid cron step: {step_value}")
+            step = int(step_value)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (_parse_value(value, names) for value in part.split("-", 1))
+        else:
+            start = _parse_value(part, names)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise CronError(f"cron field {field} out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """ Standard 5 field cron expression evaluated in a time zone, same semantics as CronJob schedule"""
+
+    def __init__(self, expression: str, timezone: str = "Etc/UTC"):
+        self.expression = expression
+        self.timezone = ZoneInfo(timezone)
+        fields = MACROS.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise CronError(f"cron expression needs 5 fields: {expression}")
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12, MONTH_NAMES)
+        # 7 is an alias for sunday
+        self.weekdays = {day % 7 for day in _parse_field(fields[4], 0, 7, DAY_NAMES)}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_match = moment.day in self.days
+        weekday_match = (moment.weekday() + 1) % 7 in self.weekdays
+        # like cron, when both day fields are restricted either of them may match
+        if self.any_day or self.any_weekday:
+            return day_match and weekday_match
+        return day_match or weekday_match
+
+    def next_after(self, after: datetime) -> datetime:
+        """ first matching time strictly after the given aware datetime"""
+        moment = after.astimezone(self.timezone).replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=5 * 366)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.replace(tzinfo=self.timezone)
+        raise CronError(f"cron expression never matches: {self.expression}")
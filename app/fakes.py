@@ -0,0 +1,559 @@
+"""In-process fakes of the CAST AI and Kubernetes APIs, enough of both for pause and resume to run end to end.
+
+Both are plain HTTP servers on local ports, so hibernate talks to them through its real clients. Used by
+`bench.py scale`, no cloud cluster or API key needed:
+
+    cluster = FakeCluster(nodes=100, latency=0.005)
+    cluster.start()
+    ctx = cluster.context()
+    ...
+    cluster.stop()
+
+Only pods created on the hibernation node are modelled, workloads on other nodes are not needed by hibernate.
+"""
+import copy
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from context import AppContext
+
+PAUSE_TAINT = "scheduling.cast.ai/paused-cluster"
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _match_labels(labels: dict, selector: str) -> bool:
+    """ equality based label selector: a=b,c=d,e"""
+    for requirement in filter(None, (part.strip() for part in (selector or "").split(","))):
+        key, _, value = requirement.partition("=")
+        if key not in labels or (value and labels[key] != value.lstrip("=")):
+            return False
+    return True
+
+
+def _merge_patch(target: dict, patch: dict):
+    """ merge patch, lists are replaced and None removes the key"""
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_patch(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def _json_patch(target: dict, operations: list):
+    """ RFC 6902 add, remove, replace and test"""
+    for operation in operations:
+        *parents, last = [part.replace("~1", "/").replace("~0", "~") for part in operation["path"].split("/")[1:]]
+        container = target
+        for part in parents:
+            container = container[int(part)] if isinstance(container, list) else container[part]
+        op = operation["op"]
+        if op == "test":
+            current = container[int(last)] if isinstance(container, list) else container.get(last)
+            if current != operation["value"]:
+                raise ValueError(f"test failed for {operation['path']}")
+        elif op == "remove":
+            if isinstance(container, list):
+                del container[int(last)]
+            else:
+                del container[last]
+        elif isinstance(container, list):
+            if last == "-":
+                container.append(copy.deepcopy(operation["value"]))
+            elif op == "add":
+                container.insert(int(last), copy.deepcopy(operation["value"]))
+            else:
+                container[int(last)] = copy.deepcopy(operation["value"])
+        else:
+            container[last] = copy.deepcopy(operation["value"])
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status: int, message: str, headers: dict = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class FakeCluster:
+    """ Shared state behind the fake CAST AI and Kubernetes APIs.
+
+    latency is added to every API response, operation_latency is how long node create/delete operations take and
+    pod_start_latency how long a restarted Deployment needs for a Ready pod on the hibernation node. Creating a node
+    of one of unavailable_instance_types is rejected like a type not offered in the region. fail() injects error
+    responses.
+    """
+
+    def __init__(self, nodes: int = 10, deployments: int = None, latency: float = 0.0, operation_latency: float = 0.5,
+                 pod_start_latency: float = 0.2, provider: str = "EKS", instance_type: str = "m5.xlarge",
+                 unavailable_instance_types=()):
+        self.cluster_id = str(uuid.uuid4())
+        self.latency = latency
+        self.operation_latency = operation_latency
+        self.pod_start_latency = pod_start_latency
+        self.provider = provider
+        self.unavailable_instance_types = set(unavailable_instance_types)
+        self.calls = Counter()
+        self.policies = {"enabled": True, "unschedulablePods": {"enabled": True}}
+        self._condition = threading.Condition()
+        self._resource_version = itertools.count(1)
+        self._closed = False
+        self._servers = []
+        self.castai_nodes = {}
+        self.nodes = {}
+        self.deployments = {}
+        self.pods = {}
+        self.config_maps = {}
+        self.leases = {}
+        self.operations = {}
+        self.events = {"nodes": [], "pods": []}
+        self._timers = []
+        self._faults = []
+
+        with self._condition:
+            for index in range(nodes):
+                self._add_node(f"ip-10-0-{index // 250}-{index % 250}", instance_type, {}, [], ready=True)
+            for name, priority_class in (("coredns", "system-cluster-critical"), ("metrics-server", "system-cluster-critical"),
+                                         ("kube-proxy-autoscaler", "system-node-critical")):
+                self._add_deployment("kube-system", name, priority_class)
+            self._add_deployment("castai-pod-node-lifecycle", "castai-pod-node-lifecycle", None)
+            for index in range(deployments if deployments is not None else nodes * 3):
+                self._add_deployment(f"team-{index % 50}", f"app-{index}", None)
+            self.config_maps[("castai-agent", "castai-hibernate-state")] = self._object(
+                {"metadata": {"name": "castai-hibernate-state", "namespace": "castai-agent"},
+                 "data": {"last_run_status": "success", "last_run_time": "2022-01-01T00:00:00"}})
+
+    # state changes, all called with the condition held
+
+    def _object(self, obj: dict) -> dict:
+        obj["metadata"]["resourceVersion"] = str(next(self._resource_version))
+        obj["metadata"].setdefault("uid", str(uuid.uuid4()))
+        obj["metadata"].setdefault("creationTimestamp", _now())
+        return obj
+
+    def _event(self, kind: str, event_type: str, obj: dict):
+        self.events[kind].append((int(obj["metadata"]["resourceVersion"]), event_type, copy.deepcopy(obj)))
+        self._condition.notify_all()
+
+    def _add_node(self, name: str, instance_type: str, labels: dict, taints: list, ready: bool) -> str:
+        node_id = str(uuid.uuid4())
+        zone = f"eu-central-1{'abc'[len(self.castai_nodes) % 3]}"
+        labels = dict(labels, **{"kubernetes.io/hostname": name, "provisioner.cast.ai/node-id": node_id,
+                                 "topology.kubernetes.io/zone": zone, "node.kubernetes.io/instance-type": instance_type})
+        self.castai_nodes[node_id] = {"id": node_id, "name": name, "instanceType": instance_type, "labels": labels,
+                                      "state": {"phase": "ready" if ready else "pending"}, "createdAt": _now()}
+        if ready:
+            self._register_node(node_id, taints)
+        return node_id
+
+    def _register_node(self, node_id: str, taints: list):
+        castai_node = self.castai_nodes[node_id]
+        castai_node["state"]["phase"] = "ready"
+        node = self._object({
+            "metadata": {"name": castai_node["name"], "labels": dict(castai_node["labels"])},
+            "spec": {"taints": [dict(taint) for taint in taints]} if taints else {},
+            "status": {"conditions": [{"type": "Ready", "status": "True", "lastTransitionTime": _now()}]},
+        })
+        self.nodes[castai_node["name"]] = node
+        self._event("nodes", "ADDED", node)
+
+    def _remove_node(self, node_id: str):
+        castai_node = self.castai_nodes.pop(node_id, None)
+        node = self.nodes.pop(castai_node["name"], None) if castai_node else None
+        if node is not None:
+            self._object(node)
+            self._event("nodes", "DELETED", node)
+
+    def _add_deployment(self, namespace: str, name: str, priority_class: str):
+        pod_spec = {"containers": [{"name": name, "image": f"registry.local/{name}:1"}]}
+        if priority_class:
+            pod_spec["priorityClassName"] = priority_class
+        self.deployments[(namespace, name)] = self._object({
+            "metadata": {"name": name, "namespace": namespace},
+            "spec": {"replicas": 1, "selector": {"matchLabels": {"app": name}},
+                     "template": {"metadata": {"labels": {"app": name}}, "spec": pod_spec}},
+        })
+
+    def _rollout(self, deployment: dict):
+        """ a restarted Deployment that tolerates the pause taint gets a Ready pod on the hibernation node"""
+        tolerations = deployment["spec"]["template"]["spec"].get("tolerations") or []
+        tolerated = {toleration.get("key") for toleration in tolerations}
+        for node in self.nodes.values():
+            taints = {taint["key"] for taint in node["spec"].get("taints") or []}
+            if PAUSE_TAINT in taints and taints <= tolerated | {PAUSE_TAINT} and PAUSE_TAINT in tolerated:
+                self._after(self.pod_start_latency, self._start_pod, deployment, node["metadata"]["name"])
+                return
+
+    def _start_pod(self, deployment: dict, node_name: str):
+        metadata = deployment["metadata"]
+        pod = self._object({
+            "metadata": {"name": f"{metadata['name']}-{uuid.uuid4().hex[:5]}", "namespace": metadata["namespace"],
+                         "labels": dict(deployment["spec"]["template"]["metadata"]["labels"])},
+            "spec": {"nodeName": node_name, "containers": deployment["spec"]["template"]["spec"]["containers"]},
+            "status": {"phase": "Running", "conditions": [{"type": "Ready", "status": "True"}]},
+        })
+        self.pods[pod["metadata"]["uid"]] = pod
+        self._event("pods", "ADDED", pod)
+
+    def _after(self, delay: float, action, *args):
+        self._timers.append((time.monotonic() + delay, action, args))
+        self._condition.notify_all()
+
+    def _run_timers(self):
+        with self._condition:
+            while not self._closed:
+                now = time.monotonic()
+                due = [timer for timer in self._timers if timer[0] <= now]
+                self._timers = [timer for timer in self._timers if timer[0] > now]
+                for _, action, args in due:
+                    action(*args)
+                next_due = min((timer[0] for timer in self._timers), default=now + 1)
+                self._condition.wait(max(0.001, next_due - now))
+
+    def _operation(self, on_done, *args) -> str:
+        operation_id = str(uuid.uuid4())
+        self.operations[operation_id] = {"id": operation_id, "done": False}
+
+        def finish():
+            on_done(*args)
+            self.operations[operation_id]["done"] = True
+        self._after(self.operation_latency, finish)
+        return operation_id
+
+    # lifecycle
+
+    def start(self):
+        threading.Thread(target=self._run_timers, name="fake-cluster", daemon=True).start()
+        self.castai_url = self._serve(_CastAIHandler)
+        self.k8s_url = self._serve(_KubernetesHandler)
+        return self
+
+    def _serve(self, handler) -> str:
+        server = _FakeServer(("127.0.0.1", 0), handler, self)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self._servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def stop(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+    def fail(self, api: str, method: str, path: str, times: int = 1, status: int = 503):
+        """ answer the next times requests of api ("castai" or "kubernetes") whose path matches the path regex with
+        status, with Retry-After: 0 so clients retry without waiting"""
+        with self._condition:
+            self._faults.append({"api": api, "method": method, "path": re.compile(path), "times": times,
+                                 "status": status})
+
+    def injected_fault(self, api: str, method: str, path: str):
+        with self._condition:
+            for fault in self._faults:
+                if fault["times"] and fault["api"] == api and fault["method"] == method and \
+                        fault["path"].fullmatch(path):
+                    fault["times"] -= 1
+                    self.calls[f"{api} {method} injected {fault['status']}"] += 1
+                    raise FakeAPIError(fault["status"], "injected failure", {"Retry-After": "0"})
+
+    def context(self, **overrides) -> AppContext:
+        """ AppContext for this cluster, Kubernetes clients point to the fake API server"""
+        from kubernetes import client
+        from k8s_utils import RateLimitedApiClient
+        ctx = AppContext(cluster_id=self.cluster_id, castai_api_token="fake", castai_api_url=self.castai_url,
+                         action="pause", **overrides)
+        configuration = client.Configuration()
+        configuration.host = self.k8s_url
+        ctx.k8s_api_client = RateLimitedApiClient(configuration)
+        return ctx
+
+    # CAST AI API
+
+    def castai(self, method: str, path: str, query: dict, body):
+        parts = path.strip("/").split("/")
+        with self._condition:
+            if path.startswith("/v1/kubernetes/external-clusters/operations/"):
+                self.calls["castai GET operation"] += 1
+                if parts[-1] not in self.operations:
+                    raise FakeAPIError(404, "operation not found")
+                return self.operations[parts[-1]]
+            if path.endswith("/policies"):
+                self.calls[f"castai {method} policies"] += 1
+                if method == "PUT":
+                    self.policies = body
+                return self.policies
+            if len(parts) == 4:
+                self.calls["castai GET cluster"] += 1
+                return {"id": self.cluster_id, "providerType": self.provider.lower(), "status": "ready"}
+            if len(parts) == 5 and method == "GET":
+                self.calls["castai GET nodes"] += 1
+                return {"items": list(self.castai_nodes.values())}
+            if len(parts) == 5 and method == "POST":
+                self.calls["castai POST node"] += 1
+                if body["instanceType"] in self.unavailable_instance_types:
+                    raise FakeAPIError(400, f"instance type {body['instanceType']} is not available in the region")
+                name = f"ip-10-1-{len(self.castai_nodes) // 250}-{uuid.uuid4().hex[:6]}"
+                node_id = self._add_node(name, body["instanceType"], body.get("kubernetesLabels") or {}, [],
+                                         ready=False)
+                taints = body.get("kubernetesTaints") or []
+                return {"nodeId": node_id, "operationId": self._operation(self._register_node, node_id, taints)}
+            node_id = parts[5]
+            if node_id not in self.castai_nodes:
+                raise FakeAPIError(404, "node not found")
+            if method == "DELETE":
+                self.calls["castai DELETE node"] += 1
+                self.castai_nodes[node_id]["state"]["phase"] = "draining"
+                return {"operationId": self._operation(self._remove_node, node_id)}
+            self.calls["castai GET node"] += 1
+            return self.castai_nodes[node_id]
+
+    # Kubernetes API
+
+    def kubernetes(self, method: str, path: str, query: dict, body, content_type: str):
+        match = re.fullmatch(r"/api/v1/nodes(?:/([^/]+))?", path)
+        if match:
+            return self._nodes_api(method, match.group(1), query, body, content_type)
+        match = re.fullmatch(r"/api/v1/pods", path)
+        if match:
+            self.calls[f"k8s {method} pods"] += 1
+            return self._list("PodList", "pods", self.pods.values(), query)
+        match = re.fullmatch(r"/apis/apps/v1/deployments", path)
+        if match:
+            self.calls["k8s GET deployments"] += 1
+            return self._list("DeploymentList", None, self.deployments.values(), query)
+        match = re.fullmatch(r"/apis/apps/v1/namespaces/([^/]+)/deployments/([^/]+)", path)
+        if match:
+            self.calls[f"k8s {method} deployment"] += 1
+            with self._condition:
+                deployment = self.deployments.get(match.groups())
+                if deployment is None:
+                    raise FakeAPIError(404, "deployment not found")
+                if method == "PATCH":
+                    self._patch(deployment, body, content_type)
+                    self._object(deployment)
+                    self._rollout(deployment)
+                return deployment
+        match = re.fullmatch(r"/api/v1/namespaces/([^/]+)/configmaps(?:/([^/]+))?", path)
+        if match:
+            return self._config_maps_api(method, match.group(1), match.group(2), body, content_type)
+        match = re.fullmatch(r"/apis/coordination.k8s.io/v1/namespaces/([^/]+)/leases(?:/([^/]+))?", path)
+        if match:
+            return self._leases_api(method, match.group(1), match.group(2), body)
+        raise FakeAPIError(404, f"no fake for {method} {path}")
+
+    def _patch(self, obj: dict, body, content_type: str):
+        try:
+            if "json-patch" in content_type:
+                _json_patch(obj, body)
+            else:
+                _merge_patch(obj, body)
+        except (KeyError, IndexError, ValueError) as e:
+            raise FakeAPIError(422, f"patch failed: {e}")
+
+    def _nodes_api(self, method: str, name: str, query: dict, body, content_type: str):
+        if name is None:
+            self.calls["k8s GET nodes"] += 1
+            return self._list("NodeList", "nodes", self.nodes.values(), query)
+        self.calls[f"k8s {method} node"] += 1
+        with self._condition:
+            node = self.nodes.get(name)
+            if node is None:
+                raise FakeAPIError(404, f'nodes "{name}" not found')
+            if method == "PATCH":
+                self._patch(node, body, content_type)
+                self._object(node)
+                self._event("nodes", "MODIFIED", node)
+            return node
+
+    def _config_maps_api(self, method: str, namespace: str, name: str, body, content_type: str):
+        self.calls[f"k8s {method} configmap"] += 1
+        with self._condition:
+            if method == "POST":
+                name = body["metadata"]["name"]
+                if (namespace, name) in self.config_maps:
+                    raise FakeAPIError(409, f'configmaps "{name}" already exists')
+                body["metadata"]["namespace"] = namespace
+                self.config_maps[(namespace, name)] = self._object(body)
+                return body
+            config_map = self.config_maps.get((namespace, name))
+            if config_map is None:
+                raise FakeAPIError(404, f'configmaps "{name}" not found')
+            if method == "PUT":
+                body["metadata"]["namespace"] = namespace
+                self.config_maps[(namespace, name)] = config_map = self._object(body)
+            elif method == "PATCH":
+                self._patch(config_map, body, content_type)
+                self._object(config_map)
+            elif method == "DELETE":
+                del self.config_maps[(namespace, name)]
+                return {"kind": "Status", "status": "Success"}
+            return config_map
+
+    def _leases_api(self, method: str, namespace: str, name: str, body):
+        """ create, read and replace with optimistic concurrency on resourceVersion"""
+        self.calls[f"k8s {method} lease"] += 1
+        with self._condition:
+            name = name or body["metadata"]["name"]
+            current = self.leases.get((namespace, name))
+            if method == "GET":
+                if current is None:
+                    raise FakeAPIError(404, f'leases "{name}" not found')
+                return current
+            if method == "POST" and current is not None:
+                raise FakeAPIError(409, f'leases "{name}" already exists')
+            if method == "PUT":
+                if current is None:
+                    raise FakeAPIError(404, f'leases "{name}" not found')
+                if body["metadata"].get("resourceVersion") != current["metadata"]["resourceVersion"]:
+                    raise FakeAPIError(409, f'leases "{name}" was modified, resourceVersion does not match')
+            body["metadata"]["namespace"] = namespace
+            self.leases[(namespace, name)] = self._object(body)
+            return body
+
+    def _selected(self, objects, query: dict) -> list:
+        label_selector = query.get("labelSelector")
+        field_selector = query.get("fieldSelector")
+        selected = []
+        for obj in objects:
+            if label_selector and not _match_labels(obj["metadata"].get("labels") or {}, label_selector):
+                continue
+            if field_selector:
+                field, _, value = field_selector.partition("=")
+                if field == "spec.nodeName" and obj["spec"].get("nodeName") != value:
+                    continue
+            selected.append(obj)
+        return selected
+
+    def _list(self, kind: str, events: str, objects, query: dict):
+        if str(query.get("watch")).lower() in ("true", "1"):
+            return _Watch(self, events, query)
+        with self._condition:
+            items = sorted(self._selected(objects, query),
+                           key=lambda obj: (obj["metadata"].get("namespace", ""), obj["metadata"]["name"]))
+            start = int(query.get("continue") or 0)
+            limit = int(query.get("limit") or 0) or len(items)
+            metadata = {"resourceVersion": str(next(self._resource_version))}
+            if start + limit < len(items):
+                metadata["continue"] = str(start + limit)
+            return {"kind": kind, "apiVersion": "v1", "metadata": metadata,
+                    "items": copy.deepcopy(items[start:start + limit])}
+
+    def watch_events(self, events: str, query: dict, resource_version: int, deadline: float):
+        """ yield (resource version, type, object) after resource_version until deadline or stop()"""
+        with self._condition:
+            position = 0
+            while True:
+                log = self.events[events]
+                while position < len(log):
+                    event = log[position]
+                    position += 1
+                    if event[0] > resource_version and self._selected([event[2]], query):
+                        self._condition.release()
+                        try:
+                            yield event
+                        finally:
+                            self._condition.acquire()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._closed:
+                    return
+                self._condition.wait(remaining)
+
+
+class _Watch:
+    def __init__(self, cluster: FakeCluster, events: str, query: dict):
+        self.cluster = cluster
+        self.events = events
+        self.query = query
+
+    def stream(self):
+        resource_version = int(self.query.get("resourceVersion") or 0)
+        deadline = time.monotonic() + float(self.query.get("timeoutSeconds") or 60)
+        for _, event_type, obj in self.cluster.watch_events(self.events, self.query, resource_version, deadline):
+            yield json.dumps({"type": event_type, "object": obj}).encode() + b"\n"
+
+
+class _FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, cluster: FakeCluster):
+        super().__init__(address, handler)
+        self.cluster = cluster
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        cluster = self.server.cluster
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        if cluster.latency:
+            time.sleep(cluster.latency)
+        try:
+            cluster.injected_fault(self.api, self.command, url.path)
+            result = self.dispatch(self.command, url.path, query, body)
+        except FakeAPIError as e:
+            return self._send(e.status, {"kind": "Status", "status": "Failure", "message": str(e), "code": e.status},
+                              e.headers)
+        if isinstance(result, _Watch):
+            return self._stream(result)
+        self._send(200, result)
+
+    def _send(self, status: int, payload, headers: dict = None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, watch: _Watch):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for line in watch.stream():
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _CastAIHandler(_FakeHandler):
+    api = "castai"
+
+    def dispatch(self, method, path, query, body):
+        return self.server.cluster.castai(method, path, query, body)
+
+
+class _KubernetesHandler(_FakeHandler):
+    api = "kubernetes"
+
+    def dispatch(self, method, path, query, body):
+        return self.server.cluster.kubernetes(method, path, query, body, self.headers.get("Content-Type", ""))
@@ -0,0 +1,92 @@
+"""Hibernate many clusters from one process.
+
+CLUSTERS_FILE points to a JSON list with one object per cluster, every AppContext field can be set per cluster:
+
+    [{"cluster_id": "...", "api_key_env": "API_KEY_PROD", "kube_context": "prod"},
+     {"cluster_id": "...", "api_key": "...", "kube_context": "staging", "cloud": "EKS"}]
+
+Settings missing in the file are read from the environment like for a single cluster, except kube_context: every
+cluster names its own, at most one entry leaves it out and uses the in-cluster config.
+"""
+import contextvars
+import dataclasses
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from context import AppContext
+
+cluster_tag = contextvars.ContextVar("cluster_tag", default="-")
+
+
+class ClusterTagFilter(logging.Filter):
+    """ adds the cluster being handled by the current thread or task as %(cluster)s"""
+
+    def filter(self, record):
+        record.cluster = cluster_tag.get()
+        return True
+
+
+class FleetError(Exception):
+    def __init__(self, message, summary):
+        super().__init__(message)
+        self.summary = summary
+
+
+def load_fleet(path: str, action: str, environ=os.environ) -> list:
+    """ one AppContext per cluster of the clusters file"""
+    with open(path) as f:
+        entries = json.load(f)
+    fields = {field.name for field in dataclasses.fields(AppContext)}
+    contexts = []
+    kube_contexts = {}
+    for entry in entries:
+        entry = dict(entry)
+        if "api_key_env" in entry:
+            entry["castai_api_token"] = environ[entry.pop("api_key_env")]
+        elif "api_key" in entry:
+            entry["castai_api_token"] = entry.pop("api_key")
+        unknown = set(entry) - fields
+        if unknown:
+            raise ValueError(f"unknown settings for cluster {entry.get('cluster_id')}: {', '.join(sorted(unknown))}")
+        # two clusters on one Kubernetes API would cordon, taint and patch the same nodes
+        entry.setdefault("kube_context", None)
+        if entry["kube_context"] in kube_contexts:
+            target = f"kube context {entry['kube_context']}" if entry["kube_context"] else "the in-cluster config"
+            raise ValueError(f"clusters {kube_contexts[entry['kube_context']]} and {entry['cluster_id']} both use "
+                             f"{target}, every cluster needs its own kube_context")
+        kube_contexts[entry["kube_context"]] = entry["cluster_id"]
+        cluster_environ = dict(environ, CLUSTER_ID=entry["cluster_id"], API_KEY=entry.get("castai_api_token", ""),
+                               ACTION=action)
+        contexts.append(dataclasses.replace(AppContext.from_env(cluster_environ), **entry))
+    return contexts
+
+
+def run_fleet(contexts: list, action: str, run_cluster, max_workers: int = 4):
+    """ run_cluster(ctx, action) for every cluster, at most max_workers at a time, failures are isolated per cluster"""
+    summary = {"succeeded": [], "failed": {}}
+
+    def run(ctx):
+        cluster_tag.set(ctx.cluster_id)
+        logging.info("Starting %s", action)
+        return run_cluster(ctx, action)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="fleet") as executor:
+        futures = {executor.submit(contextvars.copy_context().run, run, ctx): ctx.cluster_id for ctx in contexts}
+        for future, cluster_id in futures.items():
+            try:
+                if future.result() is False:
+                    summary["failed"][cluster_id] = f"{action} failed and was rolled back"
+                else:
+                    summary["succeeded"].append(cluster_id)
+            except Exception as err:
+                summary["failed"][cluster_id] = str(err)
+
+    logging.info("Fleet %s summary: succeeded %s, failed %s", action, len(summary["succeeded"]),
+                 len(summary["failed"]))
+    for cluster_id, err in summary["failed"].items():
+        logging.error("Cluster %s %s failed: %s", cluster_id, action, err)
+    if summary["failed"]:
+        raise FleetError(f'{action} failed for {len(summary["failed"])} clusters', summary)
+    return summary
@@ -1,9 +1,19 @@
+import functools
+import json
 import logging
 import os
+import random
+import socket
+import threading
+import time
 from datetime import datetime
-from utils import basic_retry, parse_labels
+from typing import NamedTuple
+import metrics
+from utils import (FanOutError, basic_retry, finish_summary, get_rate_limiter, parse_labels, run_concurrently,
+                   sort_outcomes, _is_retryable_error)
 from kubernetes.client.rest import ApiException
 from kubernetes import client as rawclient
+from kubernetes import watch
 
 
 class K8sAPIError(Exception):
@@ -12,149 +22,638 @@ class K8sAPIError(Exception):
 class TaintException(Exception):
     pass
 
+
+class RateLimitedApiClient(rawclient.ApiClient):
+    """ ApiClient that takes a token from the process wide k8s-read or k8s-write bucket before every call,
+    and counts requests by path template and status code, with bytes and latency for the call ledger"""
+    _calls = threading.local()
+
+    def call_api(self, resource_path, method, *args, **kwargs):
+        get_rate_limiter("k8s-read" if method in ("GET", "HEAD") else "k8s-write").acquire()
+        # request() only sees the URL with names filled in, keep the template for the metrics label
+        self._calls.resource_path = resource_path
+        return super().call_api(resource_path, method, *args, **kwargs)
+
+    def request(self, method, url, *args, **kwargs):
+        code, received = "error", 0
+        body = kwargs.get("body")
+        sent = len(json.dumps(body)) if body is not None else 0
+        started = time.monotonic()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            code = response.status
+            # streamed responses (lists read page by page, watches) are only counted when the length is known
+            received = len(response.data) if kwargs.get("_preload_content", True) else int(
+                response.headers.get("Content-Length") or 0)
+            return response
+        except ApiException as e:
+            code = e.status
+            raise
+        finally:
+            metrics.count_request("kubernetes", method, getattr(self._calls, "resource_path", "unknown"), code,
+                                  time.monotonic() - started, sent, received)
+
+
+class NodeRecord(NamedTuple):
+    """ Node fields hibernate needs, parsed straight from list JSON"""
+    name: str
+    labels: dict
+    unschedulable: bool
+
+
+class DeploymentRecord(NamedTuple):
+    """ Deployment fields hibernate needs, parsed straight from list JSON"""
+    namespace: str
+    name: str
+    priority_class_name: str
+    tolerations: list
+    replicas: int
+    match_labels: dict
+
+    @property
+    def key(self) -> str:
+        return f"{self.namespace}/{self.name}"
+
+
+def node_record(item: dict) -> NodeRecord:
+    return NodeRecord(name=item["metadata"]["name"],
+                      labels=item["metadata"].get("labels") or {},
+                      unschedulable=bool(item.get("spec", {}).get("unschedulable")))
+
+
+def deployment_record(item: dict) -> DeploymentRecord:
+    spec = item.get("spec", {})
+    pod_spec = spec.get("template", {}).get("spec", {})
+    return DeploymentRecord(namespace=item["metadata"]["namespace"],
+                            name=item["metadata"]["name"],
+                            priority_class_name=pod_spec.get("priorityClassName"),
+                            tolerations=pod_spec.get("tolerations"),
+                            replicas=spec.get("replicas", 1),
+                            match_labels=spec.get("selector", {}).get("matchLabels") or {})
+
+
+def iter_list(list_fn, record, limit: int = 500, **kwargs):
+    """ yield record(item) for every item of a paginated list call, JSON is parsed without OpenAPI models"""
+    _continue = None
+    while True:
+        resp = list_fn(limit=limit, _continue=_continue, _preload_content=False, **kwargs)
+        try:
+            page = json.loads(resp.data)
+        finally:
+            resp.release_conn()
+        for item in page.get("items") or []:
+            yield record(item)
+        _continue = page.get("metadata", {}).get("continue")
+        if not _continue:
+            return
+
+
+class CordonError(FanOutError, K8sAPIError):
+    """ nodes failed to cordon or uncordon, errors by node name"""
+
+
 @basic_retry(attempts=3, pause=10)
-def cordon_all_nodes(client, protect_removal_disabled: str, exclude_node_id: str):
+def cordon_node(client, node_name: str):
+    """ mark single node unschedulable"""
+    logging.info("Cordoning: %s" % node_name)
+    client.patch_node(node_name, {"spec": {"unschedulable": True}})
+
+
+@basic_retry(attempts=3, pause=10)
+def cordon_all_nodes(client, protect_removal_disabled: str, exclude_node_id: str, max_workers: int = 10):
     """cordon all the nodes so essential components could be scheduled only on hybernation node"""
     logging.info("Cordon function")
 
-    node_body = {
-        "spec": {
-            "unschedulable": True
-        }
-    }
+    summary = {"cordoned": [], "skipped": [], "failed": {}}
+    to_cordon = select_nodes_to_cordon(client, protect_removal_disabled, exclude_node_id, summary)
+
+    # every node is patched and retried on its own
+    outcomes = run_concurrently(lambda node_name: cordon_node(client, node_name), to_cordon, max_workers)
+    return finish_cordon_summary(summary, sort_outcomes(outcomes, summary, "cordoned"))
 
-    node_list = client.list_node()
-    for node in node_list.items:
-        logging.info("Inspecting node %s to cordon", node.metadata.name)
-        if node.metadata.labels.get(
-                "autoscaling.cast.ai/removal-disabled") == "true" and protect_removal_disabled == "true":
-            logging.info("skip Cordoning node: %s due protect_removal_disabled label" % node.metadata.name)
+
+def select_nodes_to_cordon(client, protect_removal_disabled: str, exclude_node_id: str, summary: dict):
+    """ names of schedulable nodes to cordon, excluded nodes are recorded in summary as skipped"""
+    to_cordon = []
+    for node in iter_list(client.list_node, node_record):
+        logging.info("Inspecting node %s to cordon", node.name)
+        if node.labels.get("autoscaling.cast.ai/removal-disabled") == "true" and protect_removal_disabled == "true":
+            logging.info("skip Cordoning node: %s due protect_removal_disabled label" % node.name)
+            summary["skipped"].append(node.name)
+            continue
+        if node.labels.get("provisioner.cast.ai/node-id") == exclude_node_id:
+            logging.info("skip Cordoning hibernation node: %s" % node.name)
+            summary["skipped"].append(node.name)
             continue
-        if node.metadata.labels.get("provisioner.cast.ai/node-id") == exclude_node_id:
-            logging.info("skip Cordoning hibernation node: %s" % node.metadata.name)
+        if node.unschedulable:
+            logging.info("skip Cordoning already unschedulable node: %s" % node.name)
+            summary["skipped"].append(node.name)
             continue
-        logging.info("Cordoning: %s" % node.metadata.name)
-        client.patch_node(node.metadata.name, node_body)
+        to_cordon.append(node.name)
+    return to_cordon
+
+
+def finish_cordon_summary(summary: dict, errors: dict = None):
+    return finish_summary("Cordon", summary, errors, CordonError, "cordon", "node")
+
+
+@basic_retry(attempts=3, pause=10)
+def uncordon_node(client, node_name: str):
+    """ mark single node schedulable again"""
+    logging.info("Uncordoning: %s" % node_name)
+    client.patch_node(node_name, {"spec": {"unschedulable": False}})
+
+
+def uncordon_nodes(client, node_names: list, max_workers: int = 10):
+    """ uncordon nodes concurrently, returns summary of uncordoned and failed nodes"""
+    summary = {"uncordoned": [], "failed": {}}
+    outcomes = run_concurrently(lambda node_name: uncordon_node(client, node_name), node_names, max_workers)
+    errors = sort_outcomes(outcomes, summary, "uncordoned")
+    return finish_summary("Uncordon", summary, errors, CordonError, "uncordon", "node")
 
 
 def deployment_tolerates(deployment, toleration):
     """" check if deployment tolerates a taint on a hibernation node"""
-    if deployment.spec.template.spec.tolerations:
-        if [tol_key for tol_key in deployment.spec.template.spec.tolerations if tol_key.key == toleration]:
+    if deployment.tolerations:
+        if [tol_key for tol_key in deployment.tolerations if tol_key.get("key") == toleration]:
             return True
     return False
 
 
-@basic_retry(attempts=3, pause=15)
-def add_special_toleration(client, deployment: str, toleration: str):
+@basic_retry(attempts=3, pause=5)
+def add_special_toleration(client, deployment: DeploymentRecord, toleration: str):
     """" modify essential deployment to keep them running on hibernation node (tolerate node)"""
     logging.info("add tolerations to essential workloads function")
 
-    toleration_to_add = {
-        'key': toleration,
-        'effect': 'NoSchedule',
-        'operator': 'Exists'
-    }
-
-    deployment_name = deployment.metadata.name
+    deployment_name = deployment.name
     if not deployment_tolerates(deployment, toleration):
-        current_tolerations = deployment.spec.template.spec.tolerations
         logging.info("Patching and restarting: %s" % deployment_name)
-        if current_tolerations is None:
-            current_tolerations = []
-        current_tolerations.append(toleration_to_add)
-
-        restart_body = {
-            'spec': {
-                'template': {
-                    'spec': {
-                        'tolerations': current_tolerations
-                    }
-                }
-            }
-        }
+        restart_body = toleration_patch(deployment, toleration)
 
         patch_result = None
         try:
-            patch_result = client.patch_namespaced_deployment(deployment_name, deployment.metadata.namespace,
+            patch_result = client.patch_namespaced_deployment(deployment_name, deployment.namespace,
                                                               restart_body)
         except ApiException as e:
+            if _is_retryable_error(e):
+                raise
+            if e.status == 422 and toleration_applied(client, deployment, toleration):
+                logging.info(f'Deployment {deployment_name} already has toleration, applied by an earlier attempt')
+                return True
             raise K8sAPIError(
                 f'Exception when calling patching deployment: {deployment_name} with result {patch_result}') from e
 
         if patch_result:
             logging.info("Patch complete...")
+        return True
     else:
         logging.info(f'SKIP Deployment {deployment_name} already has toleration')
+        return False
 
 
-def check_hibernation_node_readiness(client, taint: str, node_name: str):
-    """ check if node has taint """
-    node = client.read_node(node_name)
-    if check_if_node_has_specific_taint(client, taint, node_name):
-        if node_is_ready(node) and not node_has_unexpected_taint(client, taint, node_name):
-            logging.info(
-                "check_hibernation_node_readiness: found hibernation node %s with valid taint %s and no other unexpected taints",
-                node_name, taint)
-            return node.metadata.labels.get("provisioner.cast.ai/node-id")
+class TolerationError(FanOutError, K8sAPIError):
+    """ deployments failed to patch or revert, errors by namespace/name"""
+
+
+def add_special_tolerations(client, deployments: list, toleration: str, max_workers: int = 10):
+    """ patch deployments concurrently, returns summary of patched, skipped and failed deployments"""
+    summary = {"patched": [], "skipped": [], "failed": {}}
+    by_key = {deployment.key: deployment for deployment in deployments}
+    outcomes = run_concurrently(lambda key: add_special_toleration(client, by_key[key], toleration),
+                                list(by_key), max_workers)
+    return finish_toleration_summary(summary, sort_outcomes(outcomes, summary, "patched", "skipped"))
+
+
+def toleration_patch(deployment: DeploymentRecord, toleration: str) -> list:
+    """ JSON patch that appends toleration to the pod template instead of rewriting the list.
+
+    The test op makes the patch fail with 422 when the list is no longer the one it was built from, so a retry
+    after a lost response cannot add the toleration twice and a concurrent writer is not overwritten.
+    """
+    toleration_to_add = {
+        'key': toleration,
+        'effect': 'NoSchedule',
+        'operator': 'Exists'
+    }
+    path = "/spec/template/spec/tolerations"
+    if deployment.tolerations is None:
+        return [{"op": "test", "path": path, "value": None},
+                {"op": "add", "path": path, "value": [toleration_to_add]}]
+    return [{"op": "test", "path": path, "value": deployment.tolerations},
+            {"op": "add", "path": f"{path}/-", "value": toleration_to_add}]
+
+
+def toleration_applied(client, deployment: DeploymentRecord, toleration: str) -> bool:
+    """ after a 422 from the guarded patch, whether the current deployment already tolerates"""
+    resp = client.read_namespaced_deployment(deployment.name, deployment.namespace, _preload_content=False)
+    try:
+        current = deployment_record(json.loads(resp.data))
+    finally:
+        resp.release_conn()
+    return deployment_tolerates(current, toleration)
+
+
+def finish_toleration_summary(summary: dict, errors: dict = None):
+    return finish_summary("Toleration", summary, errors, TolerationError, "patch", "deployment")
+
+
+def toleration_revert_patch(deployment: DeploymentRecord, toleration: str) -> list:
+    """ JSON patch removing the toleration, every removal tests the entry first so a changed list is not damaged"""
+    patch = []
+    tolerations = deployment.tolerations or []
+    for index in reversed(range(len(tolerations))):
+        if tolerations[index].get("key") == toleration:
+            path = f"/spec/template/spec/tolerations/{index}"
+            patch.append({"op": "test", "path": f"{path}/key", "value": toleration})
+            patch.append({"op": "remove", "path": path})
+    return patch
+
+
+@basic_retry(attempts=3, pause=5)
+def remove_special_toleration(client, deployment: DeploymentRecord, toleration: str):
+    """ undo add_special_toleration, False when the deployment does not have the toleration"""
+    revert_body = toleration_revert_patch(deployment, toleration)
+    if not revert_body:
+        return False
+    logging.info("Removing toleration and restarting: %s" % deployment.key)
+    try:
+        client.patch_namespaced_deployment(deployment.name, deployment.namespace, revert_body)
+    except ApiException as e:
+        if _is_retryable_error(e):
+            raise
+        raise K8sAPIError(f'Exception when reverting toleration of deployment: {deployment.key}') from e
+    return True
+
+
+def remove_special_tolerations(client, keys: list, toleration: str, max_workers: int = 10):
+    """ revert tolerations of deployments by namespace/name key with one list call, returns summary"""
+    summary = {"reverted": [], "skipped": [], "failed": {}}
+    if not keys:
+        return summary
+    wanted = set(keys)
+    by_key = {deployment.key: deployment
+              for deployment in iter_list(client.list_deployment_for_all_namespaces, deployment_record)
+              if deployment.key in wanted}
+    summary["skipped"].extend(sorted(wanted - set(by_key)))
+    outcomes = run_concurrently(lambda key: remove_special_toleration(client, by_key[key], toleration),
+                                list(by_key), max_workers)
+    errors = sort_outcomes(outcomes, summary, "reverted", "skipped")
+    return finish_summary("Toleration revert", summary, errors, TolerationError, "revert", "deployment")
+
+
+def pod_is_ready(pod):
+    """ check if pod is running, ready and not terminating"""
+    if pod.metadata.deletion_timestamp or not pod.status or not pod.status.conditions:
+        return False
+    for condition in pod.status.conditions:
+        if condition.type == "Ready" and condition.status == "True":
+            return True
+    return False
+
+
+def deployment_owns_pod(deployment, pod):
+    pod_labels = pod.metadata.labels or {}
+    return (pod.metadata.namespace == deployment.namespace and
+            all(pod_labels.get(key) == value for key, value in deployment.match_labels.items()))
+
+
+def log_workload_progress(ready: int, total: int, pending: list):
+    logging.info("Kept workloads ready on hibernation node: %s/%s, waiting for %s", ready, total, pending)
+
+
+def wait_for_workloads_on_node(client, deployments: list, node_name: str, timeout: float,
+                               on_progress=log_workload_progress):
+    """ watch pods on node until every deployment has a Ready pod there, False if timeout expires first"""
+    waiting = {}
+    for deployment in deployments:
+        if deployment.replicas == 0 or not deployment.match_labels:
+            continue
+        waiting[deployment.key] = deployment
+    total = len(waiting)
+    deadline = time.monotonic() + timeout
+    field_selector = f"spec.nodeName={node_name}"
+    pods = {}
+    last_reported = []
+
+    def all_ready():
+        for key in [key for key, deployment in waiting.items()
+                    if any(pod_is_ready(pod) and deployment_owns_pod(deployment, pod) for pod in pods.values())]:
+            del waiting[key]
+        progress = (total - len(waiting), total, sorted(waiting))
+        if progress != tuple(last_reported):
+            on_progress(*progress)
+            last_reported[:] = progress
+        return not waiting
+
+    resource_version = None
+    while True:
+        if resource_version is None:
+            pod_list = client.list_pod_for_all_namespaces(field_selector=field_selector)
+            pods = {pod.metadata.uid: pod for pod in pod_list.items}
+            resource_version = pod_list.metadata.resource_version
+        if all_ready():
+            return True
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logging.warning("Timed out after %ss waiting for workloads on node %s: %s", timeout, node_name,
+                            sorted(waiting))
+            return False
+
+        w = watch.Watch()
+        try:
+            for event in w.stream(client.list_pod_for_all_namespaces, field_selector=field_selector,
+                                  resource_version=resource_version, timeout_seconds=max(1, int(remaining))):
+                pod = event["object"]
+                resource_version = pod.metadata.resource_version
+                if event["type"] == "DELETED":
+                    pods.pop(pod.metadata.uid, None)
+                else:
+                    pods[pod.metadata.uid] = pod
+                if all_ready():
+                    return True
+                if time.monotonic() >= deadline:
+                    break
+        except ApiException as e:
+            if e.status != 410:
+                raise
+            logging.info("Pod watch expired, listing pods on node %s again", node_name)
+            resource_version = None
+        finally:
+            w.stop()
+
+
+HOSTNAME_LABEL = "kubernetes.io/hostname"
+NODE_ID_LABEL = "provisioner.cast.ai/node-id"
+
+
+class NodeInformer:
+    """ Watch backed cache of V1Node objects, one list plus one watch stream instead of a GET per check.
+
+    Nodes are indexed by name, hostname label and CAST AI node id label, so mapping between them needs no API call.
+    A failed watch or list is retried with exponential backoff up to max_backoff seconds.
+    """
+
+    def __init__(self, client, watch_timeout: int = 300, max_backoff: float = 60):
+        self.client = client
+        self.watch_timeout = watch_timeout
+        self.max_backoff = max_backoff
+        self._nodes = {}
+        self._by_hostname = {}
+        self._by_castai_id = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = threading.Event()
+        self._response = None
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            resource_version = self._relist()
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(resource_version, self._stopped),
+                                            name="node-informer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped.set()
+            self._thread = None
+            response, self._response = self._response, None
+        if response is not None:
+            _interrupt(response)
+
+    def _relist(self):
+        node_list = self.client.list_node()
+        with self._condition:
+            self._nodes, self._by_hostname, self._by_castai_id = {}, {}, {}
+            for node in node_list.items:
+                self._store(node)
+            self._condition.notify_all()
+        return node_list.metadata.resource_version
+
+    def _store(self, node):
+        """ add or replace node in the cache and its indexes, condition must be held"""
+        self._remove(node.metadata.name)
+        self._nodes[node.metadata.name] = node
+        labels = node.metadata.labels or {}
+        for index, label in ((self._by_hostname, HOSTNAME_LABEL), (self._by_castai_id, NODE_ID_LABEL)):
+            if labels.get(label):
+                index[labels[label]] = node.metadata.name
+
+    def _remove(self, node_name: str):
+        node = self._nodes.pop(node_name, None)
+        if node is None:
+            return
+        labels = node.metadata.labels or {}
+        for index, label in ((self._by_hostname, HOSTNAME_LABEL), (self._by_castai_id, NODE_ID_LABEL)):
+            if index.get(labels.get(label)) == node_name:
+                del index[labels[label]]
+
+    def _watch_nodes(self, stopped: threading.Event):
+        """ list_node that keeps the streamed watch response, so stop() can close it"""
+        @functools.wraps(self.client.list_node)
+        def list_node(*args, **kwargs):
+            response = self.client.list_node(*args, **kwargs)
+            with self._condition:
+                if stopped.is_set():
+                    _interrupt(response)
+                else:
+                    self._response = response
+            return response
+        return list_node
+
+    def _run(self, resource_version, stopped: threading.Event):
+        failures = 0
+        while not stopped.is_set():
+            w = watch.Watch()
+            try:
+                if resource_version is None:
+                    resource_version = self._relist()
+                for event in w.stream(self._watch_nodes(stopped), resource_version=resource_version,
+                                      timeout_seconds=self.watch_timeout):
+                    if stopped.is_set():
+                        break
+                    failures = 0
+                    node = event["object"]
+                    resource_version = node.metadata.resource_version
+                    if event["type"] == "DELETED":
+                        with self._condition:
+                            self._remove(node.metadata.name)
+                            self._condition.notify_all()
+                    else:
+                        self.update(node)
+                failures = 0
+                continue
+            except ApiException as e:
+                if stopped.is_set():
+                    return
+                resource_version = None
+                if e.status == 410:
+                    logging.info("Node watch expired, listing nodes again")
+                    continue
+                failures += 1
+                logging.warning(f"Node watch failed, listing nodes again: {e}")
+            except Exception as e:
+                if stopped.is_set():
+                    return
+                resource_version = None
+                failures += 1
+                logging.warning(f"Node watch failed, listing nodes again: {e}")
+            finally:
+                w.stop()
+            # a watch that keeps failing (no RBAC, API server down) must not turn into a list per second
+            delay = min(self.max_backoff, 2 ** (failures - 1))
+            stopped.wait(random.uniform(delay / 2, delay))
+
+    def update(self, node):
+        """ store node unless cache already holds a newer version, used for watch events and patch results"""
+        with self._condition:
+            current = self._nodes.get(node.metadata.name)
+            if current is not None and _resource_version(current) > _resource_version(node):
+                return
+            self._store(node)
+            self._condition.notify_all()
+
+    def get(self, node_name: str):
+        self.start()
+        with self._condition:
+            return self._nodes.get(node_name)
+
+    def by_hostname(self, hostname: str):
+        self.start()
+        with self._condition:
+            return self._nodes.get(self._by_hostname.get(hostname))
+
+    def by_castai_id(self, node_id: str):
+        self.start()
+        with self._condition:
+            return self._nodes.get(self._by_castai_id.get(node_id))
+
+    def castai_id(self, node_name: str):
+        """ CAST AI node id of the node, join with NodeInventory.by_id for the CAST AI record"""
+        node = self.get(node_name)
+        return (node.metadata.labels or {}).get(NODE_ID_LABEL) if node is not None else None
+
+    def find(self, predicate) -> list:
+        self.start()
+        with self._condition:
+            return [node for node in self._nodes.values() if predicate(node)]
+
+    def wait_for(self, node_name: str, predicate, timeout: float):
+        """ wait until predicate(node or None) is true, returns the last seen node"""
+        self.start()
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                node = self._nodes.get(node_name)
+                remaining = deadline - time.monotonic()
+                if predicate(node) or remaining <= 0:
+                    return node
+                self._condition.wait(remaining)
+
+
+def _interrupt(response):
+    """ end a streamed response another thread is reading, close() would wait for that read to finish"""
+    sock = getattr(getattr(response, "connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def _resource_version(node) -> int:
+    try:
+        return int(node.metadata.resource_version)
+    except (TypeError, ValueError):
+        return 0
+
+
+def check_hibernation_node_readiness(client, taint: str, node_name: str, informer: NodeInformer = None,
+                                     timeout: float = 90):
+    """ wait for hibernation node to settle, return its CAST AI id if it is ready and tainted correctly"""
+    temporary_informer = informer is None
+    if temporary_informer:
+        informer = NodeInformer(client)
+    try:
+        node = informer.wait_for(node_name, lambda n: hibernation_node_state(n, taint) != "pending", timeout)
+    finally:
+        if temporary_informer:
+            informer.stop()
+
+    if hibernation_node_state(node, taint) == "ready":
+        logging.info(
+            "check_hibernation_node_readiness: found hibernation node %s with valid taint %s and no other unexpected taints",
+            node_name, taint)
+        return node.metadata.labels.get("provisioner.cast.ai/node-id")
     logging.info("Hibernation node %s is not READY", node_name)
     return None
 
 
-@basic_retry(attempts=3, pause=10)
-def node_is_ready(node: str):
+def hibernation_node_state(node, taint: str) -> str:
+    """ ready, pending (not registered yet or network still unavailable) or invalid"""
+    if node is None:
+        return "pending"
+    if not check_if_node_has_specific_taint(node, taint) or not node_is_ready(node):
+        return "invalid"
+    if node_has_taint(node, "node.kubernetes.io/network-unavailable"):
+        logging.info("Taint 'node.kubernetes.io/network-unavailable' found on node %s, waiting", node.metadata.name)
+        return "pending"
+    if node_has_unexpected_taint(node, taint):
+        return "invalid"
+    return "ready"
+
+
+def node_is_ready(node):
     """ check if node is ready """
     node_scheduling = node.spec.unschedulable
-    for condition in node.status.conditions:
+    for condition in node.status.conditions or []:
         if condition.status and condition.type == "Ready" and not node_scheduling:
             return True
     return False
 
 
-def check_if_node_has_specific_taint(client, taint: str, node_name: str):
-    """ check if node has taint """
-    node = client.read_node(node_name)
+def node_has_taint(node, taint: str) -> bool:
+    return any(current_taint.key == taint for current_taint in node.spec.taints or [])
 
-    if node.spec.taints:
-        for current_taint in node.spec.taints:
-            if current_taint.to_dict()["key"] == taint:
-                logging.info("check_if_node_has_specific_taint: found node %s with taint %s", node_name, taint)
-                return True
-    logging.info("Node %s is not tainted", node_name)
+
+def check_if_node_has_specific_taint(node, taint: str):
+    """ check if node has taint """
+    if node_has_taint(node, taint):
+        logging.info("check_if_node_has_specific_taint: found node %s with taint %s", node.metadata.name, taint)
+        return True
+    logging.info("Node %s is not tainted", node.metadata.name)
     return False
 
-@basic_retry(attempts=3, pause=30)
-def node_has_unexpected_taint(client, valid_taint_key: str, node_name: str):
+
+def node_has_unexpected_taint(node, valid_taint_key: str):
     """ check if node has unexpected taint """
-    node = client.read_node(node_name)
-
-    if node.spec.taints:
-        for current_taint in node.spec.taints:
-            if current_taint.to_dict()["key"] == "node.kubernetes.io/network-unavailable":
-                raise TaintException("Taint 'node.kubernetes.io/network-unavailable' found. Retrying...") # retry if network is unavailable
-            if current_taint.to_dict()["key"] != valid_taint_key:
-                logging.info("unexpected taint found %s on node %s", current_taint.to_dict()["key"], node_name)
-                return True
-    logging.info("Node %s does not have unexpected taint", node_name)
+    for current_taint in node.spec.taints or []:
+        if current_taint.key not in (valid_taint_key, "node.kubernetes.io/network-unavailable"):
+            logging.info("unexpected taint found %s on node %s", current_taint.key, node.metadata.name)
+            return True
+    logging.info("Node %s does not have unexpected taint", node.metadata.name)
     return False
 
 
 @basic_retry(attempts=2, pause=5)
-def add_node_taint(client, node_name, pause_taint: str, labels: str):
+def add_node_taint(client, node_name, pause_taint: str, labels: str, informer: NodeInformer = None):
     """ add specific taint to node"""
     logging.info(f'patching node {node_name} to add {pause_taint} taint')
 
-    node_name_label = "kubernetes.io/hostname=" + node_name
-    node = client.list_node(label_selector=node_name_label).items[0]
+    node = informer.by_hostname(node_name) if informer else None
+    if node is None:
+        node_name_label = f"{HOSTNAME_LABEL}={node_name}"
+        node = client.list_node(label_selector=node_name_label).items[0]
 
     taint_to_add = {"key": pause_taint, "effect": "NoSchedule"}
-    current_taints = node.spec.taints
-    if current_taints is None:
-        current_taints = []
-    elif check_if_node_has_specific_taint(client, pause_taint, node_name):
+    if check_if_node_has_specific_taint(node, pause_taint):
         logging.info(f'node {node_name} already has {pause_taint} taint')
         return
 
+    current_taints = list(node.spec.taints or [])
     current_taints.append(taint_to_add)
 
     taint_body = {
@@ -183,12 +682,20 @@ def add_node_taint(client, node_name, pause_taint: str, labels: str):
 
     if patch_result:
         logging.info("node %s successfully patched", node.metadata.name)
+        if informer:
+            informer.update(patch_result)
 
 
 @basic_retry(attempts=3, pause=5)
-def remove_node_taint(client, pause_taint: str, node_id: str):
+def remove_node_taint(client, pause_taint: str, node_id: str, informer: NodeInformer = None):
     """ remove specific taint from node"""
-    node = client.list_node(label_selector=f"provisioner.cast.ai/node-id={node_id}").items[0]
+    node = informer.by_castai_id(node_id) if informer else None
+    if node is None:
+        node = client.list_node(label_selector=f"{NODE_ID_LABEL}={node_id}").items[0]
+    return untaint_node(client, node, pause_taint, informer)
+
+
+def untaint_node(client, node, pause_taint: str, informer: NodeInformer = None):
     node_name = node.metadata.name
 
     logging.info(f'patching node {node_name} to remove {pause_taint} taint')
@@ -201,6 +708,8 @@ def remove_node_taint(client, pause_taint: str, node_id: str):
         patch_result = client.patch_node(node.metadata.name, taint_body)
     except ApiException as e:
         raise K8sAPIError(f'Failed to remove taint from node {node.metadata.name}') from e
+    if informer and patch_result:
+        informer.update(patch_result)
 
     if patch_result:
         logging.info(f'node {node_name} successfully patched')
@@ -209,10 +718,32 @@ def remove_node_taint(client, pause_taint: str, node_id: str):
         logging.error(f'failed to patch node {node_name}, with details {patch_result}')
 
 
+def remove_pause_taints(client, pause_taint: str, informer: NodeInformer, max_workers: int = 10):
+    """ remove the taint from every node that still has it, returns names of the untainted nodes"""
+    @basic_retry(attempts=3, pause=5)
+    def untaint(node_name):
+        node = informer.get(node_name)
+        if node is None or not node_has_taint(node, pause_taint):
+            return False
+        return untaint_node(client, node, pause_taint, informer)
+
+    tainted = [node.metadata.name for node in informer.find(lambda node: node_has_taint(node, pause_taint))]
+    outcomes = run_concurrently(untaint, tainted, max_workers)
+    failed = {node_name: err for node_name, (_, err) in outcomes.items() if err is not None}
+    if failed:
+        raise TaintException(f"Failed to remove {pause_taint} taint from nodes: {failed}")
+    return [node_name for node_name, (untainted, _) in outcomes.items() if untainted]
+
+
 @basic_retry(attempts=3, pause=15)
-def get_node_castai_id(client, node_name: str):
+def get_node_castai_id(client, node_name: str, informer: NodeInformer = None):
     """" Node with hibernation taint already exist """
-    node_name_label = "kubernetes.io/hostname=" + node_name
+    node = informer.by_hostname(node_name) if informer else None
+    if node is not None:
+        node_id = (node.metadata.labels or {}).get(NODE_ID_LABEL)
+        logging.info("found Node %s with id %s that is running Pause Job ", node.metadata.name, node_id)
+        return node_id
+    node_name_label = f"{HOSTNAME_LABEL}={node_name}"
     node_list = client.list_node(label_selector=node_name_label)
     if len(node_list.items) == 1:
         for node in node_list.items:
@@ -222,20 +753,23 @@ def get_node_castai_id(client, node_name: str):
 
 
 @basic_retry(attempts=3, pause=15)
-def get_deployments_names_with_system_priority_class(client):
-    """Return all system-critical priority-class deployments"""
-    deployments = client.list_deployment_for_all_namespaces()
-    critical_deploys = []
-    for deployment in deployments.items:
-        if has_system_priority_class(deployment): critical_deploys.append(deployment)
-    return critical_deploys
+def get_deployments_to_keep(client, namespaces: list):
+    """Return system-critical deployments and all deployments in namespaces, every deployment once"""
+    keep = {}
+    for deployment in iter_list(client.list_deployment_for_all_namespaces, deployment_record):
+        if deployment.namespace in namespaces:
+            logging.info(f'Additional {deployment.namespace} deployment {deployment.name} will be patched')
+            keep[deployment.key] = deployment
+        elif has_system_priority_class(deployment):
+            keep[deployment.key] = deployment
+    return list(keep.values())
 
 
 @basic_retry(attempts=3, pause=15)
 def has_system_priority_class(deployment):
     """ validate if Deployment is system critical"""
-    if deployment.spec.template.spec.priority_class_name in ("system-cluster-critical", "system-node-critical"):
-        logging.info(f'SYSTEM CRITICAL {deployment.metadata.name} found')
+    if deployment.priority_class_name in ("system-cluster-critical", "system-node-critical"):
+        logging.info(f'SYSTEM CRITICAL {deployment.name} found')
         return True
     else:
         return False
@@ -301,3 +835,50 @@ def update_last_run_status(client, cm: str, ns: str, status: str):
     }
     logging.info(f"configMap body to {body}")
     client.patch_namespaced_config_map(name=cm, namespace=ns, body=body)
+
+
+
+class ConfigMapCheckpoint:
+    """ Pipeline checkpoint kept as JSON in one key of a ConfigMap, a checkpoint older than max_age is ignored"""
+
+    def __init__(self, client, cm: str, ns: str, key: str, max_age: float = 12 * 3600):
+        self.client = client
+        self.cm = cm
+        self.ns = ns
+        self.key = key
+        self.max_age = max_age
+        self.started_at = time.time()
+
+    @basic_retry(attempts=3, pause=15)
+    def load(self) -> dict:
+        """ results of the steps the last unfinished run completed, empty when there is none"""
+        config_map = self.client.read_namespaced_config_map(name=self.cm, namespace=self.ns)
+        value = (config_map.data or {}).get(self.key)
+        if not value:
+            return {}
+        try:
+            checkpoint = json.loads(value)
+        except ValueError as e:
+            logging.warning(f"ignoring unreadable checkpoint {self.key}: {e}")
+            return {}
+        if time.time() - checkpoint.get("started_at", 0) > self.max_age:
+            logging.info("ignoring checkpoint %s from %s, it is too old", self.key,
+                         datetime.fromtimestamp(checkpoint.get("started_at", 0)).strftime("%Y-%m-%dT%H:%M:%S"))
+            return {}
+        self.started_at = checkpoint["started_at"]
+        if checkpoint.get("running"):
+            logging.info("last run was interrupted during: %s", ", ".join(checkpoint["running"]))
+        return checkpoint.get("completed") or {}
+
+    def save(self, completed: dict, running: list):
+        """ best effort, a lost checkpoint only means the next run redoes some steps"""
+        value = json.dumps({"started_at": self.started_at, "completed": completed, "running": running},
+                           separators=(",", ":"))
+        try:
+            self.client.patch_namespaced_config_map(name=self.cm, namespace=self.ns, body={"data": {self.key: value}})
+        except ApiException as e:
+            logging.warning(f"could not save checkpoint {self.key}: {e}")
+
+    @basic_retry(attempts=3, pause=15)
+    def clear(self):
+        self.client.patch_namespaced_config_map(name=self.cm, namespace=self.ns, body={"data": {self.key: None}})
@@ -0,0 +1,170 @@
+"""Run lock on a coordination.k8s.io/v1 Lease, so pause and resume runs never overlap.
+
+The holder renews the Lease while it runs and clears it when done. A run that crashed stops renewing and its
+Lease expires after lease_duration seconds. The action of the holder is kept in an annotation, so a second run of
+the same action can exit after one read.
+
+The identity is stable across retries of one run (the Job name, or the pod name), so a restarted container takes
+its own Lease over at once and continues the run instead of mistaking it for another run.
+"""
+import logging
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from kubernetes import client as rawclient
+from kubernetes.client.rest import ApiException
+
+ACTION_ANNOTATION = "hibernate.cast.ai/action"
+
+
+class LockLost(Exception):
+    pass
+
+
+def default_identity() -> str:
+    """ pod name, the same after a container restart"""
+    return socket.gethostname()
+
+
+class LeaseLock:
+    def __init__(self, client, name: str, namespace: str, action: str = None, identity: str = None,
+                 lease_duration: int = 60, renew_interval: float = 15):
+        self.client = client
+        self.name = name
+        self.namespace = namespace
+        self.action = action
+        self.identity = identity or default_identity()
+        self.lease_duration = lease_duration
+        self.renew_interval = renew_interval
+        self.holder = None
+        self.holder_action = None
+        self.lost = False
+        self._acquire_time = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _now() -> datetime:
+        return datetime.now(timezone.utc)
+
+    def _lease(self, resource_version: str = None, transitions: int = 0, holder: str = None):
+        now = self._now()
+        return rawclient.V1Lease(
+            metadata=rawclient.V1ObjectMeta(name=self.name, resource_version=resource_version,
+                                            annotations={ACTION_ANNOTATION: self.action or ""}),
+            spec=rawclient.V1LeaseSpec(holder_identity=holder, lease_duration_seconds=self.lease_duration,
+                                       acquire_time=self._acquire_time or now, renew_time=now,
+                                       lease_transitions=transitions))
+
+    def _expired(self, lease) -> bool:
+        spec = lease.spec
+        renewed = spec.renew_time or spec.acquire_time
+        if not spec.holder_identity or renewed is None:
+            return True
+        if renewed.tzinfo is None:
+            renewed = renewed.replace(tzinfo=timezone.utc)
+        return renewed + timedelta(seconds=spec.lease_duration_seconds or self.lease_duration) < self._now()
+
+    def try_acquire(self) -> bool:
+        """ take the Lease if it is free, released or expired, False with holder set when another run has it"""
+        try:
+            lease = self.client.read_namespaced_lease(self.name, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            self._acquire_time = self._now()
+            try:
+                self.client.create_namespaced_lease(self.namespace, self._lease(holder=self.identity))
+            except ApiException as e:
+                # another run created it first, read who holds it
+                if e.status == 409:
+                    return self.try_acquire()
+                raise
+            return self._acquired()
+
+        self.holder = lease.spec.holder_identity
+        self.holder_action = (lease.metadata.annotations or {}).get(ACTION_ANNOTATION)
+        if self.holder != self.identity and not self._expired(lease):
+            return False
+        if self.holder == self.identity:
+            logging.info("Run lock %s is held by an earlier attempt of this run, taking it over", self.name)
+        elif self.holder:
+            logging.warning("Run lock %s of %s expired, taking it over", self.name, self.holder)
+        self._acquire_time = self._now()
+        transitions = (lease.spec.lease_transitions or 0) + (self.holder != self.identity)
+        try:
+            self.client.replace_namespaced_lease(self.name, self.namespace,
+                                                 self._lease(lease.metadata.resource_version, transitions,
+                                                             self.identity))
+        except ApiException as e:
+            # another run wrote the Lease between our read and write
+            if e.status == 409:
+                return False
+            raise
+        return self._acquired()
+
+    def _acquired(self) -> bool:
+        self.holder, self.holder_action = self.identity, self.action
+        self.lost = False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._renew, name="run-lock", daemon=True)
+        self._thread.start()
+        logging.info("Acquired run lock %s as %s", self.name, self.identity)
+        return True
+
+    def acquire(self, timeout: float, poll: float = 5, exit_on_same_action: bool = True) -> bool:
+        """ wait up to timeout seconds for the Lease, return False at once when a run of the same action holds it"""
+        deadline = time.monotonic() + timeout
+        waiting_logged = False
+        while not self.try_acquire():
+            if exit_on_same_action and self.holder_action == self.action:
+                logging.info("%s is already running in %s", self.action, self.holder)
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if not waiting_logged:
+                logging.info("Waiting up to %ss for %s of %s to finish", int(timeout), self.holder_action,
+                             self.holder)
+                waiting_logged = True
+            time.sleep(min(poll, remaining))
+        return True
+
+    def _renew(self):
+        while not self._stop.wait(self.renew_interval):
+            try:
+                lease = self.client.read_namespaced_lease(self.name, self.namespace)
+                if lease.spec.holder_identity != self.identity:
+                    self.lost = True
+                    logging.error("Run lock %s was taken over by %s", self.name, lease.spec.holder_identity)
+                    return
+                self.client.replace_namespaced_lease(self.name, self.namespace,
+                                                     self._lease(lease.metadata.resource_version,
+                                                                 lease.spec.lease_transitions or 0, self.identity))
+            except Exception as e:
+                # the Lease stays valid until it expires, the next renewal tries again
+                logging.warning(f"Could not renew run lock {self.name}: {e}")
+
+    def check(self):
+        """ raise LockLost once another run took the Lease over, the holder must stop changing the cluster"""
+        if self.lost:
+            raise LockLost(f"run lock {self.name} was taken over by another run")
+
+    def release(self):
+        """ clear the holder so the next run does not wait for expiry, best effort"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.lost:
+            return
+        try:
+            lease = self.client.read_namespaced_lease(self.name, self.namespace)
+            if lease.spec.holder_identity == self.identity:
+                self.client.replace_namespaced_lease(self.name, self.namespace,
+                                                     self._lease(lease.metadata.resource_version,
+                                                                 lease.spec.lease_transitions or 0))
+        except ApiException as e:
+            logging.warning(f"Could not release run lock {self.name}, it expires in {self.lease_duration}s: {e}")
@@ -1,9 +1,16 @@
-from cast_utils import *
-from k8s_utils import *
-from kubernetes import client, config
-from dotenv import load_dotenv
-from pathlib import Path
+from cast_utils import (cluster_ready, create_hibernation_node_with_fallback, get_castai_node_name_by_id,
+                        get_castai_policy, get_cluster_details, get_node_inventory, get_suitable_hibernation_node,
+                        missing_footprint, pausable_node_footprint, provision_footprint, toggle_autoscaler_top_flag)
+from context import AppContext, get_context
+from cron import CronSchedule
+from pipeline import Pipeline, StopPipeline
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import NamedTuple
+import metrics
+from utils import _is_retryable_error, parse_rate_limits, set_rate_limit
 import os
+import sys
 import time
 import logging
 import requests
@@ -20,38 +27,11 @@ def get_logging_level():
     }
     return levels.get(log_level, logging.INFO)
 
-logging.basicConfig(format="%(asctime)s %(message)s", level=get_logging_level(), handlers=[logging.StreamHandler()])
-logging.info("Starting hibernate")
-
-local_development = os.environ.get("LOCAL_DEVELOPMENT")
-# local_development = True
-
-if not local_development:
-    # Run hibernate from container inside k8s
-    config.load_incluster_config()
-else:
-    # Run hibernate from local IDE
-    logging.info(f"local dev: {local_development}")
-    load_dotenv(dotenv_path=Path('../.env'))
-    config.load_kube_config()
-
-k8s_v1 = client.CoreV1Api()
-k8s_v1_apps = client.AppsV1Api()
-
-castai_api_url = os.environ.get("API_URL", "https://api.cast.ai")
-castai_api_token = os.environ["API_KEY"]
-cluster_id = os.environ["CLUSTER_ID"]
-hibernate_node_type_override = os.environ.get("HIBERNATE_NODE")
-hibernate_node_labels = os.environ.get("HIBERNATE_NODE_LABELS")
-
-action = os.environ["ACTION"]
-user_namespaces_to_keep = os.environ.get("NAMESPACES_TO_KEEP")
-protect_removal_disabled = os.environ.get("PROTECT_REMOVAL_DISABLED")
-
-my_node_name = os.environ.get("MY_NODE_NAME")
 
 ns = "castai-agent"
 configmap_name = "castai-hibernate-state"
+suspend_checkpoint_key = "suspend_checkpoint"
+run_lock_name = "castai-hibernate-run"
 
 castai_pause_toleration = "scheduling.cast.ai/paused-cluster"
 cast_nodeID_label = "provisioner.cast.ai/node-id"
@@ -60,13 +40,6 @@ namespaces_to_keep = [
     "kube-system"
 ]
 
-# TODO: not all instances types are available in all regions
-instance_type = {
-    "GKE": "e2-standard-2",
-    "EKS": "m5a.large",
-    "AKS": "Standard_D2as_v5"
-}
-
 cloud_labels = {
     "GKE": "topology.gke.io/zone",
     "EKS": "k8s.io/cloud-provider-aws",
@@ -74,161 +47,320 @@ cloud_labels = {
 }
 
 
-def handle_resume():
+class HibernationNode(NamedTuple):
+    id: str
+    name: str
+
+
+def handle_resume(ctx: AppContext, preprovision=True):
     logging.info("Resuming cluster, autoscaling will be enabled")
-    try:
-        policy_changed = toggle_autoscaler_top_flag(cluster_id, castai_api_url, castai_api_token, True)
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"Failed to enable autoscaler: {e}")
-        raise
-    if not policy_changed:
-        raise Exception("could not enable CAST AI autoscaler.")
+    enable_cluster_autoscaler(ctx)
+
+    # a pause that never finished left cordoned nodes, the pause taint and added tolerations behind
+    if load_suspend_checkpoint(ctx):
+        logging.warning("The last pause did not finish, undoing what it changed")
+        handle_rollback(ctx, enable_autoscaler=False)
+
+    if preprovision and ctx.resume_preprovision:
+        with metrics.phase("resume", ctx.cluster_id, "preprovision"):
+            preprovision_footprint(ctx)
 
     logging.info("Resume operation completed.")
 
 
-def handle_suspend(cloud):
+def enable_cluster_autoscaler(ctx: AppContext):
+    with metrics.phase("resume", ctx.cluster_id, "enable_autoscaler"):
+        try:
+            policy_changed = toggle_autoscaler_top_flag(ctx.cluster_id, ctx.castai_api_url, ctx.castai_api_token,
+                                                        True)
+        except requests.exceptions.HTTPError as e:
+            logging.error(f"Failed to enable autoscaler: {e}")
+            raise
+        if not policy_changed:
+            raise Exception("could not enable CAST AI autoscaler.")
+
+
+def load_suspend_checkpoint(ctx: AppContext) -> dict:
+    """ steps finished by a pause that has not completed, empty when there is none or it cannot be read"""
+    from k8s_utils import ConfigMapCheckpoint
     try:
-        current_policies = get_castai_policy(cluster_id, castai_api_url, castai_api_token)
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"Failed to get CAST AI policy: {e}")
-        raise
-    if current_policies.get("enabled") == False:
-        logging.info("Cluster is already with disabled autoscaler policies, checking for dirty state.")
-        if last_run_dirty(client=k8s_v1, cm=configmap_name, ns=ns):
-            raise Exception("Cluster is already paused, but last run was dirty, clean configMap to retry or wait 12h")
-        else:
-            time.sleep(360)  # avoid double running
-            try:
-                nodes = get_castai_nodes(cluster_id=cluster_id, castai_api_url=castai_api_url,
-                                         castai_api_token=castai_api_token)
-            except requests.exceptions.HTTPError as e:
-                logging.error(f"Failed to get CAST AI nodes: {e}")
-                raise
-            logging.info(f'Number of nodes found in the cluster: {len(nodes.get("items", []))}')
-            logging.info("Cluster is already with disabled autoscaler policies, exiting.")
-            return 0
+        return ConfigMapCheckpoint(ctx.k8s_v1, configmap_name, ns, suspend_checkpoint_key).load()
+    except Exception as e:
+        logging.warning(f"could not read pause checkpoint: {e}")
+        return {}
+
 
+def discard_suspend_checkpoint(ctx: AppContext):
+    """ a resumed cluster has no pause left to continue, the next pause starts from the beginning"""
+    from k8s_utils import ConfigMapCheckpoint
     try:
-        toggle_autoscaler_top_flag(cluster_id, castai_api_url, castai_api_token, False)
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"Failed to disable autoscaler: {e}")
-        raise
+        ConfigMapCheckpoint(ctx.k8s_v1, configmap_name, ns, suspend_checkpoint_key).clear()
+    except Exception as e:
+        logging.warning(f"could not discard pause checkpoint: {e}")
+
 
-    my_node_name_id = ""
-    if my_node_name:
-        logging.info("Job pod node name found: %s", my_node_name)
-        my_node_name_id = get_node_castai_id(client=k8s_v1, node_name=my_node_name)
-
-    if hibernate_node_type_override:
-        hibernate_node_type = hibernate_node_type_override
-    else:
-        hibernate_node_type = instance_type[cloud]
-
-    candidate_node = get_suitable_hibernation_node(cluster_id=cluster_id, castai_api_url=castai_api_url,
-                                                   castai_api_token=castai_api_token,
-                                                   instance_type=hibernate_node_type, cloud=cloud)
-
-    hibernation_node_id = None
-    if candidate_node:
-        logging.info("Found suitable hibernation candidate node: %s", candidate_node)
-        add_node_taint(client=k8s_v1, node_name=candidate_node,
-                       pause_taint=castai_pause_toleration,
-                       labels=hibernate_node_labels)
-        hibernation_node_id = check_hibernation_node_readiness(client=k8s_v1, taint=castai_pause_toleration,
-                                                               node_name=candidate_node)
-
-    if my_node_name_id == hibernation_node_id:
+def preprovision_footprint(ctx: AppContext):
+    """ bring back the pre-pause nodes in one wave instead of waiting for autoscaler scale-ups"""
+    from snapshot import mark_snapshot_provisioned, read_snapshot, snapshot_provisioned
+    try:
+        snapshot = read_snapshot(client=ctx.k8s_v1, cm=configmap_name, ns=ns)
+        if not snapshot or not snapshot.get("footprint"):
+            logging.info("No pre-pause node footprint recorded, autoscaler will add nodes")
+            return
+        if snapshot_provisioned(client=ctx.k8s_v1, cm=configmap_name, ns=ns, snapshot=snapshot):
+            logging.info("Footprint of pause at %s was already provisioned", snapshot["taken_at"])
+            return
+        inventory = get_node_inventory(ctx.cluster_id, ctx.castai_api_url, ctx.castai_api_token, max_age=0)
+        provision_footprint(ctx.cluster_id, ctx.castai_api_url, ctx.castai_api_token,
+                            missing_footprint(snapshot["footprint"], inventory),
+                            max_workers=ctx.provision_concurrency)
+        mark_snapshot_provisioned(client=ctx.k8s_v1, cm=configmap_name, ns=ns, snapshot=snapshot)
+    except Exception as err:
+        # the autoscaler is already enabled and will add the capacity reactively
+        logging.warning(f"Pre-provisioning from node footprint failed: {err}")
+
+
+def get_engine(ctx: AppContext):
+    """ implementations of the fan-out stages: cordon, toleration patching and node deletion"""
+    if ctx.engine == "async":
+        import aio
+        if aio.available():
+            return aio
+        logging.warning("ENGINE=async requires aiohttp, falling back to sync engine")
+    import k8s_utils
+    import cast_utils
+    return SimpleNamespace(cordon_all_nodes=k8s_utils.cordon_all_nodes,
+                           add_special_tolerations=k8s_utils.add_special_tolerations,
+                           delete_all_pausable_nodes=cast_utils.delete_all_pausable_nodes)
+
+
+def handle_suspend(ctx: AppContext, cloud, guard=None):
+    from k8s_utils import (ConfigMapCheckpoint, DeploymentRecord, add_node_taint, check_hibernation_node_readiness,
+                           get_deployments_to_keep, get_node_castai_id, iter_list, last_run_dirty, node_record,
+                           remove_node_taint, update_last_run_status, wait_for_workloads_on_node)
+    from catalog import read_catalog, save_catalog
+    from snapshot import build_snapshot, save_snapshot
+
+    cluster_id, castai_api_url, castai_api_token = ctx.cluster_id, ctx.castai_api_url, ctx.castai_api_token
+    k8s_v1, k8s_v1_apps, node_informer = ctx.k8s_v1, ctx.k8s_v1_apps, ctx.node_informer
+    engine = get_engine(ctx)
+    # finished steps are checkpointed, a re-run after a crash or transient error continues where this one stopped
+    checkpoint = ConfigMapCheckpoint(k8s_v1, configmap_name, ns, suspend_checkpoint_key)
+    suspend = Pipeline("suspend", checkpoint=checkpoint, guard=guard)
+
+    @suspend.step(checkpoint=True)
+    def disable_autoscaler():
         try:
-            node_list_result = get_castai_nodes(cluster_id, castai_api_url, castai_api_token)
+            current_policies = get_castai_policy(cluster_id, castai_api_url, castai_api_token)
         except requests.exceptions.HTTPError as e:
-            logging.error(f"Failed to get CAST AI nodes: {e}")
+            logging.error(f"Failed to get CAST AI policy: {e}")
             raise
-        nodes = []
-        for node in node_list_result.get("items", []):
-            if node["state"]["phase"] == "ready":
-                nodes.append(node)
-        logging.info(f'Number of READY nodes found in the cluster: {len(nodes)}')
-        if len(nodes) == 1:
-            logging.info("Hibernation node is the same as job pod node, pause job just ran, exiting")
-            return 0
-
-    if not hibernation_node_id:
-        logging.info("No suitable hibernation node found, should make one")
+        if current_policies.get("enabled") == False:
+            logging.info("Cluster is already with disabled autoscaler policies, checking for dirty state.")
+            if last_run_dirty(client=k8s_v1, cm=configmap_name, ns=ns):
+                raise Exception("Cluster is already paused, but last run was dirty, clean configMap to retry or wait 12h")
+            else:
+                try:
+                    inventory = get_node_inventory(cluster_id=cluster_id, castai_api_url=castai_api_url,
+                                                   castai_api_token=castai_api_token)
+                except requests.exceptions.HTTPError as e:
+                    logging.error(f"Failed to get CAST AI nodes: {e}")
+                    raise
+                logging.info(f'Number of nodes found in the cluster: {len(inventory.items)}')
+                raise StopPipeline("Cluster is already with disabled autoscaler policies, exiting.")
+
         try:
-            hibernation_node_id = create_hibernation_node(cluster_id, castai_api_url, castai_api_token,
-                                                          instance_type=hibernate_node_type,
-                                                          k8s_taint=castai_pause_toleration,
-                                                          labels=hibernate_node_labels,
-                                                          cloud=cloud)
+            toggle_autoscaler_top_flag(cluster_id, castai_api_url, castai_api_token, False)
         except requests.exceptions.HTTPError as e:
-            logging.error(f"Failed to create hibernation node: {e}")
+            logging.error(f"Failed to disable autoscaler: {e}")
             raise
 
-    if not hibernation_node_id:
-        raise Exception("could not create hibernation node")
+    @suspend.step()
+    def job_node():
+        if ctx.my_node_name:
+            logging.info("Job pod node name found: %s", ctx.my_node_name)
+            return get_node_castai_id(client=k8s_v1, node_name=ctx.my_node_name, informer=node_informer)
+        return ""
+
+    # read only, runs while the autoscaler is toggled and the hibernation node is provisioned
+    @suspend.step()
+    def discover_deployments():
+        keep_namespaces = list(namespaces_to_keep)
+        if ctx.user_namespaces_to_keep:
+            logging.info(f'user provided namespaces_to_keep is not empty {ctx.user_namespaces_to_keep}')
+            keep_namespaces.extend(namespace.strip() for namespace in ctx.user_namespaces_to_keep.split(","))
+        logging.info(f"namespaces to keep: {keep_namespaces}")
+        return get_deployments_to_keep(client=k8s_v1_apps, namespaces=keep_namespaces)
+
+    @suspend.step(requires=("disable_autoscaler", "job_node"), checkpoint=True,
+                  decode=lambda value: HibernationNode(*value))
+    def hibernation_node(job_node):
+        catalog = read_catalog(k8s_v1, configmap_name, ns)
+        catalog.observe(get_node_inventory(cluster_id, castai_api_url, castai_api_token).items)
+        hibernate_node_types = catalog.ranked(cloud, override=ctx.hibernate_node_type_override)
+        logging.info("Hibernation node instance types in order of preference: %s", hibernate_node_types)
+
+        candidate_node = None
+        for hibernate_node_type in hibernate_node_types:
+            candidate_node = get_suitable_hibernation_node(cluster_id=cluster_id, castai_api_url=castai_api_url,
+                                                           castai_api_token=castai_api_token,
+                                                           instance_type=hibernate_node_type, cloud=cloud)
+            if candidate_node:
+                break
+
+        hibernation_node_id = None
+        if candidate_node:
+            logging.info("Found suitable hibernation candidate node: %s", candidate_node)
+            add_node_taint(client=k8s_v1, node_name=candidate_node,
+                           pause_taint=castai_pause_toleration,
+                           labels=ctx.hibernate_node_labels, informer=node_informer)
+            with metrics.phase("pause", cluster_id, "readiness_wait"):
+                hibernation_node_id = check_hibernation_node_readiness(client=k8s_v1, taint=castai_pause_toleration,
+                                                                       node_name=candidate_node,
+                                                                       informer=node_informer)
+
+        if job_node == hibernation_node_id:
+            try:
+                inventory = get_node_inventory(cluster_id, castai_api_url, castai_api_token)
+            except requests.exceptions.HTTPError as e:
+                logging.error(f"Failed to get CAST AI nodes: {e}")
+                raise
+            nodes = []
+            for node in inventory.items:
+                if node["state"]["phase"] == "ready":
+                    nodes.append(node)
+            logging.info(f'Number of READY nodes found in the cluster: {len(nodes)}')
+            if len(nodes) == 1:
+                raise StopPipeline("Hibernation node is the same as job pod node, pause job just ran, exiting")
+
+        if not hibernation_node_id:
+            logging.info("No suitable hibernation node found, should make one")
+            try:
+                with metrics.phase("pause", cluster_id, "create_node"):
+                    hibernation_node_id, hibernate_node_type = create_hibernation_node_with_fallback(
+                        cluster_id, castai_api_url, castai_api_token, instance_types=hibernate_node_types,
+                        k8s_taint=castai_pause_toleration, labels=ctx.hibernate_node_labels, cloud=cloud,
+                        on_failure=catalog.mark_failed)
+                logging.info("Hibernation node created with instance type %s", hibernate_node_type)
+            except requests.exceptions.HTTPError as e:
+                logging.error(f"Failed to create hibernation node: {e}")
+                raise
+            finally:
+                save_catalog(k8s_v1, configmap_name, ns, catalog)
+        else:
+            save_catalog(k8s_v1, configmap_name, ns, catalog)
 
-    try:
-        node_name = get_castai_node_name_by_id(cluster_id, castai_api_url, castai_api_token, hibernation_node_id)
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"Failed to get node name by ID: {e}")
-        raise
+        if not hibernation_node_id:
+            raise Exception("could not create hibernation node")
+
+        node = node_informer.by_castai_id(hibernation_node_id)
+        if node is not None:
+            node_name = node.metadata.name
+        else:
+            # a node created a moment ago may not have joined the cluster yet
+            try:
+                node_name = get_castai_node_name_by_id(cluster_id, castai_api_url, castai_api_token,
+                                                       hibernation_node_id)
+            except requests.exceptions.HTTPError as e:
+                logging.error(f"Failed to get node name by ID: {e}")
+                raise
 
-    hibernation_node_status = check_hibernation_node_readiness(client=k8s_v1, taint=castai_pause_toleration,
-                                                               node_name=node_name)
-    if hibernation_node_status:
+        with metrics.phase("pause", cluster_id, "readiness_wait"):
+            if not check_hibernation_node_readiness(client=k8s_v1, taint=castai_pause_toleration,
+                                                    node_name=node_name, informer=node_informer):
+                raise Exception("no ready hibernation node exist")
         logging.info("Hibernation node exist: %s", hibernation_node_id)
-        cordon_all_nodes(k8s_v1, protect_removal_disabled, exclude_node_id=hibernation_node_id)
-        time.sleep(20)
-    else:
-        raise Exception("no ready hibernation node exist")
-
-    for deploy in get_deployments_names_with_system_priority_class(client=k8s_v1_apps):
-        add_special_toleration(client=k8s_v1_apps, deployment=deploy, toleration=castai_pause_toleration)
-
-    if user_namespaces_to_keep:
-        logging.info(f'user provided namespaces_to_keep is not empty {user_namespaces_to_keep}')
-        for namespace in user_namespaces_to_keep.split(","):
-            namespaces_to_keep.append(namespace)
-
-    for namespace in namespaces_to_keep:
-        logging.info(f"additional namespace {namespace} to patch")
-        deploys = k8s_v1_apps.list_namespaced_deployment(namespace=namespace)
-        for deploy in deploys.items:
-            logging.info(f'Additional {namespace} deployment {deploy.metadata.name} will be patched')
-            add_special_toleration(client=k8s_v1_apps, deployment=deploy, toleration=castai_pause_toleration)
-    time.sleep(30)  # allow core dns and other critical pods to be scheduled on hibernation node
-
-    defer_job_node_deletion = False
-
-    if my_node_name_id and my_node_name_id != hibernation_node_id:
-        logging.info("Job pod node id and hibernation node is not the same")
-        delete_all_pausable_nodes(cluster_id=cluster_id, castai_api_url=castai_api_url,
-                                  castai_api_token=castai_api_token,
-                                  hibernation_node_id=hibernation_node_id,
-                                  protect_removal_disabled=protect_removal_disabled, job_node_id=my_node_name_id)
-        defer_job_node_deletion = True
-    else:
+        return HibernationNode(hibernation_node_id, node_name)
+
+    # cordon state before this run touches any node
+    @suspend.step()
+    def list_nodes():
+        return list(iter_list(k8s_v1.list_node, node_record))
+
+    # must not run again after the cordon, it would record the cordoned state
+    @suspend.step(requires=("hibernation_node", "list_nodes", "discover_deployments"), checkpoint=True)
+    def record_snapshot(hibernation_node, list_nodes, discover_deployments):
+        inventory = get_node_inventory(cluster_id, castai_api_url, castai_api_token)
+        footprint = pausable_node_footprint(inventory, hibernation_node.id, ctx.protect_removal_disabled)
+        # a repeated pause only sees the hibernation node, keep the snapshot of the first one
+        if not footprint:
+            return None
+        snapshot = build_snapshot(cluster_id, hibernation_node.id, list_nodes, discover_deployments,
+                                  castai_pause_toleration, footprint)
+        save_snapshot(client=k8s_v1, cm=configmap_name, ns=ns, snapshot=snapshot)
+        # checkpointed, rollback trusts the snapshot only when it was taken by the pause it undoes
+        return snapshot["taken_at"]
+
+    # rollback undoes the cordon from the snapshot, so it has to be saved first
+    @suspend.step(requires=("hibernation_node", "record_snapshot"), checkpoint=True)
+    def cordon_nodes(hibernation_node):
+        engine.cordon_all_nodes(k8s_v1, ctx.protect_removal_disabled, exclude_node_id=hibernation_node.id,
+                                max_workers=ctx.cordon_concurrency)
+
+    # restarted pods must only fit on the hibernation node, so patching waits for the cordon
+    @suspend.step(requires=("discover_deployments", "cordon_nodes"), checkpoint=True,
+                  decode=lambda value: [DeploymentRecord(*deployment) for deployment in value])
+    def patch_tolerations(discover_deployments):
+        toleration_summary = engine.add_special_tolerations(client=k8s_v1_apps, deployments=discover_deployments,
+                                                            toleration=castai_pause_toleration,
+                                                            max_workers=ctx.patch_concurrency)
+        return [deploy for deploy in discover_deployments if deploy.key in toleration_summary["patched"]]
+
+    # allow core dns and other critical pods to be scheduled on hibernation node
+    @suspend.step(requires=("hibernation_node", "patch_tolerations"), checkpoint=True)
+    def wait_for_workloads(hibernation_node, patch_tolerations):
+        wait_for_workloads_on_node(client=k8s_v1, deployments=patch_tolerations, node_name=hibernation_node.name,
+                                   timeout=ctx.workload_ready_timeout)
+
+    @suspend.step(requires=("job_node", "hibernation_node", "record_snapshot", "wait_for_workloads"), checkpoint=True)
+    def delete_nodes(job_node, hibernation_node):
+        if job_node and job_node != hibernation_node.id:
+            logging.info("Job pod node id and hibernation node is not the same")
+            engine.delete_all_pausable_nodes(cluster_id=cluster_id, castai_api_url=castai_api_url,
+                                             castai_api_token=castai_api_token,
+                                             hibernation_node_id=hibernation_node.id,
+                                             protect_removal_disabled=ctx.protect_removal_disabled,
+                                             job_node_id=job_node, max_workers=ctx.delete_concurrency)
+            return True
         logging.info("Delete all nodes except hibernation node")
-        delete_all_pausable_nodes(cluster_id, castai_api_url, castai_api_token, hibernation_node_id,
-                                  protect_removal_disabled)
-
-    remove_node_taint(client=k8s_v1, pause_taint=castai_pause_toleration, node_id=hibernation_node_id)
-
-    if defer_job_node_deletion:
-        logging.info("Delete jobs node with id %s:", my_node_name_id)
-        delete_all_pausable_nodes(cluster_id=cluster_id, castai_api_url=castai_api_url,
-                                  castai_api_token=castai_api_token,
-                                  hibernation_node_id=hibernation_node_id,
-                                  protect_removal_disabled=protect_removal_disabled)
+        engine.delete_all_pausable_nodes(cluster_id, castai_api_url, castai_api_token, hibernation_node.id,
+                                         ctx.protect_removal_disabled, max_workers=ctx.delete_concurrency)
+        return False
+
+    @suspend.step(requires=("hibernation_node", "delete_nodes"), checkpoint=True)
+    def remove_taint(hibernation_node):
+        remove_node_taint(client=k8s_v1, pause_taint=castai_pause_toleration, node_id=hibernation_node.id,
+                          informer=node_informer)
+
+    @suspend.step(requires=("job_node", "hibernation_node", "delete_nodes", "remove_taint"), checkpoint=True)
+    def delete_job_node(job_node, hibernation_node, delete_nodes):
+        if delete_nodes:
+            logging.info("Delete jobs node with id %s:", job_node)
+            # not waiting for the drain, it evicts this pod before the run could record its status
+            engine.delete_all_pausable_nodes(cluster_id=cluster_id, castai_api_url=castai_api_url,
+                                             castai_api_token=castai_api_token,
+                                             hibernation_node_id=hibernation_node.id,
+                                             protect_removal_disabled=ctx.protect_removal_disabled,
+                                             max_workers=ctx.delete_concurrency, wait_operations=False)
+
+    @suspend.step(requires=("delete_job_node",), checkpoint=True)
+    def check_cluster_ready():
+        if cluster_ready(cluster_id=cluster_id, castai_api_url=castai_api_url, castai_api_token=castai_api_token):
+            logging.info(f"cluster ready, updating last run status to success.")
+            update_last_run_status(client=k8s_v1, cm=configmap_name, ns=ns, status="success")
+            logging.info("Pause operation completed.")
+        else:
+            update_last_run_status(client=k8s_v1, cm=configmap_name, ns=ns, status="cluster-not-ready")
+            raise Exception("Pause finished, but cluster is not ready")
 
-    if cluster_ready(cluster_id=cluster_id, castai_api_url=castai_api_url, castai_api_token=castai_api_token):
-        logging.info(f"cluster ready, updating last run status to success.")
-        update_last_run_status(client=k8s_v1, cm=configmap_name, ns=ns, status="success")
-        logging.info("Pause operation completed.")
-    else:
-        update_last_run_status(client=k8s_v1, cm=configmap_name, ns=ns, status="cluster-not-ready")
-        raise Exception("Pause finished, but cluster is not ready")
+    try:
+        suspend.run()
+    finally:
+        suspend.log_timings()
+        metrics.record_pipeline(suspend, "pause", cluster_id)
+    checkpoint.clear()
+    if suspend.stopped_by:
+        return 0
 
 
 def get_cloud_provider(cluster_id: str, castai_api_url: str, castai_api_token: str):
@@ -248,9 +380,236 @@ def get_cloud_provider(cluster_id: str, castai_api_url: str, castai_api_token: s
     return os.environ["CLOUD"]
 
 
+def log_pre_pause_snapshot(snapshot: dict):
+    """ state recorded before the failed pause, what rollback has to restore"""
+    logging.info("Pre-pause snapshot from %s: %s nodes (%s cordoned), %s kept deployments (%s tolerating)",
+                 snapshot["taken_at"], len(snapshot["nodes"]),
+                 sum(node["unschedulable"] for node in snapshot["nodes"]), len(snapshot["deployments"]),
+                 sum(deployment["tolerates"] for deployment in snapshot["deployments"]))
+
+
+def handle_rollback(ctx: AppContext, enable_autoscaler=True):
+    """ Undo a failed pause in parallel: enable the autoscaler, uncordon the nodes the pause cordoned, remove the
+    pause taint and revert the tolerations it added, so surviving nodes take workloads again within seconds.
+    Resume runs it without the autoscaler step for a pause that never finished."""
+    from k8s_utils import ConfigMapCheckpoint, remove_pause_taints, remove_special_tolerations, uncordon_nodes
+    from snapshot import read_snapshot
+
+    k8s_v1 = ctx.k8s_v1
+    rollback = Pipeline("rollback")
+
+    @rollback.step()
+    def pause_record():
+        completed = ConfigMapCheckpoint(k8s_v1, configmap_name, ns, suspend_checkpoint_key).load()
+        snapshot = read_snapshot(client=k8s_v1, cm=configmap_name, ns=ns)
+        # an older snapshot belongs to another pause, this one failed before it cordoned or patched anything
+        if not snapshot or snapshot["taken_at"] != completed.get("record_snapshot"):
+            logging.info("Failed pause recorded no snapshot, no nodes or deployments to restore")
+            return None
+        log_pre_pause_snapshot(snapshot)
+        return snapshot
+
+    # the undone pause must not be continued by the next run, the checkpoint is read first
+    @rollback.step(requires=("pause_record",))
+    def discard_checkpoint():
+        discard_suspend_checkpoint(ctx)
+
+    if enable_autoscaler:
+        @rollback.step(name="enable_autoscaler")
+        def enable():
+            enable_cluster_autoscaler(ctx)
+
+    @rollback.step(requires=("pause_record",))
+    def uncordon(pause_record):
+        if not pause_record:
+            return
+        schedulable = {node["name"] for node in pause_record["nodes"] if not node["unschedulable"]}
+        cordoned = ctx.node_informer.find(lambda node: node.spec.unschedulable and node.metadata.name in schedulable)
+        uncordon_nodes(k8s_v1, [node.metadata.name for node in cordoned], max_workers=ctx.cordon_concurrency)
+
+    # only pause adds this taint, a node that still has it after a failed pause is its hibernation node
+    @rollback.step()
+    def remove_taint():
+        remove_pause_taints(k8s_v1, castai_pause_toleration, ctx.node_informer, max_workers=ctx.cordon_concurrency)
+
+    @rollback.step(requires=("pause_record",))
+    def revert_tolerations(pause_record):
+        if not pause_record:
+            return
+        keys = [deployment["key"] for deployment in pause_record["deployments"] if not deployment["tolerates"]]
+        remove_special_tolerations(ctx.k8s_v1_apps, keys, castai_pause_toleration, max_workers=ctx.patch_concurrency)
+
+    try:
+        rollback.run()
+    finally:
+        rollback.log_timings()
+        metrics.record_pipeline(rollback, "rollback", ctx.cluster_id)
+
+
+def _is_async_retryable(err: BaseException) -> bool:
+    """ errors of the async engine, it can only have raised them when it was loaded"""
+    aio = sys.modules.get("aio")
+    return aio is not None and aio.available() and aio._is_retryable(err)
+
+
+def is_transient_error(err: BaseException) -> bool:
+    """ API throttling, server errors and network failures, directly or as the cause of a wrapping error.
+
+    A fan-out stage error (cordon, toleration patching, node deletion) is transient when every item failed that way.
+    """
+    while err is not None:
+        if _is_retryable_error(err) or _is_async_retryable(err):
+            return True
+        errors = getattr(err, "errors", None)
+        if errors:
+            return all(is_transient_error(item_error) for item_error in errors.values())
+        err = err.__cause__
+    return False
+
+
+def run_action(ctx: AppContext, cloud, action):
+    from lease import LeaseLock  # deferred, it loads the kubernetes client
+    started = time.monotonic()
+    outcome = "failed"
+    # pause and resume runs of this cluster, from Jobs or controller replicas, never overlap
+    lock = LeaseLock(ctx.k8s_coordination, run_lock_name, ns, action=action, identity=ctx.run_lock_identity)
+    with metrics.call_ledger() as ledger:
+        try:
+            if not lock.acquire(timeout=ctx.run_lock_wait):
+                if lock.holder_action == action:
+                    logging.info("Another %s run holds the run lock, exiting", action)
+                    outcome = "skipped"
+                    return
+                raise Exception(f"{lock.holder_action} run {lock.holder} still holds the run lock after "
+                                f"{ctx.run_lock_wait}s")
+
+            if action == "resume":
+                # resume only enables the autoscaler and adds missing nodes, a run that lost the lock to another
+                # resume repeats that harmlessly and a pause that took it over disables the autoscaler after it
+                handle_resume(ctx)
+                outcome = "ok"
+                return
+
+            try:
+                # a run that lost the lock stops before its next step, the new holder continues the pause
+                handle_suspend(ctx, cloud, guard=lock.check)
+                outcome = "ok"
+                return True
+            except BaseException as err:
+                from k8s_utils import update_last_run_status
+                if lock.lost:
+                    logging.error(f"Hibernation stopped, another run took the run lock over: {err}")
+                    outcome = "lock_lost"
+                    raise
+                if is_transient_error(err):
+                    # undoing the pause would throw away node creation and cordoning, the Job retry continues it
+                    logging.error(f"Hibernation interrupted by a transient error, the next run continues from the "
+                                  f"checkpoint: {err}")
+                    update_last_run_status(client=ctx.k8s_v1, cm=configmap_name, ns=ns, status="interrupted")
+                    outcome = "interrupted"
+                    raise
+                logging.info("Hibernation failed, rolling the cluster back")
+                handle_rollback(ctx)
+                update_last_run_status(client=ctx.k8s_v1, cm=configmap_name, ns=ns, status="exception")
+                outcome = "rolled_back"
+                return False
+        finally:
+            lock.release()
+            ledger.log_summary()
+            metrics.record_run(action, ctx.cluster_id, outcome, time.monotonic() - started)
+            metrics.export(textfile=os.environ.get("METRICS_TEXTFILE"), pushgateway_url=os.environ.get("PUSHGATEWAY_URL"))
+
+
+def unfinished_pause(ctx: AppContext, schedules: dict, now: datetime) -> bool:
+    """ a pause checkpoint is left and the cluster is still due to stay paused, the next slot is a resume"""
+    if schedules["resume"].next_after(now) > schedules["pause"].next_after(now):
+        return False
+    return bool(load_suspend_checkpoint(ctx))
+
+
+def continue_unfinished_pause(ctx: AppContext, cloud, schedules: dict, initial_backoff: float = 30,
+                              max_backoff: float = 900):
+    """ a pause cut short by a crash, a transient error or by the pause deleting the controller's own node is not
+    left for tomorrow, it is retried with backoff until it finishes or the resume is due"""
+    failures = 0
+    while unfinished_pause(ctx, schedules, datetime.now(timezone.utc)):
+        logging.info("Continuing the interrupted pause")
+        try:
+            return run_action(ctx, cloud, "pause")
+        except Exception as err:
+            failures += 1
+            until_resume = (schedules["resume"].next_after(datetime.now(timezone.utc)) -
+                            datetime.now(timezone.utc)).total_seconds()
+            delay = max(0, min(initial_backoff * 2 ** (failures - 1), max_backoff, until_resume))
+            logging.error(f"continuing the interrupted pause failed, retrying in {delay:.0f}s: {err}")
+            time.sleep(delay)
+    return None
+
+
+def run_controller(ctx: AppContext, cloud):
+    """ Long running mode, pause and resume on in-process cron schedules with warm clients and caches"""
+    schedules = {
+        "pause": CronSchedule(os.environ["PAUSE_SCHEDULE"], ctx.schedule_timezone),
+        "resume": CronSchedule(os.environ["RESUME_SCHEDULE"], ctx.schedule_timezone),
+    }
+    logging.info("Controller started, pause: '%s', resume: '%s', time zone: %s",
+                 schedules["pause"].expression, schedules["resume"].expression, ctx.schedule_timezone)
+
+    continue_unfinished_pause(ctx, cloud, schedules)
+
+    while True:
+        now = datetime.now(timezone.utc)
+        next_action, next_run = min(((name, schedule.next_after(now)) for name, schedule in schedules.items()),
+                                    key=lambda item: item[1])
+        logging.info("Next action %s at %s", next_action, next_run.isoformat())
+        # sleep in short steps so clock jumps and suspended nodes do not delay the run
+        remaining = (next_run - datetime.now(timezone.utc)).total_seconds()
+        while remaining > 0:
+            time.sleep(min(remaining, 60))
+            remaining = (next_run - datetime.now(timezone.utc)).total_seconds()
+
+        logging.info("Running scheduled action %s", next_action)
+        try:
+            run_action(ctx, cloud, next_action)
+        except Exception as err:
+            logging.error(f"scheduled action {next_action} failed: {err}")
+            if next_action == "pause":
+                continue_unfinished_pause(ctx, cloud, schedules)
+
+
+def run_cluster(ctx: AppContext, action):
+    """ one cluster of a fleet run, the cloud comes from the clusters file or is detected"""
+    cloud = ctx.cloud or get_cloud_provider(ctx.cluster_id, ctx.castai_api_url, ctx.castai_api_token)
+    logging.info("Hibernation input parameters clusterId: %s, cloud: %s, action: %s", ctx.cluster_id, cloud, action)
+    return run_action(ctx, cloud, action)
+
+
+def main_fleet(clusters_file: str):
+    from fleet import ClusterTagFilter, load_fleet, run_fleet
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(ClusterTagFilter())
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(cluster)s] %(message)s"))
+
+    action = os.environ["ACTION"]
+    if action not in ("pause", "resume"):
+        raise ValueError(f"multi-cluster mode runs pause or resume, not {action}")
+    contexts = load_fleet(clusters_file, action)
+    logging.info("Starting hibernate %s for %s clusters", action, len(contexts))
+    return run_fleet(contexts, action, run_cluster, max_workers=int(os.environ.get("FLEET_CONCURRENCY", "4")))
+
+
 def main():
+    # rate limits are per process, in multi-cluster mode all clusters share them
+    for endpoint_class, (rate, burst) in parse_rate_limits(os.environ.get("RATE_LIMITS", "")).items():
+        set_rate_limit(endpoint_class, rate, burst)
+
+    if os.environ.get("CLUSTERS_FILE"):
+        return main_fleet(os.environ["CLUSTERS_FILE"])
+
+    logging.info("Starting hibernate")
+    ctx = get_context()
     try:
-        cloud = get_cloud_provider(cluster_id, castai_api_url, castai_api_token)
+        cloud = get_cloud_provider(ctx.cluster_id, ctx.castai_api_url, ctx.castai_api_token)
     except requests.exceptions.HTTPError:
         logging.error("could not detect cloud provider, check API key or network problems")
         exit(1)
@@ -263,20 +622,15 @@ def main():
         exit(1)
 
     logging.info("Hibernation input parameters clusterId: %s, cloud: %s, action: %s",
-                 cluster_id, cloud, action)
+                 ctx.cluster_id, cloud, ctx.action)
 
-    if action == "resume":
-        return handle_resume()
-
-    try:
-        handle_suspend(cloud)
-    except:
-        logging.info("Hibernation failed, resuming cluster")
-        handle_resume()
-        update_last_run_status(client=k8s_v1, cm=configmap_name, ns=ns, status="exception")
+    if ctx.action == "controller":
+        return run_controller(ctx, cloud)
+    return run_action(ctx, cloud, ctx.action)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(format="%(asctime)s %(message)s", level=get_logging_level(), handlers=[logging.StreamHandler()])
     try:
         main()
     except Exception as err:
@@ -0,0 +1,269 @@
+"""Run metrics in Prometheus text exposition format.
+
+Written to a node_exporter textfile (METRICS_TEXTFILE) and/or pushed to a Pushgateway (PUSHGATEWAY_URL) after
+every run. No client library, the format is plain text:
+https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+import contextvars
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._samples(dict(zip(self.labelnames, key)), value))
+        return lines
+
+    def _samples(self, labels: dict, value) -> list:
+        return [f"{self.name}{_format_labels(labels)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, observed = self._values.get(key, ((0,) * len(self.buckets), 0.0, 0))
+            counts = tuple(count + (value <= bound) for count, bound in zip(counts, self.buckets))
+            self._values[key] = (counts, total + value, observed + 1)
+
+    def _samples(self, labels: dict, value) -> list:
+        counts, total, observed = value
+        lines = [f"{self.name}_bucket{_format_labels(dict(labels, le=bound))} {count}"
+                 for bound, count in zip(self.buckets, counts)]
+        lines.append(f'{self.name}_bucket{_format_labels(dict(labels, le="+Inf"))} {observed}')
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {observed}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+RUNS = REGISTRY.register(Counter(
+    "hibernate_runs_total", "Pause and resume runs by outcome.", ("action", "cluster", "outcome")))
+RUN_DURATION = REGISTRY.register(Histogram(
+    "hibernate_run_duration_seconds", "Duration of pause and resume runs.", ("action", "cluster")))
+LAST_RUN = REGISTRY.register(Gauge(
+    "hibernate_last_run_timestamp_seconds", "Unix time the last run finished.", ("action", "cluster", "outcome")))
+PHASE_DURATION = REGISTRY.register(Histogram(
+    "hibernate_phase_duration_seconds", "Duration of each phase of a run.", ("action", "cluster", "phase", "outcome")))
+API_REQUESTS = REGISTRY.register(Counter(
+    "hibernate_api_requests_total", "Requests to CAST AI and Kubernetes APIs by endpoint and status code.",
+    ("api", "method", "endpoint", "code")))
+RETRIES = REGISTRY.register(Counter(
+    "hibernate_retries_total", "Retried calls by function.", ("function",)))
+
+
+@contextmanager
+def phase(action: str, cluster: str, name: str):
+    """ time the block as one phase of a run, the outcome label tells failed phases apart"""
+    started = time.monotonic()
+    outcome = "failed"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        PHASE_DURATION.observe(time.monotonic() - started, action=action, cluster=cluster, phase=name,
+                               outcome=outcome)
+
+
+def record_pipeline(pipeline, action: str, cluster: str):
+    """ one phase sample per step the pipeline ran"""
+    for name, timing in pipeline.timings.items():
+        if name in pipeline.failed:
+            outcome = "failed"
+        elif name == pipeline.stopped_by:
+            outcome = "stopped"
+        else:
+            outcome = "ok"
+        PHASE_DURATION.observe(timing.duration, action=action, cluster=cluster, phase=name, outcome=outcome)
+
+
+def record_run(action: str, cluster: str, outcome: str, seconds: float):
+    RUNS.inc(action=action, cluster=cluster, outcome=outcome)
+    RUN_DURATION.observe(seconds, action=action, cluster=cluster)
+    LAST_RUN.set(time.time(), action=action, cluster=cluster, outcome=outcome)
+
+
+_ID_SEGMENT = re.compile(r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)$", re.IGNORECASE)
+
+
+def endpoint_template(path: str) -> str:
+    """ request path with ids replaced, keeps the endpoint label set small"""
+    path = path.split("?", 1)[0]
+    return "/".join("{id}" if _ID_SEGMENT.match(segment) else segment for segment in path.split("/"))
+
+
+class CallLedger:
+    """ API calls of one run by api, method and endpoint: count, errors, bytes and latency"""
+
+    def __init__(self):
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def record(self, api: str, method: str, endpoint: str, code, seconds: float, sent: int, received: int):
+        with self._lock:
+            entry = self.calls.setdefault((api, method, endpoint), {
+                "count": 0, "errors": 0, "bytes_sent": 0, "bytes_received": 0, "seconds": 0.0, "max_seconds": 0.0})
+            entry["count"] += 1
+            entry["errors"] += code == "error" or int(code) >= 400
+            entry["bytes_sent"] += sent
+            entry["bytes_received"] += received
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+    def count(self, api: str = None, method: str = None, endpoint: str = None) -> int:
+        """ calls matching every given field"""
+        with self._lock:
+            return sum(entry["count"] for (a, m, e), entry in self.calls.items()
+                       if api in (None, a) and method in (None, m) and endpoint in (None, e))
+
+    def summary(self) -> dict:
+        """ totals per api, plus the endpoints by call count"""
+        with self._lock:
+            calls = {key: dict(entry) for key, entry in self.calls.items()}
+        totals = {}
+        for (api, _, _), entry in calls.items():
+            total = totals.setdefault(api, {"count": 0, "errors": 0, "bytes_sent": 0, "bytes_received": 0,
+                                            "seconds": 0.0})
+            for field in total:
+                total[field] += entry[field]
+        endpoints = [dict(entry, api=api, method=method, endpoint=endpoint)
+                     for (api, method, endpoint), entry in sorted(calls.items(), key=lambda item: -item[1]["count"])]
+        return {"totals": totals, "endpoints": endpoints}
+
+    def log_summary(self, top: int = 10):
+        summary = self.summary()
+        for api, total in sorted(summary["totals"].items()):
+            logging.info("%s API calls: %s, errors %s, sent %s bytes, received %s bytes, %.1fs waiting", api,
+                         total["count"], total["errors"], total["bytes_sent"], total["bytes_received"],
+                         total["seconds"])
+        for entry in summary["endpoints"][:top]:
+            logging.info("  %5s %-6s %s %s, avg %.0fms, max %.0fms", entry["count"], entry["method"], entry["api"],
+                         entry["endpoint"], entry["seconds"] / entry["count"] * 1000, entry["max_seconds"] * 1000)
+
+
+_call_ledger = contextvars.ContextVar("call_ledger", default=None)
+
+
+@contextmanager
+def call_ledger():
+    """ collect the API calls made in this context, threads started with a copy of it included"""
+    ledger = CallLedger()
+    token = _call_ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        _call_ledger.reset(token)
+
+
+def count_request(api: str, method: str, endpoint: str, code, seconds: float = 0.0, sent: int = 0,
+                  received: int = 0):
+    API_REQUESTS.inc(api=api, method=method, endpoint=endpoint, code=code)
+    ledger = _call_ledger.get()
+    if ledger is not None:
+        ledger.record(api, method, endpoint, code, seconds, sent, received)
+
+
+def write_textfile(path: str, registry: Registry = REGISTRY):
+    """ replace the file atomically, node_exporter must never read a partial file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, prefix=".hibernate-", suffix=".prom", delete=False) as f:
+        f.write(registry.render())
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+
+
+def push(pushgateway_url: str, job: str = "hibernate", registry: Registry = REGISTRY, timeout: float = 10):
+    """ replace the metrics of the job group on a Pushgateway"""
+    resp = requests.put(f"{pushgateway_url.rstrip('/')}/metrics/job/{job}", data=registry.render().encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4"}, timeout=timeout)
+    resp.raise_for_status()
+
+
+def export(textfile: str = None, pushgateway_url: str = None):
+    """ best effort, a metrics outage must not fail pause or resume"""
+    if textfile:
+        try:
+            write_textfile(textfile)
+        except OSError as err:
+            logging.warning(f"could not write metrics to {textfile}: {err}")
+    if pushgateway_url:
+        try:
+            push(pushgateway_url)
+        except requests.exceptions.RequestException as err:
+            logging.warning(f"could not push metrics to {pushgateway_url}: {err}")
@@ -0,0 +1,174 @@
+import contextvars
+import inspect
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, NamedTuple
+
+
+class StopPipeline(Exception):
+    """ raised by a step to end the run early without error, steps already running are allowed to finish"""
+
+
+class PipelineError(Exception):
+    pass
+
+
+class Step(NamedTuple):
+    name: str
+    func: Callable
+    requires: tuple
+    checkpoint: bool = False
+    decode: Callable = None
+
+
+class StepTiming(NamedTuple):
+    start: float
+    end: float
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Pipeline:
+    """ Named steps with declared dependencies, independent steps run in parallel threads.
+
+    A step function receives the results of the steps it requires as keyword arguments named after them.
+
+    With a checkpoint store (load() -> {step: result}, save(completed, running)) the JSON results of checkpointed
+    steps are saved as they finish, and a later run restores them instead of running those steps again. Steps that
+    are not checkpointed run again when a step still to run needs them.
+
+    guard() is called before steps are started, an exception it raises fails the run like a step error.
+    """
+
+    def __init__(self, name: str, checkpoint=None, guard: Callable = None):
+        self.name = name
+        self.checkpoint = checkpoint
+        self.guard = guard
+        self.steps = {}
+        self.results = {}
+        self.timings = {}
+        self.failed = []
+        self.stopped_by = None
+        self.restored = []
+        self._completed = {}
+        self._saved = None
+
+    def step(self, name: str = None, requires=(), checkpoint: bool = False, decode: Callable = None):
+        """ decorator registering a function as a step, the name defaults to the function name.
+
+        The result of a checkpoint step must be JSON serializable, decode(value) rebuilds it from the JSON.
+        """
+        def register(func):
+            step_name = name or func.__name__
+            if step_name in self.steps:
+                raise PipelineError(f"duplicate step {step_name}")
+            for dependency in requires:
+                if dependency not in self.steps:
+                    raise PipelineError(f"step {step_name} requires unknown step {dependency}")
+            self.steps[step_name] = Step(step_name, func, tuple(requires), checkpoint, decode)
+            return func
+        return register
+
+    def _call(self, step: Step, started: float):
+        start = time.monotonic() - started
+        try:
+            kwargs = {name: self.results[name] for name in step.requires
+                      if name in inspect.signature(step.func).parameters}
+            return step.func(**kwargs)
+        finally:
+            self.timings[step.name] = StepTiming(start, time.monotonic() - started)
+
+    def _restore(self, pending: dict):
+        """ take results of checkpointed steps from the last unfinished run, drop steps nothing needs anymore"""
+        for name, value in self.checkpoint.load().items():
+            step = self.steps.get(name)
+            if step is None or not step.checkpoint:
+                continue
+            self.results[name] = step.decode(value) if step.decode else value
+            self._completed[name] = value
+            self.restored.append(name)
+            del pending[name]
+        if not self.restored:
+            return
+        needed = {name for name, step in pending.items() if step.checkpoint}
+        for name in reversed(list(self.steps)):
+            if name in needed:
+                needed.update(dependency for dependency in self.steps[name].requires if dependency in pending)
+        for name in [name for name in pending if name not in needed]:
+            del pending[name]
+        logging.info("%s: continuing from checkpoint, already done: %s", self.name, ", ".join(self.restored))
+
+    def _save(self, running: dict):
+        state = (sorted(self._completed), sorted(step.name for step in running.values()))
+        if state != self._saved:
+            self.checkpoint.save(self._completed, state[1])
+            self._saved = state
+
+    def run(self) -> dict:
+        """ run every step once its requirements are done, first step error is raised after running steps end"""
+        started = time.monotonic()
+        pending = dict(self.steps)
+        running = {}
+        error = None
+        if self.checkpoint is not None:
+            self._restore(pending)
+        with ThreadPoolExecutor(max_workers=max(1, len(self.steps)), thread_name_prefix=self.name) as executor:
+            while True:
+                if error is None and self.stopped_by is None and self.guard is not None:
+                    try:
+                        self.guard()
+                    except Exception as err:
+                        logging.error(f"{self.name}: stopped before starting more steps: {err}")
+                        error = err
+                if error is None and self.stopped_by is None:
+                    for step in [step for step in pending.values()
+                                 if all(name in self.results for name in step.requires)]:
+                        logging.debug("%s: starting step %s", self.name, step.name)
+                        running[executor.submit(contextvars.copy_context().run, self._call, step, started)] = step
+                        del pending[step.name]
+                if self.checkpoint is not None:
+                    self._save(running)
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        self.results[step.name] = future.result()
+                        if step.checkpoint:
+                            self._completed[step.name] = self.results[step.name]
+                    except StopPipeline as stop:
+                        logging.info("%s: step %s ended the run early: %s", self.name, step.name, stop)
+                        self.stopped_by = step.name
+                    except Exception as err:
+                        logging.error(f"{self.name}: step {step.name} failed: {err}")
+                        self.failed.append(step.name)
+                        error = error or err
+        if error is not None:
+            raise error
+        if pending and self.stopped_by is None:
+            raise PipelineError(f"steps never became runnable: {', '.join(pending)}")
+        return self.results
+
+    def critical_path(self) -> list:
+        """ chain of finished steps that determined the total run time, each waiting on the latest requirement"""
+        if not self.timings:
+            return []
+        path = [max(self.timings, key=lambda name: self.timings[name].end)]
+        while True:
+            requires = [name for name in self.steps[path[-1]].requires if name in self.timings]
+            if not requires:
+                return list(reversed(path))
+            path.append(max(requires, key=lambda name: self.timings[name].end))
+
+    def log_timings(self):
+        critical = self.critical_path()
+        for name, timing in sorted(self.timings.items(), key=lambda item: item[1].start):
+            logging.info("%s step %-20s start %7.1fs duration %7.1fs%s", self.name, name, timing.start,
+                         timing.duration, " (critical path)" if name in critical else "")
+        if critical:
+            logging.info("%s critical path: %s, %.1fs", self.name, " -> ".join(critical),
+                         self.timings[critical[-1]].end)
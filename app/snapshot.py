@@ -0,0 +1,126 @@
+import base64
+import gzip
+import hashlib
+import json
+import logging
+from datetime import datetime
+
+from kubernetes import client as rawclient
+from kubernetes.client.rest import ApiException
+
+from k8s_utils import deployment_tolerates
+from utils import basic_retry
+
+SNAPSHOT_VERSION = 1
+# raw bytes per chunk ConfigMap, base64 grows it by a third, the API server limit is 1 MiB per object
+CHUNK_SIZE = 512 * 1024
+META_KEY = "snapshot_meta"
+PROVISIONED_KEY = "snapshot_provisioned"
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def build_snapshot(cluster_id: str, hibernation_node_id: str, nodes: list, deployments: list, toleration: str,
+                   footprint: list) -> dict:
+    """ pre-pause state: cordon state of every node, toleration and replicas of every kept Deployment"""
+    return {
+        "version": SNAPSHOT_VERSION,
+        "taken_at": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "cluster_id": cluster_id,
+        "hibernation_node_id": hibernation_node_id,
+        "nodes": [{"name": node.name, "castai_id": node.labels.get("provisioner.cast.ai/node-id"),
+                   "unschedulable": node.unschedulable} for node in nodes],
+        "deployments": [{"key": deployment.key, "replicas": deployment.replicas,
+                         "tolerates": deployment_tolerates(deployment, toleration)} for deployment in deployments],
+        "footprint": footprint,
+    }
+
+
+def encode_snapshot(snapshot: dict, chunk_size: int = CHUNK_SIZE):
+    """ gzip compressed JSON split into chunks, returns (meta, chunks)"""
+    payload = gzip.compress(json.dumps(snapshot, separators=(",", ":")).encode(), compresslevel=6)
+    chunks = [payload[start:start + chunk_size] for start in range(0, len(payload), chunk_size)] or [b""]
+    meta = {"version": SNAPSHOT_VERSION, "encoding": "gzip", "chunks": len(chunks), "size": len(payload),
+            "sha256": hashlib.sha256(payload).hexdigest(), "taken_at": snapshot.get("taken_at")}
+    return meta, chunks
+
+
+def decode_snapshot(meta: dict, chunks: list) -> dict:
+    if meta.get("version") != SNAPSHOT_VERSION or meta.get("encoding") != "gzip":
+        raise SnapshotError(f"unsupported snapshot version {meta.get('version')} encoding {meta.get('encoding')}")
+    payload = b"".join(chunks)
+    if hashlib.sha256(payload).hexdigest() != meta.get("sha256"):
+        raise SnapshotError("snapshot checksum mismatch, chunks are incomplete or from another snapshot")
+    return json.loads(gzip.decompress(payload))
+
+
+def chunk_config_map_name(cm: str, index: int) -> str:
+    return f"{cm}-snapshot-{index}"
+
+
+def _read_meta(client, cm: str, ns: str):
+    config_map = client.read_namespaced_config_map(name=cm, namespace=ns)
+    return json.loads((config_map.data or {}).get(META_KEY) or "{}"), config_map.data or {}
+
+
+def _write_chunk(client, cm: str, ns: str, index: int, chunk: bytes):
+    name = chunk_config_map_name(cm, index)
+    body = rawclient.V1ConfigMap(
+        metadata=rawclient.V1ObjectMeta(name=name, labels={"castai-hibernate/snapshot-of": cm}),
+        binary_data={"chunk": base64.b64encode(chunk).decode()})
+    try:
+        client.replace_namespaced_config_map(name=name, namespace=ns, body=body)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        client.create_namespaced_config_map(namespace=ns, body=body)
+
+
+@basic_retry(attempts=3, pause=15)
+def save_snapshot(client, cm: str, ns: str, snapshot: dict, chunk_size: int = CHUNK_SIZE):
+    """ write chunk ConfigMaps first, then the meta in the state ConfigMap, so readers never see a partial snapshot"""
+    meta, chunks = encode_snapshot(snapshot, chunk_size)
+    previous, _ = _read_meta(client, cm, ns)
+    for index, chunk in enumerate(chunks):
+        _write_chunk(client, cm, ns, index, chunk)
+    client.patch_namespaced_config_map(name=cm, namespace=ns, body={"data": {META_KEY: json.dumps(meta)}})
+    for index in range(len(chunks), previous.get("chunks", 0)):
+        try:
+            client.delete_namespaced_config_map(name=chunk_config_map_name(cm, index), namespace=ns)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+    logging.info("saved pre-pause snapshot, %s bytes compressed in %s chunks", meta["size"], meta["chunks"])
+    return meta
+
+
+@basic_retry(attempts=3, pause=15)
+def read_snapshot(client, cm: str, ns: str):
+    """ last pre-pause snapshot, None when pause never recorded one"""
+    try:
+        meta, _ = _read_meta(client, cm, ns)
+    except ApiException as e:
+        if e.status == 404:
+            return None
+        raise
+    if not meta:
+        return None
+    chunks = []
+    for index in range(meta["chunks"]):
+        config_map = client.read_namespaced_config_map(name=chunk_config_map_name(cm, index), namespace=ns)
+        chunks.append(base64.b64decode((config_map.binary_data or {}).get("chunk", "")))
+    return decode_snapshot(meta, chunks)
+
+
+@basic_retry(attempts=3, pause=15)
+def snapshot_provisioned(client, cm: str, ns: str, snapshot: dict) -> bool:
+    """ whether resume already provisioned the footprint of this snapshot"""
+    _, data = _read_meta(client, cm, ns)
+    return data.get(PROVISIONED_KEY) == snapshot.get("taken_at")
+
+
+@basic_retry(attempts=3, pause=15)
+def mark_snapshot_provisioned(client, cm: str, ns: str, snapshot: dict):
+    client.patch_namespaced_config_map(name=cm, namespace=ns, body={"data": {PROVISIONED_KEY: snapshot["taken_at"]}})
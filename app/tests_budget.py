@@ -0,0 +1,99 @@
+"""API call budgets of pause and resume as a function of cluster size, run against the fake APIs in fakes.py.
+
+A change that makes a run issue O(n²) calls, or repeats a whole-cluster list per node, fails here:
+
+    python -m pytest -q tests_budget.py
+"""
+import logging
+
+import pytest
+
+import metrics
+from fakes import FakeCluster
+from main import handle_resume, handle_suspend
+
+SIZES = (10, 50, 200)
+
+# calls per node plus a fixed overhead, a pause deletes every node and cordons it, a resume creates every node
+PAUSE_BUDGET = (4, 60)
+RESUME_BUDGET = (3, 40)
+
+
+def run_cluster(size: int) -> dict:
+    """ call ledgers of one pause and one resume of a fresh fake cluster"""
+    cluster = FakeCluster(nodes=size, deployments=size, operation_latency=0.05, pod_start_latency=0.05).start()
+    ctx = cluster.context(delete_concurrency=50, cordon_concurrency=50, patch_concurrency=50,
+                          provision_concurrency=50)
+    try:
+        with metrics.call_ledger() as pause:
+            handle_suspend(ctx, "EKS")
+        assert len(cluster.nodes) == 1
+        with metrics.call_ledger() as resume:
+            handle_resume(ctx)
+        assert len(cluster.nodes) == size + 1
+    finally:
+        ctx.node_informer.stop()
+        cluster.stop()
+    pause.log_summary()
+    resume.log_summary()
+    return {"pause": pause, "resume": resume}
+
+
+@pytest.fixture(scope="module")
+def ledgers():
+    logging.getLogger().setLevel(logging.WARNING)
+    return {size: run_cluster(size) for size in SIZES}
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_pause_budget(ledgers, size):
+    per_node, overhead = PAUSE_BUDGET
+    assert ledgers[size]["pause"].count() <= per_node * size + overhead
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_resume_budget(ledgers, size):
+    per_node, overhead = RESUME_BUDGET
+    assert ledgers[size]["resume"].count() <= per_node * size + overhead
+
+
+@pytest.mark.parametrize("action,budget", [("pause", PAUSE_BUDGET), ("resume", RESUME_BUDGET)])
+def test_calls_grow_linearly(ledgers, action, budget):
+    small, large = SIZES[0], SIZES[-1]
+    extra_calls = ledgers[large][action].count() - ledgers[small][action].count()
+    assert extra_calls <= budget[0] * (large - small)
+
+
+WHOLE_CLUSTER_LISTS = (
+    ("castai", "GET", "/v1/kubernetes/external-clusters/{id}/nodes"),
+    ("kubernetes", "GET", "/api/v1/nodes"),
+    ("kubernetes", "GET", "/apis/apps/v1/deployments"),
+)
+
+
+@pytest.mark.parametrize("action", ("pause", "resume"))
+def test_whole_cluster_lists_do_not_grow(ledgers, action):
+    """ lists are paginated by 500, below that every size must list the cluster the same number of times"""
+    for endpoint in WHOLE_CLUSTER_LISTS:
+        counts = [ledgers[size][action].count(*endpoint) for size in SIZES]
+        assert counts == [counts[0]] * len(SIZES), endpoint
+        assert counts[0] <= 3, endpoint
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_one_call_per_node_operation(ledgers, size):
+    pause, resume = ledgers[size]["pause"], ledgers[size]["resume"]
+    assert pause.count("castai", "DELETE", "/v1/kubernetes/external-clusters/{id}/nodes/{id}") == size
+    assert pause.count("kubernetes", "PATCH", "/api/v1/nodes/{name}") <= size + 2
+    assert resume.count("castai", "POST", "/v1/kubernetes/external-clusters/{id}/nodes") == size
+
+
+def test_ledger_records_bytes_and_latency(ledgers):
+    totals = ledgers[SIZES[-1]]["pause"].summary()["totals"]
+    # no CAST AI call fails, Kubernetes errors are not checked: snapshot chunks are written with
+    # replace-or-create and the first replace of each chunk is an expected 404
+    assert totals["castai"]["errors"] == 0
+    for api in ("castai", "kubernetes"):
+        assert totals[api]["bytes_received"] > 0
+        assert totals[api]["seconds"] > 0
+    assert totals["kubernetes"]["bytes_sent"] > 0
@@ -0,0 +1,62 @@
+"""Ranking of hibernation node instance types by what ran in the cluster and what failed recently:
+
+    python -m pytest -q tests_catalog.py
+"""
+from catalog import FAILED_TTL, HIBERNATION_INSTANCE_TYPES, OBSERVED_TTL, InstanceCatalog
+
+NOW = 1_800_000_000.0
+DEFAULTS = HIBERNATION_INSTANCE_TYPES["EKS"]
+
+
+def test_defaults_in_order_without_history():
+    assert InstanceCatalog().ranked("EKS", now=NOW) == DEFAULTS
+    assert InstanceCatalog().ranked("unknown", now=NOW) == []
+
+
+def test_override_first_then_observed():
+    catalog = InstanceCatalog(observed={"t3.large": NOW, "m6i.large": NOW})
+    ranked = catalog.ranked("EKS", override="c5.large", now=NOW)
+    assert ranked == ["c5.large", "m6i.large", "t3.large", "m5a.large", "m5.large", "m6a.large"]
+
+
+def test_override_among_defaults_is_not_repeated():
+    assert InstanceCatalog().ranked("EKS", override="t3.large", now=NOW) == ["t3.large"] + DEFAULTS[:-1]
+
+
+def test_recent_failures_are_left_out_until_they_expire():
+    catalog = InstanceCatalog()
+    catalog.mark_failed("m5a.large", "capacity", now=NOW)
+    assert catalog.ranked("EKS", now=NOW + FAILED_TTL - 1) == DEFAULTS[1:]
+    assert catalog.ranked("EKS", now=NOW + FAILED_TTL) == DEFAULTS
+    assert catalog.failed == {}
+
+
+def test_failed_types_are_used_when_nothing_else_is_left():
+    catalog = InstanceCatalog()
+    for name in DEFAULTS:
+        catalog.mark_failed(name, "capacity", now=NOW)
+    assert catalog.ranked("EKS", now=NOW) == DEFAULTS
+
+
+def test_observed_types_expire():
+    catalog = InstanceCatalog(observed={"t3.large": NOW})
+    assert catalog.ranked("EKS", now=NOW + OBSERVED_TTL - 1)[0] == "t3.large"
+    assert catalog.ranked("EKS", now=NOW + OBSERVED_TTL) == DEFAULTS
+
+
+def test_observing_a_ready_node_clears_its_failure():
+    catalog = InstanceCatalog()
+    catalog.mark_failed("m5.large", "capacity", now=NOW)
+    catalog.observe([{"instanceType": "m5.large", "state": {"phase": "ready"}},
+                     {"instanceType": "m6a.large", "state": {"phase": "creating"}}], now=NOW)
+    assert catalog.failed == {}
+    assert catalog.observed == {"m5.large": NOW}
+
+
+def test_json_roundtrip():
+    catalog = InstanceCatalog(observed={"t3.large": NOW})
+    catalog.mark_failed("m5.large", "x" * 500, now=NOW)
+    restored = InstanceCatalog.from_json(catalog.to_json())
+    assert restored.observed == catalog.observed
+    assert restored.failed == {"m5.large": {"at": NOW, "error": "x" * 200}}
+    assert InstanceCatalog.from_json(None).to_json() == InstanceCatalog().to_json()
@@ -0,0 +1,83 @@
+"""Cron schedules of the controller, evaluated like CronJob schedules:
+
+    python -m pytest -q tests_cron.py
+"""
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from cron import CronError, CronSchedule
+
+BERLIN = ZoneInfo("Europe/Berlin")
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def test_weekday_range_skips_weekend():
+    schedule = CronSchedule("0 22 * * 1-5")
+    # friday 2026-10-02 22:00 -> monday
+    assert schedule.next_after(utc(2026, 10, 2, 22, 0)) == utc(2026, 10, 5, 22, 0)
+
+
+def test_next_after_is_strictly_after():
+    schedule = CronSchedule("0 22 * * *")
+    assert schedule.next_after(utc(2026, 10, 2, 21, 59, 59)) == utc(2026, 10, 2, 22, 0)
+    assert schedule.next_after(utc(2026, 10, 2, 22, 0)) == utc(2026, 10, 3, 22, 0)
+
+
+def test_day_of_month_and_weekday_match_either():
+    # the 13th or any friday
+    schedule = CronSchedule("0 0 13 * 5")
+    # thursday 2026-10-01 -> friday 2026-10-02
+    assert schedule.next_after(utc(2026, 10, 1, 12, 0)) == utc(2026, 10, 2, 0, 0)
+    # friday 2026-11-06 -> friday 2026-11-13, also the 13th
+    assert schedule.next_after(utc(2026, 10, 31, 12, 0)) == utc(2026, 11, 6, 0, 0)
+    assert schedule.next_after(utc(2026, 11, 10, 12, 0)) == utc(2026, 11, 13, 0, 0)
+
+
+def test_restricted_day_of_month_with_any_weekday():
+    schedule = CronSchedule("0 0 13 * *")
+    assert schedule.next_after(utc(2026, 10, 1, 12, 0)) == utc(2026, 10, 13, 0, 0)
+
+
+def test_local_time_kept_across_dst_change():
+    schedule = CronSchedule("0 7 * * 1-5", "Europe/Berlin")
+    # friday 07:00 CET, monday 07:00 is CEST after the switch on sunday 2026-03-29
+    after = datetime(2026, 3, 27, 7, 0, tzinfo=BERLIN)
+    assert schedule.next_after(after).astimezone(timezone.utc) == utc(2026, 3, 30, 5, 0)
+
+
+def test_time_in_spring_forward_gap_runs_once_after_the_gap():
+    schedule = CronSchedule("30 2 * * *", "Europe/Berlin")
+    # 02:30 does not exist on 2026-03-29, the run happens at 03:30 CEST
+    first = schedule.next_after(datetime(2026, 3, 28, 3, 0, tzinfo=BERLIN))
+    assert first.astimezone(timezone.utc) == utc(2026, 3, 29, 1, 30)
+    assert schedule.next_after(first).astimezone(timezone.utc) == utc(2026, 3, 30, 0, 30)
+
+
+def test_time_repeated_by_fall_back_runs_once():
+    schedule = CronSchedule("30 2 * * *", "Europe/Berlin")
+    # 02:30 happens twice on 2026-10-25, only the first one runs
+    first = schedule.next_after(datetime(2026, 10, 24, 3, 0, tzinfo=BERLIN))
+    assert first.astimezone(timezone.utc) == utc(2026, 10, 25, 0, 30)
+    assert schedule.next_after(first).astimezone(timezone.utc) == utc(2026, 10, 26, 1, 30)
+
+
+def test_names_macros_and_sunday_alias():
+    assert CronSchedule("0 0 * * sun").weekdays == CronSchedule("0 0 * * 7").weekdays == {0}
+    assert CronSchedule("0 0 1 jan-mar *").months == {1, 2, 3}
+    assert CronSchedule("@daily").next_after(utc(2026, 10, 2, 12, 0)) == utc(2026, 10, 3, 0, 0)
+
+
+@pytest.mark.parametrize("expression", ["0 22 * *", "*/0 * * * *", "0 24 * * *", "0 0 5-1 * *", "0 0 * * funday"])
+def test_invalid_expressions(expression):
+    with pytest.raises(CronError):
+        CronSchedule(expression)
+
+
+def test_never_matching_expression():
+    with pytest.raises(CronError):
+        CronSchedule("0 0 31 2 *").next_after(utc(2026, 1, 1))
@@ -2,8 +2,8 @@ import logging
 import sys
 import time
 
-from main import handle_suspend, handle_resume, get_cloud_provider, cluster_id, castai_api_token, ns, configmap_name, \
-    k8s_v1, hibernate_node_labels
+from context import get_context
+from main import handle_suspend, handle_resume, get_cloud_provider, ns, configmap_name
 from cast_utils import get_cluster_status, get_castai_nodes, get_castai_policy
 from k8s_utils import read_configMap
 from utils import step, parse_labels
@@ -18,27 +18,30 @@ logger.addHandler(handler)
 
 
 class Scenario:
-    def __init__(self, cluster_id, castai_api_token, ns, configmap_name, k8s_v1):
-        self.cluster_id = cluster_id
-        self.castai_api_token = castai_api_token
+    def __init__(self, ctx, ns, configmap_name):
+        self.ctx = ctx
+        self.cluster_id = ctx.cluster_id
+        self.castai_api_url = ctx.castai_api_url
+        self.castai_api_token = ctx.castai_api_token
         self.ns = ns
         self.cm = configmap_name
-        self.k8s_v1 = k8s_v1
-        self.cloud = get_cloud_provider(cluster_id=self.cluster_id, castai_api_token=self.castai_api_token)
+        self.k8s_v1 = ctx.k8s_v1
+        self.cloud = get_cloud_provider(cluster_id=self.cluster_id, castai_api_url=self.castai_api_url,
+                                        castai_api_token=self.castai_api_token)
 
     @step
     def cluster_is_ready(self):
-        cluster = get_cluster_status(self.cluster_id, self.castai_api_token)
+        cluster = get_cluster_status(self.cluster_id, self.castai_api_url, self.castai_api_token)
         logging.info(f"TEST cluster status: {cluster.get('status')}, id: {cluster.get('id')}")
         assert cluster.get('status') == 'ready', "Cluster is not ready"
 
     @step
     def validate_labels(self):
         '''compare if hibernate_node_labels key are on the node labes'''
-        node = get_castai_nodes(self.cluster_id, self.castai_api_token)
+        node = get_castai_nodes(self.cluster_id, self.castai_api_url, self.castai_api_token)
         logging.info(f"TEST node labels: {node['items'][0]['metadata']['labels']}")
-        if hibernate_node_labels:
-            parsed_labels = parse_labels(hibernate_node_labels)
+        if self.ctx.hibernate_node_labels:
+            parsed_labels = parse_labels(self.ctx.hibernate_node_labels)
             if isinstance(parsed_labels, dict):
                 for k, v in parsed_labels.items():
                     assert k in node['items'][0]['metadata']['labels'], f"Label key {k} not found on node"
@@ -57,34 +60,34 @@ class Scenario:
     @step
     def suspend(self):
         logging.info(f"TEST suspending cluster")
-        handle_suspend(self.cloud)
+        handle_suspend(self.ctx, self.cloud)
 
         time.sleep(300)  # sometimes delete nodes takes longer time
-        nodes = get_castai_nodes(self.cluster_id, self.castai_api_token)
+        nodes = get_castai_nodes(self.cluster_id, self.castai_api_url, self.castai_api_token)
         logging.info(f'Number of nodes found in the cluster: {len(nodes["items"])}')
         assert len(nodes["items"]) == 1, "Incorrect number of nodes after suspend"
 
     def double_suspend(self):
         logging.info(f"TEST suspending already suspended cluster")
-        handle_suspend(self.cloud)
+        handle_suspend(self.ctx, self.cloud)
 
         time.sleep(30)  # make sure nodes are not about to be added
-        current_policies = get_castai_policy(self.cluster_id, self.castai_api_token)
-        nodes = get_castai_nodes(self.cluster_id, self.castai_api_token)
+        current_policies = get_castai_policy(self.cluster_id, self.castai_api_url, self.castai_api_token)
+        nodes = get_castai_nodes(self.cluster_id, self.castai_api_url, self.castai_api_token)
         logging.info(f'Number of nodes found in the cluster: {len(nodes["items"])}')
         assert len(nodes["items"]) == 1 and not current_policies["enabled"], "Incorrect number of nodes after suspend"
 
     @step
     def resume(self):
         logging.info(f"TEST resuming cluster")
-        handle_resume()
-        current_policies = get_castai_policy(self.cluster_id, self.castai_api_token)
+        handle_resume(self.ctx)
+        current_policies = get_castai_policy(self.cluster_id, self.castai_api_url, self.castai_api_token)
         assert current_policies["enabled"], "Policy not enabled after resume"
 
 
 def test_all():
     logging.info("TEST test started")
-    scenario = Scenario(cluster_id, castai_api_token, ns, configmap_name, k8s_v1)
+    scenario = Scenario(get_context(), ns, configmap_name)
     scenario.cluster_is_ready()
     scenario.get_cloud()
     scenario.configmap_read()
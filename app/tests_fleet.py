@@ -0,0 +1,41 @@
+"""Clusters file of multi-cluster mode:
+
+    python -m pytest -q tests_fleet.py
+"""
+import json
+
+import pytest
+
+from fleet import load_fleet
+
+ENVIRON = {"API_KEY_PROD": "prod-key", "KUBE_CONTEXT": "shared"}
+
+
+def load(tmp_path, entries: list) -> list:
+    path = tmp_path / "clusters.json"
+    path.write_text(json.dumps(entries))
+    return load_fleet(str(path), "pause", environ=ENVIRON)
+
+
+def test_one_context_per_cluster(tmp_path):
+    contexts = load(tmp_path, [{"cluster_id": "a", "api_key_env": "API_KEY_PROD", "kube_context": "prod"},
+                               {"cluster_id": "b", "api_key": "key", "kube_context": "staging", "cloud": "EKS"},
+                               {"cluster_id": "c", "api_key": "key"}])
+    assert [(ctx.cluster_id, ctx.kube_context, ctx.action) for ctx in contexts] == [
+        ("a", "prod", "pause"), ("b", "staging", "pause"), ("c", None, "pause")]
+    assert contexts[0].castai_api_token == "prod-key"
+
+
+@pytest.mark.parametrize("entries", [
+    [{"cluster_id": "a", "api_key": "key"}, {"cluster_id": "b", "api_key": "key"}],
+    [{"cluster_id": "a", "api_key": "key", "kube_context": "prod"},
+     {"cluster_id": "b", "api_key": "key", "kube_context": "prod"}],
+])
+def test_shared_kubernetes_cluster_is_rejected(tmp_path, entries):
+    with pytest.raises(ValueError, match="both use"):
+        load(tmp_path, entries)
+
+
+def test_unknown_setting_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match="unknown settings"):
+        load(tmp_path, [{"cluster_id": "a", "api_key": "key", "kube_ctx": "prod"}])
@@ -0,0 +1,85 @@
+"""Run lock on a Lease: one holder at a time, take-over of expired and own Leases, run against the fake APIs:
+
+    python -m pytest -q tests_lease.py
+"""
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from fakes import FakeCluster
+from lease import LeaseLock, LockLost
+
+NAME = "castai-hibernate-run"
+NS = "castai-agent"
+
+
+@pytest.fixture
+def client():
+    cluster = FakeCluster(nodes=1, deployments=0).start()
+    yield cluster.context().k8s_coordination
+    cluster.stop()
+
+
+@pytest.fixture
+def locks(client):
+    created = []
+
+    def make(identity: str, action: str = "pause", **kwargs) -> LeaseLock:
+        lock = LeaseLock(client, NAME, NS, action=action, identity=identity, **kwargs)
+        created.append(lock)
+        return lock
+
+    yield make
+    for lock in created:
+        lock.release()
+
+
+def test_second_run_of_same_action_exits_at_once(locks):
+    assert locks("job-1").try_acquire()
+    other = locks("job-2")
+    started = time.monotonic()
+    assert not other.acquire(timeout=30, poll=0.1)
+    assert time.monotonic() - started < 5
+    assert other.holder == "job-1"
+
+
+def test_other_action_waits_for_release(locks):
+    first = locks("job-1")
+    assert first.try_acquire()
+    resume = locks("job-2", action="resume")
+    assert not resume.acquire(timeout=0.3, poll=0.1)
+    assert resume.holder_action == "pause"
+    first.release()
+    assert resume.acquire(timeout=1, poll=0.1)
+
+
+def test_retry_of_same_run_takes_its_lease_over(client, locks):
+    assert locks("job-1").try_acquire()
+    retry = locks("job-1")
+    assert retry.try_acquire()
+    assert client.read_namespaced_lease(NAME, NS).spec.lease_transitions == 0
+
+
+def test_expired_lease_is_taken_over_and_old_holder_stops(client, locks, monkeypatch):
+    first = locks("job-1", renew_interval=0.1)
+    assert first.try_acquire()
+    later = locks("job-2", action="resume")
+    assert not later.try_acquire()
+
+    # seen from two minutes later the renewals of job-1 have stopped
+    monkeypatch.setattr(later, "_now", lambda: datetime.now(timezone.utc) + timedelta(seconds=120))
+    assert later.try_acquire()
+    lease = client.read_namespaced_lease(NAME, NS)
+    assert lease.spec.holder_identity == "job-2"
+    assert lease.spec.lease_transitions == 1
+
+    deadline = time.monotonic() + 5
+    while not first.lost and time.monotonic() < deadline:
+        time.sleep(0.05)
+    with pytest.raises(LockLost):
+        first.check()
+    # the old holder does not clear the Lease of the new one
+    first.release()
+    assert client.read_namespaced_lease(NAME, NS).spec.holder_identity == "job-2"
+    later.check()
@@ -0,0 +1,101 @@
+"""Prometheus text exposition of run metrics, written to a textfile and pushed to a stand-in Pushgateway:
+
+    python -m pytest -q tests_metrics.py
+"""
+import os
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+import metrics
+from bench import start_stand_in_server
+
+
+@pytest.fixture
+def registry():
+    registry = metrics.Registry()
+    runs = registry.register(metrics.Counter("test_runs_total", "Runs.", ("action", "outcome")))
+    duration = registry.register(metrics.Histogram("test_duration_seconds", "Duration.", ("action",),
+                                                   buckets=(1, 5)))
+    runs.inc(action="pause", outcome="ok")
+    runs.inc(2, action="pause", outcome="ok")
+    runs.inc(action='say "hi"\\\n', outcome="failed")
+    duration.observe(0.5, action="pause")
+    duration.observe(3, action="pause")
+    duration.observe(10, action="pause")
+    return registry
+
+
+EXPECTED = """\
+# HELP test_runs_total Runs.
+# TYPE test_runs_total counter
+test_runs_total{action="pause",outcome="ok"} 3
+test_runs_total{action="say \\"hi\\"\\\\\\n",outcome="failed"} 1
+# HELP test_duration_seconds Duration.
+# TYPE test_duration_seconds histogram
+test_duration_seconds_bucket{action="pause",le="1"} 1
+test_duration_seconds_bucket{action="pause",le="5"} 2
+test_duration_seconds_bucket{action="pause",le="+Inf"} 3
+test_duration_seconds_sum{action="pause"} 13.5
+test_duration_seconds_count{action="pause"} 3
+"""
+
+
+def test_exposition_format(registry):
+    assert registry.render() == EXPECTED
+
+
+def test_labels_must_match():
+    counter = metrics.Counter("test_total", "Test.", ("action",))
+    with pytest.raises(ValueError):
+        counter.inc(phase="pause")
+
+
+def test_write_textfile_replaces_file(registry, tmp_path):
+    path = tmp_path / "hibernate.prom"
+    path.write_text("stale")
+    metrics.write_textfile(str(path), registry)
+    assert path.read_text() == EXPECTED
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    # no temporary file is left for node_exporter to pick up
+    assert os.listdir(tmp_path) == ["hibernate.prom"]
+
+
+class _PushgatewayHandler(BaseHTTPRequestHandler):
+    """ Stand-in Pushgateway, keeps the pushed groups on the server"""
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        self.server.pushed.append((self.path, self.headers["Content-Type"], body))
+        self.send_response(200 if self.path.startswith("/metrics/job/") else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def pushgateway():
+    server, url = start_stand_in_server(handler=_PushgatewayHandler)
+    server.pushed = []
+    yield server, url
+    server.shutdown()
+
+
+def test_push_replaces_job_group(registry, pushgateway):
+    server, url = pushgateway
+    metrics.push(url + "/", registry=registry)
+    assert server.pushed == [("/metrics/job/hibernate", "text/plain; version=0.0.4", EXPECTED)]
+
+
+def test_push_error_is_raised(registry, pushgateway):
+    server, url = pushgateway
+    with pytest.raises(requests.exceptions.HTTPError):
+        metrics.push(url + "/prefix", registry=registry)
+
+
+def test_export_is_best_effort(pushgateway, tmp_path):
+    _, url = pushgateway
+    metrics.export(textfile=str(tmp_path / "missing" / "hibernate.prom"), pushgateway_url=url + "/prefix")
@@ -0,0 +1,157 @@
+"""Pipeline checkpoints: a run that failed part way continues from the saved results of checkpointed steps:
+
+    python -m pytest -q tests_pipeline.py
+"""
+import json
+from collections import Counter
+
+import pytest
+
+from pipeline import Pipeline, PipelineError, StopPipeline
+
+
+class MemoryCheckpoint:
+    """ checkpoint store that keeps the JSON like the ConfigMap does"""
+
+    def __init__(self):
+        self.value = None
+        self.running = []
+
+    def load(self) -> dict:
+        return json.loads(self.value or "{}")
+
+    def save(self, completed: dict, running: list):
+        self.value = json.dumps(completed)
+        self.running = running
+
+
+def build(checkpoint, calls: Counter, fail: str = None) -> Pipeline:
+    """ snapshot -> list -> delete, snapshot -> create, delete needs create"""
+    pipeline = Pipeline("test", checkpoint=checkpoint)
+
+    def call(name):
+        calls[name] += 1
+        if name == fail:
+            raise RuntimeError(f"{name} failed")
+
+    @pipeline.step(checkpoint=True, decode=tuple)
+    def snapshot():
+        call("snapshot")
+        return ("node-1", "node-2")
+
+    @pipeline.step(requires=("snapshot",))
+    def list_nodes(snapshot):
+        call("list_nodes")
+        return list(snapshot)
+
+    @pipeline.step(requires=("snapshot",), checkpoint=True)
+    def create(snapshot):
+        call("create")
+        return "hibernation-node"
+
+    @pipeline.step(requires=("list_nodes", "create"), checkpoint=True)
+    def delete(list_nodes, create):
+        call("delete")
+        return [name for name in list_nodes if name != create]
+
+    return pipeline
+
+
+def test_checkpointed_steps_are_restored_after_failure():
+    checkpoint = MemoryCheckpoint()
+    calls = Counter()
+    with pytest.raises(RuntimeError):
+        build(checkpoint, calls, fail="delete").run()
+    assert set(checkpoint.load()) == {"snapshot", "create"}
+
+    calls.clear()
+    pipeline = build(checkpoint, calls)
+    results = pipeline.run()
+    assert sorted(pipeline.restored) == ["create", "snapshot"]
+    # list_nodes is not checkpointed and delete still needs it
+    assert calls == Counter({"list_nodes": 1, "delete": 1})
+    assert results["snapshot"] == ("node-1", "node-2")
+    assert results["delete"] == ["node-1", "node-2"]
+    assert set(checkpoint.load()) == {"snapshot", "create", "delete"}
+
+
+def test_steps_nothing_needs_are_not_run_again():
+    checkpoint = MemoryCheckpoint()
+    build(checkpoint, Counter()).run()
+
+    calls = Counter()
+    pipeline = build(checkpoint, calls)
+    pipeline.run()
+    assert calls == Counter()
+    assert "list_nodes" not in pipeline.results
+
+
+def test_unknown_and_not_checkpointed_results_are_ignored():
+    checkpoint = MemoryCheckpoint()
+    checkpoint.value = json.dumps({"list_nodes": ["stale"], "removed_step": 1})
+    calls = Counter()
+    pipeline = build(checkpoint, calls)
+    pipeline.run()
+    assert pipeline.restored == []
+    assert calls == Counter({"snapshot": 1, "list_nodes": 1, "create": 1, "delete": 1})
+
+
+def test_running_steps_are_saved():
+    checkpoint = MemoryCheckpoint()
+    pipeline = Pipeline("test", checkpoint=checkpoint)
+    seen = []
+
+    @pipeline.step(checkpoint=True)
+    def first():
+        return 1
+
+    @pipeline.step(requires=("first",))
+    def second():
+        seen.append(list(checkpoint.running))
+
+    pipeline.run()
+    assert seen == [["second"]]
+    assert checkpoint.running == []
+
+
+def test_guard_stops_before_next_step():
+    calls = Counter()
+
+    def guard():
+        if calls["first"]:
+            raise RuntimeError("lock lost")
+
+    pipeline = Pipeline("test", guard=guard)
+
+    @pipeline.step()
+    def first():
+        calls["first"] += 1
+
+    @pipeline.step(requires=("first",))
+    def second():
+        calls["second"] += 1
+
+    with pytest.raises(RuntimeError, match="lock lost"):
+        pipeline.run()
+    assert calls == Counter({"first": 1})
+
+
+def test_stop_pipeline_ends_run_without_error():
+    pipeline = Pipeline("test")
+
+    @pipeline.step()
+    def first():
+        raise StopPipeline("nothing to do")
+
+    @pipeline.step(requires=("first",))
+    def second():
+        raise AssertionError("must not run")
+
+    pipeline.run()
+    assert pipeline.stopped_by == "first"
+
+
+def test_unknown_requirement_is_rejected():
+    pipeline = Pipeline("test")
+    with pytest.raises(PipelineError):
+        pipeline.step(name="second", requires=("first",))(lambda: None)
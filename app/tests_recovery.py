@@ -0,0 +1,198 @@
+"""A pause that fails on transient API errors is interrupted instead of rolled back, and the next run continues it
+from the checkpoint. Runs against the fake APIs in fakes.py:
+
+    python -m pytest -q tests_recovery.py
+"""
+import copy
+import logging
+from datetime import datetime, timezone
+
+import pytest
+
+from cast_utils import NodeInventory, select_pausable_nodes
+from cron import CronSchedule
+from fakes import FakeCluster
+from lease import LeaseLock
+from main import (configmap_name, continue_unfinished_pause, ns, run_action, run_lock_name,
+                  suspend_checkpoint_key)
+
+# every item is retried 3 times on its own, a fault on all attempts makes it fail for good
+ATTEMPTS = 3
+
+STAGES = {
+    "deletion": lambda cluster: ("castai", "DELETE", f"/v1/kubernetes/external-clusters/{cluster.cluster_id}/nodes/"
+                                                     f"{next(iter(cluster.castai_nodes))}"),
+    "cordon": lambda cluster: ("kubernetes", "PATCH", f"/api/v1/nodes/{next(iter(cluster.nodes))}"),
+    "tolerations": lambda cluster: ("kubernetes", "PATCH", "/apis/apps/v1/namespaces/kube-system/deployments/coredns"),
+}
+
+
+@pytest.fixture
+def cluster():
+    logging.getLogger().setLevel(logging.WARNING)
+    cluster = FakeCluster(nodes=10, deployments=5, operation_latency=0.05, pod_start_latency=0.05).start()
+    yield cluster
+    cluster.stop()
+
+
+def state(cluster) -> dict:
+    return cluster.config_maps[(ns, configmap_name)]["data"]
+
+
+def workload_state(cluster) -> dict:
+    """ what pause changes on the Kubernetes side: cordon and taints per node, tolerations per Deployment"""
+    nodes = {name: (bool(node["spec"].get("unschedulable")),
+                    [taint["key"] for taint in node["spec"].get("taints") or []])
+             for name, node in cluster.nodes.items()}
+    # a reverted Deployment may keep an empty list where it had none
+    deployments = {key: copy.deepcopy(deployment["spec"]["template"]["spec"].get("tolerations") or [])
+                   for key, deployment in cluster.deployments.items()}
+    return {"nodes": nodes, "deployments": deployments}
+
+
+def assert_pause_undone(cluster, before: dict):
+    """ every node that survived the pause is back as it was, the hibernation node lost its taint"""
+    after = workload_state(cluster)
+    for name, node in after["nodes"].items():
+        assert node == before["nodes"].get(name, (False, [])), name
+    assert after["deployments"] == before["deployments"]
+    assert not state(cluster).get(suspend_checkpoint_key)
+    assert cluster.policies["enabled"] is True
+
+
+@pytest.mark.parametrize("stage", STAGES)
+def test_transient_failure_interrupts_and_next_run_continues(cluster, stage):
+    api, method, path = STAGES[stage](cluster)
+    cluster.fail(api, method, path, times=ATTEMPTS, status=503)
+    ctx = cluster.context()
+    try:
+        with pytest.raises(Exception):
+            run_action(ctx, "EKS", "pause")
+        assert state(cluster)["last_run_status"] == "interrupted"
+        assert state(cluster).get(suspend_checkpoint_key)
+        # not rolled back, the autoscaler stays off for the retried run
+        assert cluster.policies["enabled"] is False
+        created = cluster.calls["castai POST node"]
+
+        assert run_action(ctx, "EKS", "pause") is True
+        assert state(cluster)["last_run_status"] == "success"
+        assert not state(cluster).get(suspend_checkpoint_key)
+        assert len(cluster.nodes) == 1
+        # the hibernation node of the first run was restored from the checkpoint, not created again
+        assert cluster.calls["castai POST node"] == created
+    finally:
+        ctx.node_informer.stop()
+
+
+@pytest.mark.parametrize("stage", STAGES)
+def test_permanent_failure_rolls_back(cluster, stage):
+    before = workload_state(cluster)
+    api, method, path = STAGES[stage](cluster)
+    cluster.fail(api, method, path, times=1, status=403)
+    ctx = cluster.context()
+    try:
+        assert run_action(ctx, "EKS", "pause") is False
+        assert state(cluster)["last_run_status"] == "exception"
+        assert_pause_undone(cluster, before)
+    finally:
+        ctx.node_informer.stop()
+
+
+def test_rollback_ignores_snapshot_of_earlier_pause(cluster):
+    ctx = cluster.context()
+    try:
+        assert run_action(ctx, "EKS", "pause") is True
+        run_action(ctx, "EKS", "resume")
+        # the first pause left its toleration on the kept Deployments, its snapshot says they had none
+        tolerations = workload_state(cluster)["deployments"]
+        cluster.fail("kubernetes", "PUT", f"/api/v1/namespaces/{ns}/configmaps/{configmap_name}-snapshot-0",
+                     times=1, status=403)
+
+        assert run_action(ctx, "EKS", "pause") is False
+        assert workload_state(cluster)["deployments"] == tolerations
+        assert not state(cluster).get(suspend_checkpoint_key)
+        assert cluster.policies["enabled"] is True
+    finally:
+        ctx.node_informer.stop()
+
+
+def test_job_node_deletion_is_started_not_awaited():
+    # slow drains: the run must record its status before the drain of its own node evicts it
+    cluster = FakeCluster(nodes=5, deployments=5, operation_latency=1.5, pod_start_latency=0.05).start()
+    logging.getLogger().setLevel(logging.WARNING)
+    job_node = next(iter(cluster.castai_nodes.values()))
+    ctx = cluster.context(my_node_name=job_node["name"])
+    try:
+        assert run_action(ctx, "EKS", "pause") is True
+        assert state(cluster)["last_run_status"] == "success"
+        assert cluster.castai_nodes[job_node["id"]]["state"]["phase"] == "draining"
+    finally:
+        ctx.node_informer.stop()
+        cluster.stop()
+
+
+def test_draining_nodes_are_not_deleted_again():
+    inventory = NodeInventory([{"id": "a", "name": "a", "labels": {}, "state": {"phase": "draining"}},
+                               {"id": "b", "name": "b", "labels": {}, "state": {"phase": "ready"}}])
+    summary = {"deleted": [], "in_progress": [], "skipped": [], "failed": {}}
+    assert select_pausable_nodes(inventory, "hibernation", "false", None, summary) == ["b"]
+    assert summary["in_progress"] == ["a"]
+
+
+def test_controller_continues_pause_of_killed_pod(cluster):
+    # the next slot is a resume, so the cluster is due to stay paused
+    hour = datetime.now(timezone.utc).hour
+    schedules = {"pause": CronSchedule(f"0 {(hour + 2) % 24} * * *"),
+                 "resume": CronSchedule(f"0 {(hour + 1) % 24} * * *")}
+    api, method, path = STAGES["deletion"](cluster)
+    cluster.fail(api, method, path, times=ATTEMPTS, status=503)
+    ctx = cluster.context(run_lock_identity="hibernate-controller")
+    # the killed pod never released its Lease
+    dead = LeaseLock(ctx.k8s_coordination, run_lock_name, ns, action="pause", identity="hibernate-controller",
+                     renew_interval=3600)
+    try:
+        with pytest.raises(Exception):
+            run_action(ctx, "EKS", "pause")
+        assert dead.try_acquire()
+
+        assert continue_unfinished_pause(ctx, "EKS", schedules) is True
+        assert state(cluster)["last_run_status"] == "success"
+        assert len(cluster.nodes) == 1
+    finally:
+        dead.release()
+        ctx.node_informer.stop()
+
+
+def test_resume_undoes_unfinished_pause(cluster):
+    before = workload_state(cluster)
+    api, method, path = STAGES["deletion"](cluster)
+    cluster.fail(api, method, path, times=ATTEMPTS, status=503)
+    ctx = cluster.context()
+    try:
+        with pytest.raises(Exception):
+            run_action(ctx, "EKS", "pause")
+        assert state(cluster)["last_run_status"] == "interrupted"
+
+        run_action(ctx, "EKS", "resume")
+        assert_pause_undone(cluster, before)
+    finally:
+        ctx.node_informer.stop()
+
+
+def test_controller_retries_unfinished_pause(cluster):
+    hour = datetime.now(timezone.utc).hour
+    schedules = {"pause": CronSchedule(f"0 {(hour + 2) % 24} * * *"),
+                 "resume": CronSchedule(f"0 {(hour + 1) % 24} * * *")}
+    api, method, path = STAGES["cordon"](cluster)
+    # the scheduled pause and the first retry fail
+    cluster.fail(api, method, path, times=2 * ATTEMPTS, status=503)
+    ctx = cluster.context()
+    try:
+        with pytest.raises(Exception):
+            run_action(ctx, "EKS", "pause")
+        assert continue_unfinished_pause(ctx, "EKS", schedules, initial_backoff=0) is True
+        assert cluster.calls[f"{api} {method} injected 503"] == 2 * ATTEMPTS
+        assert state(cluster)["last_run_status"] == "success"
+        assert len(cluster.nodes) == 1
+    finally:
+        ctx.node_informer.stop()
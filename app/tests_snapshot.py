@@ -0,0 +1,72 @@
+"""Pre-pause snapshot encoding and its chunk ConfigMaps, run against the fake APIs in fakes.py:
+
+    python -m pytest -q tests_snapshot.py
+"""
+import os
+
+import pytest
+
+from fakes import FakeCluster
+from snapshot import SnapshotError, chunk_config_map_name, decode_snapshot, encode_snapshot, read_snapshot, save_snapshot
+
+CM = "castai-hibernate-state"
+NS = "castai-agent"
+
+
+def make_snapshot(nodes: int) -> dict:
+    # node ids do not compress, so the payload needs several small chunks
+    return {"taken_at": "2026-10-02T22:00:00", "nodes": [{"name": f"node-{index}", "castai_id": os.urandom(16).hex()}
+                                                        for index in range(nodes)]}
+
+
+def test_roundtrip_in_chunks():
+    snapshot = make_snapshot(100)
+    meta, chunks = encode_snapshot(snapshot, chunk_size=1024)
+    assert meta["chunks"] == len(chunks) > 1
+    assert all(len(chunk) <= 1024 for chunk in chunks)
+    assert sum(len(chunk) for chunk in chunks) == meta["size"]
+    assert decode_snapshot(meta, chunks) == snapshot
+
+
+def test_empty_snapshot_has_one_chunk():
+    meta, chunks = encode_snapshot({})
+    assert meta["chunks"] == len(chunks) == 1
+    assert decode_snapshot(meta, chunks) == {}
+
+
+def test_missing_or_foreign_chunk_is_rejected():
+    meta, chunks = encode_snapshot(make_snapshot(100), chunk_size=1024)
+    with pytest.raises(SnapshotError):
+        decode_snapshot(meta, chunks[:-1])
+    _, other = encode_snapshot(make_snapshot(100), chunk_size=1024)
+    with pytest.raises(SnapshotError):
+        decode_snapshot(meta, [other[0]] + chunks[1:])
+
+
+def test_unknown_version_is_rejected():
+    meta, chunks = encode_snapshot({})
+    with pytest.raises(SnapshotError):
+        decode_snapshot(dict(meta, version=meta["version"] + 1), chunks)
+
+
+@pytest.fixture
+def cluster():
+    cluster = FakeCluster(nodes=1, deployments=0).start()
+    yield cluster
+    cluster.stop()
+
+
+def test_save_and_read_drop_chunks_of_a_larger_earlier_snapshot(cluster):
+    client = cluster.context().k8s_v1
+    assert read_snapshot(client, CM, NS) is None
+
+    large = make_snapshot(200)
+    meta = save_snapshot(client, CM, NS, large, chunk_size=1024)
+    assert meta["chunks"] > 2
+    assert read_snapshot(client, CM, NS) == large
+
+    small = make_snapshot(1)
+    assert save_snapshot(client, CM, NS, small, chunk_size=1024)["chunks"] == 1
+    assert read_snapshot(client, CM, NS) == small
+    chunk_maps = [name for namespace, name in cluster.config_maps if name.startswith(f"{CM}-snapshot-")]
+    assert chunk_maps == [chunk_config_map_name(CM, 0)]
@@ -1,17 +1,30 @@
+import contextvars
 import functools
 import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import requests
-from tenacity import retry, wait_fixed, stop_after_attempt, before_log, retry_if_exception_type
+from concurrent.futures import ThreadPoolExecutor
+from tenacity import retry, stop_after_attempt, before_log, retry_if_exception
+
+import metrics
+
+# longest Retry-After that is honored, a server asking for more gets the regular backoff
+MAX_RETRY_AFTER = 300
 
 
 def step(f):
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
         logging.info(f"============= starting {f.__name__ + ' ':=<40}=============")
+        started = time.monotonic()
         try:
             return f(*args, **kwargs)
         finally:
-            logging.info(f"------------- finishing {f.__name__ + ' ':-<40}------------")
+            logging.info(f"------------- finishing {f.__name__ + ' ':-<40}------------ {time.monotonic() - started:.1f}s")
 
     return wrapper
 
@@ -23,22 +36,65 @@ def _is_retryable_error(exc: BaseException) -> bool:
     if isinstance(exc, requests.exceptions.ConnectionError):
         return True
     if isinstance(exc, requests.exceptions.HTTPError):
-        # Retry on 5xx server errors, but fail fast on 4xx client errors
+        # Retry on 5xx server errors and throttling, but fail fast on other 4xx client errors
         resp = exc.response
-        if resp is not None and 500 <= resp.status_code < 600:
+        if resp is not None and (resp.status_code == 429 or 500 <= resp.status_code < 600):
             return True
         return False
+    from kubernetes.client.rest import ApiException  # deferred, kubernetes client is slow to import
+    if isinstance(exc, ApiException):
+        # Kubernetes API server errors, same rule as above
+        return exc.status is not None and (exc.status == 429 or 500 <= exc.status < 600)
     return False
 
 
+def retry_after(exc: BaseException):
+    """Seconds the server asked to wait in the Retry-After header of the failed response, None without one."""
+    headers = None
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        headers = exc.response.headers
+    else:
+        headers = getattr(exc, "headers", None)
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    if seconds > MAX_RETRY_AFTER:
+        return None
+    return max(0.0, seconds)
+
+
+def retry_delay(exc: BaseException, attempt: int, pause: float) -> float:
+    """Retry-After when the server sent one, otherwise exponential backoff from pause with jitter."""
+    delay = retry_after(exc)
+    if delay is not None:
+        return delay
+    delay = min(pause * 2 ** (attempt - 1), pause * 8)
+    return random.uniform(delay / 2, delay)
+
+
+def _wait_retry_delay(pause: float):
+    def wait(retry_state):
+        return retry_delay(retry_state.outcome.exception(), retry_state.attempt_number, pause)
+    return wait
+
+
 def basic_retry(attempts, pause):
     def decorator_chain(f):
         f = failure_logging(f)
         f = retry(
-            wait=wait_fixed(pause),
+            wait=_wait_retry_delay(pause),
             stop=stop_after_attempt(attempts),
             before=before_log(logging, logging.INFO),
-            retry=retry_if_exception_type(_is_retryable_error),
+            retry=retry_if_exception(_is_retryable_error),
+            before_sleep=lambda retry_state: metrics.RETRIES.inc(function=f.__name__),
+            reraise=True,
         )(f)
         return f
 
@@ -56,6 +112,129 @@ def failure_logging(f):
 
     return wrapper
 
+
+def run_concurrently(f, items, max_workers: int):
+    """Call f(item) for every item in a bounded thread pool, failures are isolated per item.
+
+    Returns a dict of item -> (result, exception), exactly one of them is None.
+    """
+    outcomes = {}
+    if not items:
+        return outcomes
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        # each item runs in a copy of the caller context, keeps context variables such as the log tag
+        futures = {executor.submit(contextvars.copy_context().run, f, item): item for item in items}
+        for future, item in futures.items():
+            try:
+                outcomes[item] = (future.result(), None)
+            except Exception as err:
+                outcomes[item] = (None, err)
+    return outcomes
+
+
+class FanOutError(Exception):
+    """ some items of a concurrent operation failed, summary reports every item"""
+
+    def __init__(self, message, summary, errors=None):
+        super().__init__(message)
+        self.summary = summary
+        # item -> exception, lets the caller tell transient failures from real ones
+        self.errors = errors or {}
+
+
+def sort_outcomes(outcomes: dict, summary: dict, done: str, skipped: str = None) -> dict:
+    """ record run_concurrently outcomes in summary, a falsy result counts as skipped when skipped is given.
+
+    Returns a dict of item -> exception of the failed items.
+    """
+    errors = {}
+    for item, (result, err) in outcomes.items():
+        if err is not None:
+            summary["failed"][item] = str(err)
+            errors[item] = err
+        elif skipped and not result:
+            summary[skipped].append(item)
+        else:
+            summary[done].append(item)
+    return errors
+
+
+def finish_summary(title: str, summary: dict, errors: dict, error_class, verb: str, noun: str):
+    """ log the summary of a concurrent operation, raise error_class when any item failed"""
+    logging.info("%s summary: %s", title,
+                 ", ".join(f"{key.replace('_', ' ')} {len(items)}" for key, items in summary.items()))
+    for item, err in summary["failed"].items():
+        logging.error("Failed to %s %s %s: %s", verb, noun, item, err)
+    if summary["failed"]:
+        raise error_class(f'Failed to {verb} {len(summary["failed"])} {noun}s', summary, errors)
+    return summary
+
+
+class RateLimiter:
+    """Token bucket shared between threads, rate requests per second with bursts up to burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take one token, returns how many seconds the caller has to wait before sending."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+# endpoint class -> (requests per second, burst), one bucket per class for the whole process
+RATE_LIMITS = {
+    "castai-read": (20, 40),
+    "castai-write": (10, 20),
+    "castai-operations": (10, 20),
+    "k8s-read": (50, 100),
+    "k8s-write": (30, 60),
+}
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def set_rate_limit(endpoint_class: str, rate: float, burst: int):
+    with _rate_limiters_lock:
+        _rate_limiters[endpoint_class] = RateLimiter(rate, burst)
+
+
+def get_rate_limiter(endpoint_class: str) -> RateLimiter:
+    with _rate_limiters_lock:
+        if endpoint_class not in _rate_limiters:
+            _rate_limiters[endpoint_class] = RateLimiter(*RATE_LIMITS[endpoint_class])
+        return _rate_limiters[endpoint_class]
+
+
+def parse_rate_limits(value: str) -> dict:
+    """Parse "castai-write=5/10,k8s-write=40" into endpoint class -> (rate, burst), burst defaults to 2x rate."""
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        endpoint_class, _, limit = item.partition("=")
+        rate, _, burst = limit.partition("/")
+        endpoint_class = endpoint_class.strip()
+        if endpoint_class not in RATE_LIMITS:
+            raise ValueError(f"unknown endpoint class {endpoint_class}, one of {', '.join(RATE_LIMITS)}")
+        limits[endpoint_class] = (float(rate), int(burst) if burst else max(1, int(float(rate) * 2)))
+    return limits
+
+
 def parse_labels(labels: str) -> dict:
     """Parse and validate labels from a string"""
     label_dict = {}